@@ -0,0 +1,374 @@
+"""
+ベンチマーク用の偽の外部サービス
+
+VOICEVOXはローカルのHTTPサーバーとして動かし、
+Gemini, OpenAI, Discordは同じインターフェースを持つオブジェクトで置き換える。
+どれも応答までの待ち時間を指定でき、呼び出し回数を数える。
+"""
+
+import asyncio
+import base64
+import io
+import json
+import math
+import re
+import struct
+import threading
+import time
+import types
+from array import array
+from types import SimpleNamespace
+from typing import Any, Optional, Union, get_args, get_origin
+
+from aiohttp import web
+from PIL import Image
+from pydantic import BaseModel
+
+# 偽のVOICEVOXが返す音声の形式 (VOICEVOXと同じ24kHzモノラル16bit)
+VOICEVOX_SAMPLE_RATE = 24000
+# 1文字あたりの音声の長さ(秒)
+SECONDS_PER_CHAR = 0.12
+
+
+def make_wav(seconds: float, sample_rate: int = VOICEVOX_SAMPLE_RATE) -> bytes:
+    """440Hzの正弦波のwav"""
+    count = max(int(seconds * sample_rate), 1)
+    period = array(
+        "h",
+        (
+            int(8000 * math.sin(2 * math.pi * 440 * i / sample_rate))
+            for i in range(sample_rate // 440 * 10)
+        ),
+    )
+    samples = (period * (count // len(period) + 1))[:count]
+    data = samples.tobytes()
+    header = struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF",
+        36 + len(data),
+        b"WAVE",
+        b"fmt ",
+        16,
+        1,
+        1,
+        sample_rate,
+        sample_rate * 2,
+        2,
+        16,
+        b"data",
+        len(data),
+    )
+    return header + data
+
+
+def make_png(size: int = 1024) -> bytes:
+    """圧縮の効きにくいノイズ画像 (生成画像に近いサイズになる)"""
+    image = Image.effect_noise((size, size), 64).convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class FakeVoicevoxServer:
+    """
+    /version, /audio_query, /synthesis だけを持つ偽のVOICEVOXエンジン
+
+    別スレッドのイベントループで動かすので、同期(requests)と非同期(aiohttp)の
+    どちらのクライアントからも呼び出せる。
+    """
+
+    def __init__(
+        self,
+        query_latency: float = 0.02,
+        synthesis_latency: float = 0.1,
+        synthesis_latency_per_char: float = 0.002,
+    ):
+        self.query_latency = query_latency
+        self.synthesis_latency = synthesis_latency
+        self.synthesis_latency_per_char = synthesis_latency_per_char
+        self.requests = {"version": 0, "audio_query": 0, "synthesis": 0}
+        self.url: Optional[str] = None
+        self._loop = asyncio.new_event_loop()
+        self._runner: Optional[web.AppRunner] = None
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+
+    async def version(self, request: web.Request) -> web.Response:
+        self.requests["version"] += 1
+        return web.json_response("0.0.0-fake")
+
+    async def audio_query(self, request: web.Request) -> web.Response:
+        self.requests["audio_query"] += 1
+        await asyncio.sleep(self.query_latency)
+        text = request.query.get("text", "")
+        return web.json_response(
+            {
+                "accent_phrases": [],
+                "speedScale": 1.0,
+                "pitchScale": 0.0,
+                "intonationScale": 1.0,
+                "volumeScale": 1.0,
+                "outputSamplingRate": VOICEVOX_SAMPLE_RATE,
+                "outputStereo": False,
+                "kana": text,
+            }
+        )
+
+    async def synthesis(self, request: web.Request) -> web.Response:
+        self.requests["synthesis"] += 1
+        query = await request.json()
+        text = query.get("kana", "")
+        await asyncio.sleep(
+            self.synthesis_latency + self.synthesis_latency_per_char * len(text)
+        )
+        seconds = len(text) * SECONDS_PER_CHAR / query.get("speedScale", 1.0)
+        return web.Response(body=make_wav(seconds), content_type="audio/wav")
+
+    async def _start(self) -> str:
+        app = web.Application()
+        app.router.add_get("/version", self.version)
+        app.router.add_post("/audio_query", self.audio_query)
+        app.router.add_post("/synthesis", self.synthesis)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}"
+
+    def start(self) -> "FakeVoicevoxServer":
+        self._thread.start()
+        self.url = asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+        return self
+
+    def stop(self):
+        if self._runner is not None:
+            asyncio.run_coroutine_threadsafe(
+                self._runner.cleanup(), self._loop
+            ).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+def sample_value(annotation: Any, name: str) -> Any:
+    """型注釈に合う値を作る (文字列はフィールド名にする)"""
+    origin = get_origin(annotation)
+    if origin in (Union, types.UnionType):
+        args = [a for a in get_args(annotation) if a is not type(None)]
+        return sample_value(args[0], name)
+    if origin is list:
+        return [sample_value(get_args(annotation)[0], name)]
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return sample_model(annotation)
+    if annotation is int:
+        return 0
+    if annotation is float:
+        return 0.0
+    if annotation is bool:
+        return False
+    return name
+
+
+def sample_model(schema: type[BaseModel]) -> dict:
+    return {
+        name: sample_value(field.annotation, name)
+        for name, field in schema.model_fields.items()
+    }
+
+
+def sample_json(schema: type[BaseModel], prompt: str) -> str:
+    """
+    スキーマに合うJSONを作る
+    一括抽出(scenesにindexを持つ)の場合は、プロンプトの[段落N]ごとに1件ずつ作る
+    """
+    data = sample_model(schema)
+    scenes = schema.model_fields.get("scenes")
+    if scenes is not None:
+        item = get_args(scenes.annotation)[0]
+        indices = [int(n) for n in re.findall(r"\[段落(\d+)\]", prompt)]
+        data["scenes"] = [{**sample_model(item), "index": i} for i in indices]
+    return json.dumps(data, ensure_ascii=False)
+
+
+def text_response(text: str) -> SimpleNamespace:
+    return SimpleNamespace(text=text, candidates=[])
+
+
+def image_response(data: bytes, mime_type: str = "image/png") -> SimpleNamespace:
+    part = SimpleNamespace(
+        text=None, inline_data=SimpleNamespace(data=data, mime_type=mime_type)
+    )
+    return SimpleNamespace(
+        text=None, candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))]
+    )
+
+
+class FakeGemini:
+    """
+    genai.Client().aio の models.generate_content だけを持つ偽物
+
+    response_schemaが指定されていればスキーマに合うJSON、
+    画像の出力を求められていれば画像、それ以外は短い文章を返す。
+    """
+
+    def __init__(self, latency: float = 0.3, image_latency: float = 2.0):
+        self.latency = latency
+        self.image_latency = image_latency
+        self.image = make_png()
+        self.calls = 0
+        self.aio = SimpleNamespace(
+            models=SimpleNamespace(generate_content=self._generate_content_async)
+        )
+
+    def _wants_image(self, config: Any) -> bool:
+        modalities = getattr(config, "response_modalities", None) or []
+        return "Image" in modalities
+
+    def _respond(self, contents: Any, config: Any) -> SimpleNamespace:
+        self.calls += 1
+        if self._wants_image(config):
+            return image_response(self.image)
+        schema = config.get("response_schema") if isinstance(config, dict) else None
+        if schema is not None:
+            return text_response(sample_json(schema, str(contents)))
+        return text_response("ぼくはずんだもんなのだ。ベンチマーク中なのだ。")
+
+    def _delay(self, config: Any) -> float:
+        return self.image_latency if self._wants_image(config) else self.latency
+
+    async def _generate_content_async(
+        self, model: str, contents: Any, config: Any = None
+    ):
+        await asyncio.sleep(self._delay(config))
+        return self._respond(contents, config)
+
+
+class FakeOpenAI:
+    """AsyncOpenAI の images.generate と images.edit だけを持つ偽物"""
+
+    def __init__(self, latency: float = 2.0):
+        self.latency = latency
+        self.b64_image = base64.b64encode(make_png()).decode("ascii")
+        self.calls = 0
+        self.images = SimpleNamespace(generate=self._generate, edit=self._generate)
+
+    def _result(self) -> SimpleNamespace:
+        self.calls += 1
+        return SimpleNamespace(data=[SimpleNamespace(b64_json=self.b64_image)])
+
+    async def _generate(self, **kwargs):
+        await asyncio.sleep(self.latency)
+        return self._result()
+
+
+class FakeMessage:
+    """Discordのメッセージ (受信したコマンドと、送信したメッセージの両方に使う)"""
+
+    def __init__(self, content: str, channel: "FakeChannel", author=None, guild=None):
+        self.content = content
+        self.channel = channel
+        self.author = author
+        self.guild = guild
+        self.attachments = []
+        self.mentions = []
+
+    async def edit(self, content: Optional[str] = None, **kwargs):
+        self.content = content
+
+
+class FakeChannel:
+    """テキストチャンネル。送信したメッセージと時刻を記録する"""
+
+    def __init__(self, channel_id: int, latency: float = 0.05):
+        self.id = channel_id
+        self.latency = latency
+        self.sent: list[tuple[float, Optional[str], int]] = []
+
+    async def send(self, content: Optional[str] = None, *, file=None, files=None):
+        await asyncio.sleep(self.latency)
+        files = ([file] if file else []) + list(files or [])
+        for f in files:
+            f.close()
+        self.sent.append((time.perf_counter(), content, len(files)))
+        return FakeMessage(content, self)
+
+
+class FakeVoiceClient:
+    """
+    ボイスクライアント。play()された音声ソースを別スレッドで最後まで読む
+
+    realtime=Trueの場合は実際の再生と同じく1フレーム20ミリ秒かけて読む。
+    Falseの場合は待たずに読むので、合成や読み込みの速さだけを測れる。
+    """
+
+    FRAME_SECONDS = 0.02
+
+    def __init__(self, realtime: bool = False):
+        self.realtime = realtime
+        self.play_times: list[float] = []
+        self.frames = 0
+        self.errors: list[Exception] = []
+        self._stopped = threading.Event()
+        self._playing = False
+
+    def is_connected(self) -> bool:
+        return True
+
+    def is_playing(self) -> bool:
+        return self._playing
+
+    def stop(self):
+        self._stopped.set()
+
+    def play(self, source, *, after=None):
+        self.play_times.append(time.perf_counter())
+        self._stopped.clear()
+        self._playing = True
+        threading.Thread(target=self._read, args=(source, after), daemon=True).start()
+
+    def _read(self, source, after):
+        error = None
+        try:
+            while not self._stopped.is_set():
+                if not source.read():
+                    break
+                self.frames += 1
+                if self.realtime:
+                    time.sleep(self.FRAME_SECONDS)
+        except Exception as e:
+            error = e
+            self.errors.append(e)
+        finally:
+            source.cleanup()
+            self._playing = False
+            if after:
+                after(error)
+
+
+class FakeVoiceChannel:
+    def __init__(self, guild: "FakeGuild", latency: float = 0.1):
+        self.guild = guild
+        self.latency = latency
+
+    async def connect(self) -> FakeVoiceClient:
+        await asyncio.sleep(self.latency)
+        self.guild.voice_client = FakeVoiceClient(self.guild.realtime)
+        return self.guild.voice_client
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int, realtime: bool = False):
+        self.id = guild_id
+        self.realtime = realtime
+        self.voice_client: Optional[FakeVoiceClient] = None
+
+
+def make_command(
+    content: str, guild_id: int, realtime: bool = False
+) -> tuple[FakeMessage, FakeGuild]:
+    """ボイスチャンネルに参加しているユーザーが送ったコマンド"""
+    guild = FakeGuild(guild_id, realtime)
+    author = SimpleNamespace(
+        bot=False, voice=SimpleNamespace(channel=FakeVoiceChannel(guild))
+    )
+    message = FakeMessage(content, FakeChannel(guild_id), author=author, guild=guild)
+    return message, guild
@@ -0,0 +1,362 @@
+"""
+外部サービスを使わずに主要なコマンドの処理時間を測るベンチマーク
+
+VOICEVOXはローカルの偽サーバー、Gemini, OpenAI, Discordは偽のオブジェクトに置き換え、
+/save (generate_book.save), /talk, /load, /image をコマンドの振り分けから最後まで実行する。
+シナリオごとにスループットと処理時間のp50, p95を表示する。
+
+python bench/run_bench.py --iterations 5
+python bench/run_bench.py --json bench.json                 # 結果を保存
+python bench/run_bench.py --baseline bench.json             # 保存した結果と比べ、遅くなっていれば終了コード1
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import Awaitable, Callable, Optional
+
+from pydantic import BaseModel
+
+from fakes import (
+    FakeGemini,
+    FakeOpenAI,
+    FakeVoicevoxServer,
+    make_command,
+)
+
+SEP = "-" * 100
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+SCENARIOS = ("save", "talk", "load", "image")
+
+# ベンチマークで使う文章 (段落ごとに番号を付けて、キャッシュに当たらないようにする)
+PARAGRAPH_TEXT = (
+    "ずんだもんは朝早く起きて、畑のえだまめの様子を見に行ったのだ。"
+    "朝露に濡れた葉っぱがきらきらと光っていて、遠くの山には薄い霧がかかっていたのだ。"
+    "ずんだもんは大きなかごを背負って、ひとつひとつ丁寧にさやを摘み取っていったのだ。"
+)
+TALK_TEXT = PARAGRAPH_TEXT * 4
+
+# 偽のサービスを使うので、呼び出し制限は同時実行数だけにする
+BENCH_RATE_LIMITS = {
+    "openai/gpt-image-1": {"rpm": 0, "tpm": 0},
+    "gemini/gemini-2.5-flash": {"rpm": 0, "tpm": 0},
+    "gemini/gemini-2.0-flash-exp-image-generation": {"rpm": 0, "tpm": 0},
+}
+
+
+class ScenarioResult(BaseModel):
+    """シナリオごとの結果 (秒)"""
+
+    name: str
+    iterations: int
+    errors: int
+    elapsed: float
+    throughput: float
+    p50: float
+    p95: float
+    max: float
+    first_audio_p50: Optional[float] = None
+    first_audio_p95: Optional[float] = None
+
+
+def percentile(values: list[float], q: float) -> float:
+    """nearest-rank法のパーセンタイル"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(math.ceil(q * len(ordered)) - 1, 0)]
+
+
+def book_markdown(title: str, paragraphs: int, iteration: int) -> str:
+    body = "\n\n---\n\n".join(
+        f"{PARAGRAPH_TEXT}({iteration}-{i})" for i in range(paragraphs)
+    )
+    return f"/save ## {title}\n\n{body}"
+
+
+class Bench:
+    """シナリオの実行と計測"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.saved_titles: list[str] = []
+        self._guild_id = 0
+
+        # 偽物を差し込んだ後に読み込む (モジュールの読み込み時に環境変数を読むため)
+        import clients
+        import discord_bot
+        import generate_voice
+
+        self.clients = clients
+        self.router = discord_bot.router
+        self.gv = generate_voice
+        self.gemini = FakeGemini(args.gemini_latency, args.gemini_image_latency)
+        self.openai = FakeOpenAI(args.openai_latency)
+
+    def install_fakes(self):
+        """イベントループごとのクライアントも差し替えるので、ループ内で呼ぶ"""
+        registry = self.clients.registry
+        registry.override("genai_aio", self.gemini.aio)
+        registry.override("openai_async", self.openai)
+
+    def next_guild_id(self) -> int:
+        self._guild_id += 1
+        return self._guild_id
+
+    async def measure(
+        self,
+        name: str,
+        run_once: Callable[[int], Awaitable[Optional[float]]],
+    ) -> ScenarioResult:
+        """
+        run_onceをiterations回、concurrency件ずつ並行して実行する
+        run_onceは最初の音声が再生されるまでの時間を返してもよい
+        """
+        latencies: list[float] = []
+        first_audio: list[float] = []
+        errors = 0
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def one(i: int):
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    audio = await run_once(i)
+                except Exception as e:
+                    errors += 1
+                    print(f"[{name}] {i}回目でエラー: {type(e).__name__}: {e}")
+                    return
+                latencies.append(time.perf_counter() - start)
+                if audio is not None:
+                    first_audio.append(audio)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(self.args.iterations)))
+        elapsed = time.perf_counter() - start
+
+        return ScenarioResult(
+            name=name,
+            iterations=self.args.iterations,
+            errors=errors,
+            elapsed=elapsed,
+            throughput=len(latencies) / elapsed if elapsed else 0.0,
+            p50=percentile(latencies, 0.5),
+            p95=percentile(latencies, 0.95),
+            max=max(latencies, default=0.0),
+            first_audio_p50=percentile(first_audio, 0.5) if first_audio else None,
+            first_audio_p95=percentile(first_audio, 0.95) if first_audio else None,
+        )
+
+    async def dispatch(self, content: str) -> Optional[float]:
+        """コマンドを実行し、最初の音声が再生されるまでの時間を返す"""
+        message, guild = make_command(content, self.next_guild_id(), self.args.realtime)
+        start = time.perf_counter()
+        if not await self.router.dispatch(message):
+            raise Exception(f"コマンドが見つかりません: {content[:20]}")
+        errors = [
+            c
+            for _, c, _ in message.channel.sent
+            if c and ("失敗" in c or "エラー" in c or "見つかりません" in c)
+        ]
+        if errors:
+            raise Exception(errors[0])
+        voice_client = guild.voice_client
+        if voice_client is None or not voice_client.play_times:
+            return None
+        if voice_client.errors:
+            error = voice_client.errors[0]
+            raise Exception(f"再生エラー: {type(error).__name__} {error}")
+        return voice_client.play_times[0] - start
+
+    async def save_once(self, i: int) -> None:
+        title = f"ベンチ{i}"
+        await self.dispatch(book_markdown(title, self.args.paragraphs, i))
+        self.saved_titles.append(title)
+
+    async def talk_once(self, i: int) -> Optional[float]:
+        return await self.dispatch(f"/talk {TALK_TEXT}({i})")
+
+    async def load_once(self, i: int) -> Optional[float]:
+        title = self.saved_titles[i % len(self.saved_titles)]
+        return await self.dispatch(f"/load {title}")
+
+    async def image_once(self, i: int) -> None:
+        await self.dispatch(f"/image 枝豆畑で朝露に濡れるずんだもん ({i})")
+
+    async def run(self, scenarios: list[str]) -> list[ScenarioResult]:
+        self.install_fakes()
+        results = []
+        try:
+            for name in scenarios:
+                if name == "load" and not self.saved_titles:
+                    # 読み込むブックを用意する (計測しない)
+                    await self.save_once(0)
+                print(SEP)
+                print(f"シナリオ {name} を実行中...")
+                result = await self.measure(name, getattr(self, f"{name}_once"))
+                results.append(result)
+        finally:
+            await self.gv.close_async_session()
+            await self.clients.registry.aclose_loop()
+        return results
+
+
+def format_results(results: list[ScenarioResult]) -> str:
+    lines = [
+        SEP,
+        f"{'シナリオ':<10}{'回数':>6}{'失敗':>6}{'件/秒':>9}{'p50':>9}{'p95':>9}"
+        f"{'最大':>9}{'初回音声p50':>13}{'初回音声p95':>13}",
+    ]
+
+    def seconds(value: Optional[float]) -> str:
+        return "-" if value is None else f"{value:.3f}"
+
+    for r in results:
+        lines.append(
+            f"{r.name:<10}{r.iterations:>6}{r.errors:>6}{r.throughput:>9.2f}"
+            f"{r.p50:>9.3f}{r.p95:>9.3f}{r.max:>9.3f}"
+            f"{seconds(r.first_audio_p50):>13}{seconds(r.first_audio_p95):>13}"
+        )
+    return "\n".join(lines)
+
+
+def compare_baseline(
+    results: list[ScenarioResult], baseline_path: str, threshold: float
+) -> list[str]:
+    """基準の結果よりp95がthresholdの割合以上遅くなったシナリオを返す"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {
+            r["name"]: ScenarioResult.model_validate(r) for r in json.load(f)["results"]
+        }
+    regressions = []
+    for r in results:
+        base = baseline.get(r.name)
+        if base is None or base.p95 == 0:
+            continue
+        ratio = r.p95 / base.p95 - 1
+        if ratio > threshold:
+            regressions.append(
+                f"{r.name}: p95 {base.p95:.3f}秒 -> {r.p95:.3f}秒 (+{ratio:.0%})"
+            )
+    return regressions
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="外部サービスを偽物に置き換えて、主要なコマンドの処理時間を測ります。"
+    )
+    parser.add_argument(
+        "--scenarios",
+        default=",".join(SCENARIOS),
+        help=f"実行するシナリオ (カンマ区切り: {', '.join(SCENARIOS)})",
+    )
+    parser.add_argument("--iterations", type=int, default=5, help="シナリオごとの回数")
+    parser.add_argument("--concurrency", type=int, default=1, help="並行して実行する数")
+    parser.add_argument("--paragraphs", type=int, default=4, help="/saveの段落数")
+    parser.add_argument(
+        "--realtime",
+        action="store_true",
+        help="音声を実際の再生と同じ速さで読む (既定では待たずに読む)",
+    )
+    parser.add_argument("--voicevox_latency", type=float, default=0.1)
+    parser.add_argument("--voicevox_latency_per_char", type=float, default=0.002)
+    parser.add_argument("--gemini_latency", type=float, default=0.3)
+    parser.add_argument("--gemini_image_latency", type=float, default=2.0)
+    parser.add_argument("--openai_latency", type=float, default=2.0)
+    parser.add_argument(
+        "--ffmpeg",
+        default=os.getenv("FFMPEG_PATH") or shutil.which("ffmpeg"),
+        help="Opusへの変換に使うffmpeg (/loadの再生に必要)",
+    )
+    parser.add_argument(
+        "--keep_rate_limits",
+        action="store_true",
+        help="RPM・TPMの制限を外さずに測る",
+    )
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    parser.add_argument("--baseline", help="比較する基準の結果 (--jsonで保存したもの)")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="基準よりp95がこの割合以上遅くなったら失敗にする",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        sys.exit(f"不明なシナリオ: {', '.join(sorted(unknown))}")
+    baseline_path = args.baseline and os.path.abspath(args.baseline)
+    json_path = args.json and os.path.abspath(args.json)
+
+    server = FakeVoicevoxServer(
+        synthesis_latency=args.voicevox_latency,
+        synthesis_latency_per_char=args.voicevox_latency_per_char,
+    ).start()
+
+    # book, cache, img などは作業ディレクトリに作られるので、一時ディレクトリで実行する
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    os.chdir(workdir)
+    os.environ["VOICEVOX_URL"] = server.url
+    os.environ["VOICEVOX_EXE_PATH"] = ""
+    os.environ["TRACE_ENABLED"] = "0"
+    if args.ffmpeg:
+        os.environ["FFMPEG_PATH"] = args.ffmpeg
+    elif "load" in scenarios:
+        print(
+            "ffmpegが見つからないため、音声はwavで保存されます (/loadにはlibopusが必要)"
+        )
+    if not args.keep_rate_limits:
+        os.environ["RATE_LIMITS"] = json.dumps(BENCH_RATE_LIMITS)
+    sys.path.insert(0, os.path.abspath(SRC_DIR))
+
+    try:
+        bench = Bench(args)
+        results = asyncio.run(bench.run(scenarios))
+    finally:
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(format_results(results))
+    print(
+        f"VOICEVOX: {server.requests['synthesis']}回, "
+        f"Gemini: {bench.gemini.calls}回, "
+        f"OpenAI: {bench.openai.calls}回"
+    )
+
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "args": vars(args),
+                    "results": [r.model_dump() for r in results],
+                },
+                f,
+                ensure_ascii=False,
+                indent=2,
+            )
+        print(f"結果を '{json_path}' に保存しました。")
+
+    failed = any(r.errors for r in results)
+    if baseline_path:
+        regressions = compare_baseline(results, baseline_path, args.threshold)
+        for line in regressions:
+            print(f"遅くなっています: {line}")
+        failed = failed or bool(regressions)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
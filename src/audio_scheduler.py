@@ -0,0 +1,153 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable
+
+import discord
+from discord import VoiceClient
+
+
+class AudioItem:
+    """再生キューの1件"""
+
+    def __init__(
+        self,
+        label: str,
+        make_source: Callable[[], discord.AudioSource],
+        connect: Callable[[], Awaitable[VoiceClient]],
+    ):
+        self.label = label
+        self.make_source = make_source
+        self.connect = connect
+        # 再生が終わったら(スキップ・クリア含む)完了する
+        self.done: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    def finish(self):
+        if not self.done.done():
+            self.done.set_result(None)
+
+
+class GuildAudioScheduler:
+    """
+    ギルドごとの再生キュー
+
+    音声を出すコマンドは直接playせずenqueue()で積む。
+    再生の終了はVoiceClient.play(after=...)のコールバックで検知し、
+    すぐに次の音声を再生するので、ポーリングによる待ち時間が無い。
+
+    複数の音声を順に積むコマンド(/load, /talk)はsession()の中で積む。
+    sessionは1つずつ実行されるので他のコマンドの音声が間に入らず、
+    clear()でsession中のコマンドごと取り消せる。
+    """
+
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        self._items: deque[AudioItem] = deque()
+        self._current: AudioItem | None = None
+        self._voice_client: VoiceClient | None = None
+        self._wakeup = asyncio.Event()
+        self._worker: asyncio.Task | None = None
+        self._session_lock = asyncio.Lock()
+        self._producers: set[asyncio.Task] = set()
+
+    @asynccontextmanager
+    async def session(self):
+        """
+        1つのコマンドの音声をまとめて再生する区間
+        他のコマンドのsessionが終わるまで待ってから始まる
+        clear()されると、このsessionを実行しているタスクはキャンセルされる
+        """
+        task = asyncio.current_task()
+        self._producers.add(task)
+        try:
+            async with self._session_lock:
+                yield
+        finally:
+            self._producers.discard(task)
+
+    def enqueue(
+        self,
+        label: str,
+        make_source: Callable[[], discord.AudioSource],
+        connect: Callable[[], Awaitable[VoiceClient]],
+    ) -> asyncio.Future:
+        """
+        音声を再生キューに積む
+        make_sourceは再生直前に呼ばれるので、待機中にffmpegを起動しない
+        戻り値はその音声の再生が終わったら完了するFuture
+        """
+        item = AudioItem(label, make_source, connect)
+        self._items.append(item)
+        self._wakeup.set()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        return item.done
+
+    def skip(self) -> bool:
+        """再生中の音声を止めて次へ進む"""
+        if self._current is None or self._voice_client is None:
+            return False
+        self._voice_client.stop()
+        return True
+
+    def clear(self) -> int:
+        """
+        再生待ちの音声を全て取り消し、再生中の音声も止める
+        音声を積んでいる途中のコマンド(session)もキャンセルし、続きを積ませない
+        """
+        current = asyncio.current_task()
+        for task in list(self._producers):
+            if task is not current:
+                task.cancel()
+        count = len(self._items)
+        while self._items:
+            self._items.popleft().finish()
+        self.skip()
+        return count
+
+    def status(self) -> dict:
+        return {
+            "playing": self._current.label if self._current else None,
+            "queued": [item.label for item in self._items],
+        }
+
+    async def _run(self):
+        while True:
+            if not self._items:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            item = self._items.popleft()
+            self._current = item
+            try:
+                await self._play(item)
+            except Exception as e:
+                # 1件の失敗でキュー全体を止めない
+                print(f"再生エラー: {e}")
+            finally:
+                self._current = None
+                item.finish()
+
+    async def _play(self, item: AudioItem):
+        loop = asyncio.get_running_loop()
+        finished = asyncio.Event()
+
+        def after(error):
+            if error:
+                print(f"再生エラー: {error}")
+            loop.call_soon_threadsafe(finished.set)
+
+        self._voice_client = await item.connect()
+        self._voice_client.play(item.make_source(), after=after)
+        await finished.wait()
+
+
+schedulers: dict[int, GuildAudioScheduler] = {}
+
+
+def get_scheduler(guild_id: int) -> GuildAudioScheduler:
+    """ギルドの再生キューを取得する (無ければ作成)"""
+    if guild_id not in schedulers:
+        schedulers[guild_id] = GuildAudioScheduler(guild_id)
+    return schedulers[guild_id]
@@ -0,0 +1,145 @@
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+import discord
+from discord.oggparse import OggStream
+from discord.opus import OPUS_SILENCE, Encoder
+
+from pcm_audio import FRAME_SIZE, wav_to_pcm
+
+# 段落の間に入れる無音(ミリ秒)。Opusは1パケット20ms
+PARAGRAPH_PAUSE_MS = int(os.getenv("LOAD_PARAGRAPH_PAUSE_MS", "0"))
+
+
+def book_audio_files(paragraph_path: str) -> list[str]:
+    """
+    段落フォルダの音声ファイルを再生順(0, 1, 2, ...)に返す
+    同じ番号のOpusとwavがある場合はOpusを使う
+    """
+    files: dict[int, str] = {}
+    for f in os.listdir(paragraph_path):
+        stem, ext = os.path.splitext(f)
+        if not stem.isdigit() or ext not in (".opus", ".wav"):
+            continue
+        if ext == ".wav" and int(stem) in files:
+            continue
+        files[int(stem)] = os.path.join(paragraph_path, f)
+    return [files[i] for i in sorted(files)]
+
+
+def read_opus_packets(filepath: str) -> list[bytes]:
+    """
+    Ogg/Opusファイルから音声パケットを取り出す (ヘッダのパケットは除く)
+    """
+    with open(filepath, "rb") as f:
+        return [
+            packet
+            for packet in OggStream(f).iter_packets()
+            if not packet.startswith((b"OpusHead", b"OpusTags"))
+        ]
+
+
+def encode_wav_packets(filepath: str) -> list[bytes]:
+    """
+    wavファイルをOpusパケットにエンコードする (Opus化する前に保存したブック用)
+    """
+    with open(filepath, "rb") as f:
+        pcm = wav_to_pcm(f.read())
+    encoder = Encoder()
+    return [
+        encoder.encode(pcm[i : i + FRAME_SIZE], Encoder.SAMPLES_PER_FRAME)
+        for i in range(0, len(pcm), FRAME_SIZE)
+    ]
+
+
+def load_paragraph_packets(filepaths: list[str], pause_ms: int) -> list[bytes]:
+    """
+    段落の音声ファイルを順番に読み込み、1本分のOpusパケット列にする
+    末尾にはpause_ms分の無音を入れる
+    """
+    packets = []
+    for filepath in filepaths:
+        if filepath.endswith(".opus"):
+            packets += read_opus_packets(filepath)
+        else:
+            packets += encode_wav_packets(filepath)
+    packets += [OPUS_SILENCE] * (pause_ms // 20)
+    return packets
+
+
+class PacketLoader:
+    """
+    段落ごとのOpusパケットをバックグラウンドで読み込む
+
+    再生中の段落の次の段落を先読みしておくことで、
+    段落の切り替わりで読み込み待ちが発生しないようにする。
+    """
+
+    def __init__(self, paragraph_files: list[list[str]], pause_ms: int):
+        self.paragraph_files = paragraph_files
+        self.pause_ms = pause_ms
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures: dict[int, Future] = {}
+
+    def __len__(self) -> int:
+        return len(self.paragraph_files)
+
+    def prefetch(self, index: int):
+        if index >= len(self) or index in self._futures:
+            return
+        self._futures[index] = self._executor.submit(
+            load_paragraph_packets, self.paragraph_files[index], self.pause_ms
+        )
+
+    def get(self, index: int) -> list[bytes]:
+        self.prefetch(index)
+        # 再生済みの段落のパケットは保持しない
+        return self._futures.pop(index).result()
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class BookStream(discord.AudioSource):
+    """
+    複数の段落の音声を1本の音声ソースとして送る
+
+    音声ファイルごとにffmpegを起動しないので、断片の間に隙間ができない。
+    段落の再生を始めたらon_startを呼び、次の段落を先読みする。
+    on_startは音声送信スレッドから呼ばれる点に注意。
+    """
+
+    def __init__(
+        self,
+        loader: PacketLoader,
+        indices: list[int],
+        on_start: Callable[[int], None] | None = None,
+    ):
+        self.loader = loader
+        self.indices = indices
+        self.on_start = on_start
+        self._position = -1
+        self._packets: list[bytes] = []
+        self._packet_index = 0
+        if indices:
+            loader.prefetch(indices[0])
+
+    def read(self) -> bytes:
+        while self._packet_index >= len(self._packets):
+            self._position += 1
+            if self._position >= len(self.indices):
+                return b""
+            index = self.indices[self._position]
+            self._packets = self.loader.get(index)
+            self._packet_index = 0
+            self.loader.prefetch(index + 1)
+            if self.on_start:
+                self.on_start(index)
+
+        packet = self._packets[self._packet_index]
+        self._packet_index += 1
+        return packet
+
+    def is_opus(self) -> bool:
+        return True
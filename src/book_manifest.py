@@ -0,0 +1,251 @@
+import hashlib
+import os
+import threading
+import time
+import wave
+from typing import List, Optional
+
+from pydantic import BaseModel, Field, ValidationError
+
+from book_audio import book_audio_files, read_opus_packets
+
+BOOK_DIR = "book"
+MANIFEST_FILE = "manifest.json"
+CATALOG_PATH = os.path.join(BOOK_DIR, "catalog.json")
+MANIFEST_VERSION = 1
+
+
+class AudioEntry(BaseModel):
+    path: str  # ブックフォルダからの相対パス
+    duration: float  # 秒
+    sha256: str
+
+
+class ParagraphEntry(BaseModel):
+    index: int
+    text: Optional[str] = None
+    text_sha256: Optional[str] = None
+    image: Optional[str] = None
+    image_sha256: Optional[str] = None
+    audio: List[AudioEntry] = Field(default_factory=list)
+
+
+class BookManifest(BaseModel):
+    """ブックの内容一覧 (book/<title>/manifest.json)"""
+
+    version: int = MANIFEST_VERSION
+    title: str
+    updated_at: float
+    duration: float
+    paragraphs: List[ParagraphEntry]
+
+
+class CatalogEntry(BaseModel):
+    title: str
+    paragraphs: int
+    duration: float
+    updated_at: float
+
+
+class Catalog(BaseModel):
+    """全ブックの一覧 (book/catalog.json)"""
+
+    version: int = MANIFEST_VERSION
+    books: dict[str, CatalogEntry] = Field(default_factory=dict)
+
+
+_catalog_lock = threading.Lock()
+
+
+def file_sha256(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def audio_duration(path: str) -> float:
+    """
+    音声ファイルの再生時間(秒)
+    Opusは1パケット20msで保存しているのでパケット数から求める
+    """
+    if path.endswith(".opus"):
+        return len(read_opus_packets(path)) * 0.02
+    with wave.open(path) as w:
+        return w.getnframes() / w.getframerate()
+
+
+def _write_json(path: str, model: BaseModel):
+    # 書き込み途中のファイルを読まれないよう、一時ファイルから置き換える
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(model.model_dump_json(indent=2))
+    os.replace(tmp_path, path)
+
+
+def is_valid_title(title: str) -> bool:
+    """
+    ブックのタイトルとして使えるか
+    bookフォルダ直下のフォルダを指すものだけを許可する ("..", "a/b" などは不可)
+    """
+    if not title or title in (".", ".."):
+        return False
+    if any(sep in title for sep in ("/", "\\", os.sep, os.altsep) if sep):
+        return False
+    path = os.path.normpath(os.path.join(BOOK_DIR, title))
+    return os.path.dirname(path) == os.path.normpath(BOOK_DIR)
+
+
+def book_path(title: str) -> str:
+    if not is_valid_title(title):
+        raise ValueError(f"ブックのタイトルとして使えません: {title!r}")
+    return os.path.join(BOOK_DIR, title)
+
+
+def build_manifest(title: str) -> BookManifest:
+    """
+    ブックフォルダを走査してmanifestを作成する
+    """
+    dir_path = book_path(title)
+    indices = sorted(
+        int(d)
+        for d in os.listdir(dir_path)
+        if d.isdigit() and os.path.isdir(os.path.join(dir_path, d))
+    )
+
+    paragraphs = []
+    for index in indices:
+        paragraph_path = os.path.join(dir_path, str(index))
+        entry = ParagraphEntry(index=index)
+
+        text_path = os.path.join(paragraph_path, "target.txt")
+        if os.path.exists(text_path):
+            entry.text = os.path.relpath(text_path, dir_path)
+            entry.text_sha256 = file_sha256(text_path)
+
+        image_path = os.path.join(paragraph_path, "target.png")
+        if os.path.exists(image_path):
+            entry.image = os.path.relpath(image_path, dir_path)
+            entry.image_sha256 = file_sha256(image_path)
+
+        for audio_path in book_audio_files(paragraph_path):
+            entry.audio.append(
+                AudioEntry(
+                    path=os.path.relpath(audio_path, dir_path),
+                    duration=audio_duration(audio_path),
+                    sha256=file_sha256(audio_path),
+                )
+            )
+        paragraphs.append(entry)
+
+    return BookManifest(
+        title=title,
+        updated_at=time.time(),
+        duration=sum(a.duration for p in paragraphs for a in p.audio),
+        paragraphs=paragraphs,
+    )
+
+
+def save_manifest(title: str) -> BookManifest:
+    """
+    manifest.jsonを作成し、カタログにも反映する (ブック保存時に呼ぶ)
+    """
+    manifest = _write_manifest(title)
+    update_catalog(manifest)
+    return manifest
+
+
+def _write_manifest(title: str) -> BookManifest:
+    manifest = build_manifest(title)
+    _write_json(os.path.join(book_path(title), MANIFEST_FILE), manifest)
+    return manifest
+
+
+def _read_manifest(title: str) -> Optional[BookManifest]:
+    try:
+        with open(
+            os.path.join(book_path(title), MANIFEST_FILE), "r", encoding="utf-8"
+        ) as f:
+            return BookManifest.model_validate_json(f.read())
+    except (FileNotFoundError, ValidationError):
+        return None
+
+
+def load_manifest(title: str) -> Optional[BookManifest]:
+    """
+    ブックのmanifestを読み込む
+    manifestが無い(以前の形式で保存された)ブックはその場で作成する
+    ブックが存在しない場合、タイトルが不正な場合はNone
+    """
+    if not is_valid_title(title) or not os.path.isdir(book_path(title)):
+        return None
+    return _read_manifest(title) or save_manifest(title)
+
+
+def catalog_entry(manifest: BookManifest) -> CatalogEntry:
+    return CatalogEntry(
+        title=manifest.title,
+        paragraphs=len(manifest.paragraphs),
+        duration=manifest.duration,
+        updated_at=manifest.updated_at,
+    )
+
+
+def update_catalog(manifest: BookManifest):
+    """
+    カタログのブック1件を更新する
+    カタログが無い場合は、先にbookフォルダを走査して他のブックも載せる
+    """
+    with _catalog_lock:
+        catalog = _read_catalog() or _scan_books()
+        catalog.books[manifest.title] = catalog_entry(manifest)
+        _write_json(CATALOG_PATH, catalog)
+
+
+def load_catalog() -> Catalog:
+    """
+    カタログを読み込む
+    カタログが無い場合は一度だけbookフォルダを走査して作成する
+    """
+    with _catalog_lock:
+        catalog = _read_catalog()
+        if catalog is not None:
+            return catalog
+
+    catalog = rebuild_catalog()
+    return catalog
+
+
+def rebuild_catalog() -> Catalog:
+    catalog = _scan_books()
+    os.makedirs(BOOK_DIR, exist_ok=True)
+    with _catalog_lock:
+        _write_json(CATALOG_PATH, catalog)
+    return catalog
+
+
+def _scan_books() -> Catalog:
+    """
+    bookフォルダの全てのブックからカタログを作る
+    manifestが無いブックはmanifestを作成する (カタログには書き込まない)
+    """
+    catalog = Catalog()
+    if os.path.isdir(BOOK_DIR):
+        for title in os.listdir(BOOK_DIR):
+            if not os.path.isdir(book_path(title)):
+                continue
+            manifest = _read_manifest(title) or _write_manifest(title)
+            catalog.books[title] = catalog_entry(manifest)
+    return catalog
+
+
+def _read_catalog() -> Optional[Catalog]:
+    try:
+        with open(CATALOG_PATH, "r", encoding="utf-8") as f:
+            catalog = Catalog.model_validate_json(f.read())
+    except (FileNotFoundError, ValidationError):
+        return None
+    # 以前に登録された不正なタイトルは一覧に出さない
+    catalog.books = {t: e for t, e in catalog.books.items() if is_valid_title(t)}
+    return catalog
@@ -0,0 +1,251 @@
+import json
+import os
+import threading
+import unicodedata
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+import book_manifest
+from book_manifest import BookManifest
+
+SEARCH_INDEX_PATH = os.path.join(book_manifest.BOOK_DIR, "search_index.json")
+SEARCH_INDEX_VERSION = 1
+# 検索結果に表示する前後の文字数
+SNIPPET_CHARS = 20
+
+
+class SearchHit(BaseModel):
+    title: str
+    paragraphs: List[int]  # 一致した段落の番号
+    snippet: str
+
+
+def normalize_text(text: str) -> str:
+    """
+    全角・半角や大文字・小文字の違いを無くし、空白を除く
+    """
+    return "".join(unicodedata.normalize("NFKC", text).lower().split())
+
+
+def bigrams(text: str) -> set[str]:
+    """
+    文字バイグラムの集合 (分かち書きしない日本語でも検索できるようにする)
+    1文字の場合はその文字だけ返す
+    """
+    if len(text) < 2:
+        return {text} if text else set()
+    return {text[i : i + 2] for i in range(len(text) - 1)}
+
+
+class SearchIndex:
+    """
+    ブック本文(target.txt)の転置インデックス
+
+    バイグラム -> {タイトル: [段落番号]} をJSONで保存する。
+    ブック保存時にそのブックの分だけ差し替えるので、全体を作り直す必要は無い。
+    ファイルが無い・壊れている場合は、カタログの全ブックから作り直す。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._postings: dict[str, dict[str, list[int]]] | None = None
+        # タイトル -> {"hashes": 段落本文のsha256, "grams": 登録したバイグラム}
+        self._books: dict[str, dict] = {}
+        self._mtime: float | None = None
+
+    def index_book(self, manifest: BookManifest):
+        """
+        ブックの本文を登録する。本文が変わっていなければ何もしない
+        """
+        hashes = [p.text_sha256 for p in manifest.paragraphs]
+        with self._lock:
+            self._load()
+            if self._books.get(manifest.title, {}).get("hashes") == hashes:
+                return
+            self._remove(manifest.title)
+            self._add(manifest)
+            self._save()
+
+    def remove_book(self, title: str):
+        with self._lock:
+            self._load()
+            self._remove(title)
+            self._save()
+
+    def search(self, query: str) -> dict[str, list[int]]:
+        """
+        クエリの全バイグラムを含む段落を返す (タイトル -> 段落番号)
+        バイグラムの一致だけで判定するので、順序までは確認しない
+        """
+        query = normalize_text(query)
+        with self._lock:
+            self._load()
+            postings = self._postings
+            if len(query) == 1:
+                # 1文字はその文字を含むバイグラムの和集合
+                grams = [g for g in postings if query in g]
+                result: dict[str, set[int]] = {}
+                for gram in grams:
+                    for title, indices in postings[gram].items():
+                        result.setdefault(title, set()).update(indices)
+                return {t: sorted(i) for t, i in result.items()}
+
+            grams = sorted(bigrams(query), key=lambda g: len(postings.get(g, {})))
+            if not grams:
+                return {}
+
+            # 該当が少ないバイグラムから絞り込む
+            result = {t: set(i) for t, i in postings.get(grams[0], {}).items()}
+            for gram in grams[1:]:
+                gram_postings = postings.get(gram, {})
+                for title in list(result):
+                    result[title] &= set(gram_postings.get(title, ()))
+                    if not result[title]:
+                        del result[title]
+                if not result:
+                    break
+            return {t: sorted(i) for t, i in result.items()}
+
+    def _add(self, manifest: BookManifest):
+        dir_path = book_manifest.book_path(manifest.title)
+        grams_in_book: set[str] = set()
+        for paragraph in manifest.paragraphs:
+            if not paragraph.text:
+                continue
+            with open(
+                os.path.join(dir_path, paragraph.text), "r", encoding="utf-8"
+            ) as f:
+                grams = bigrams(normalize_text(f.read()))
+            for gram in grams:
+                self._postings.setdefault(gram, {}).setdefault(
+                    manifest.title, []
+                ).append(paragraph.index)
+            grams_in_book |= grams
+
+        self._books[manifest.title] = {
+            "hashes": [p.text_sha256 for p in manifest.paragraphs],
+            "grams": sorted(grams_in_book),
+        }
+
+    def _remove(self, title: str):
+        book = self._books.pop(title, None)
+        if book is None:
+            return
+        for gram in book["grams"]:
+            gram_postings = self._postings.get(gram)
+            if gram_postings is None:
+                continue
+            gram_postings.pop(title, None)
+            if not gram_postings:
+                del self._postings[gram]
+
+    def _load(self):
+        # 他のプロセス(generate_book.main)で更新された場合は読み直す
+        try:
+            mtime = os.path.getmtime(self.path)
+        except FileNotFoundError:
+            mtime = None
+        if self._postings is not None and mtime == self._mtime:
+            return
+
+        self._postings, self._books = {}, {}
+        data = None
+        if mtime is not None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except json.JSONDecodeError:
+                pass
+        if not isinstance(data, dict) or data.get("version") != SEARCH_INDEX_VERSION:
+            self._rebuild()
+            return
+        self._postings = data["postings"]
+        self._books = data["books"]
+        self._mtime = mtime
+
+    def _rebuild(self):
+        """カタログの全ブックを登録して保存する"""
+        print("検索インデックスを作成します")
+        for title in book_manifest.load_catalog().books:
+            manifest = book_manifest.load_manifest(title)
+            if manifest is not None:
+                self._add(manifest)
+        self._save()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "version": SEARCH_INDEX_VERSION,
+                    "books": self._books,
+                    "postings": self._postings,
+                },
+                f,
+                ensure_ascii=False,
+                separators=(",", ":"),
+            )
+        os.replace(tmp_path, self.path)
+        self._mtime = os.path.getmtime(self.path)
+
+
+search_index = SearchIndex(SEARCH_INDEX_PATH)
+
+
+def make_snippet(text: str, query: str) -> str:
+    """
+    一致した箇所の前後SNIPPET_CHARS文字 (正規化した本文から切り出す)
+    """
+    normalized = normalize_text(text)
+    normalized_query = normalize_text(query)
+    position = normalized.find(normalized_query)
+    if position < 0:
+        return normalized[: SNIPPET_CHARS * 2]
+    start = max(0, position - SNIPPET_CHARS)
+    end = position + len(normalized_query) + SNIPPET_CHARS
+    return (
+        ("…" if start > 0 else "")
+        + normalized[start:end]
+        + ("…" if end < len(normalized) else "")
+    )
+
+
+def search_books(query: str, limit: int = 10) -> List[SearchHit]:
+    """
+    本文にqueryを含むブックを、一致した段落の多い順に返す
+    候補の段落は本文を読んで、queryがそのまま含まれるか確認してから順位を付ける
+    """
+    candidates = search_index.search(query)
+    normalized_query = normalize_text(query)
+
+    hits = []
+    for title, indices in candidates.items():
+        manifest: Optional[BookManifest] = book_manifest.load_manifest(title)
+        if manifest is None:
+            continue
+        dir_path = book_manifest.book_path(title)
+        paragraphs = {p.index: p for p in manifest.paragraphs}
+
+        matched = []
+        snippet = ""
+        for index in indices:
+            paragraph = paragraphs.get(index)
+            if paragraph is None or not paragraph.text:
+                continue
+            with open(
+                os.path.join(dir_path, paragraph.text), "r", encoding="utf-8"
+            ) as f:
+                text = f.read()
+            if normalized_query not in normalize_text(text):
+                continue
+            matched.append(index)
+            snippet = snippet or make_snippet(text, query)
+
+        if matched:
+            hits.append(SearchHit(title=title, paragraphs=matched, snippet=snippet))
+
+    hits.sort(key=lambda hit: (-len(hit.paragraphs), hit.title))
+    return hits[:limit]
@@ -0,0 +1,144 @@
+import asyncio
+import atexit
+import inspect
+import os
+import threading
+from typing import Any, Callable
+
+import boto3
+from dotenv import load_dotenv
+from google import genai
+from openai import AsyncOpenAI
+
+load_dotenv()
+
+
+class ClientRegistry:
+    """
+    APIクライアントをプロセス全体で共有する
+
+    クライアントは初回のget()で作成し、以降は同じものを返す。
+    認証情報の解決や接続プールの作成を呼び出しごとに繰り返さないため。
+    テストではoverride()で偽のクライアントに差し替えられる。
+
+    非同期クライアントは接続がイベントループに紐づくので、
+    per_loop=Trueで登録し、イベントループごとに作成する。
+    """
+
+    def __init__(self):
+        self._factories: dict[str, Callable[[], Any]] = {}
+        self._per_loop: set[str] = set()
+        self._clients: dict[Any, Any] = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, factory: Callable[[], Any], per_loop: bool = False):
+        self._factories[name] = factory
+        if per_loop:
+            self._per_loop.add(name)
+
+    def _key(self, name: str) -> Any:
+        if name in self._per_loop:
+            return (name, asyncio.get_running_loop())
+        return name
+
+    def get(self, name: str) -> Any:
+        key = self._key(name)
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+        with self._lock:
+            # 他のスレッドが先に作成していればそれを使う
+            if key not in self._clients:
+                self._clients[key] = self._factories[name]()
+            return self._clients[key]
+
+    def override(self, name: str, client: Any):
+        """作成済みのクライアントを差し替える (テスト用)"""
+        with self._lock:
+            self._clients[self._key(name)] = client
+
+    async def aclose_loop(self):
+        """実行中のイベントループで作成した非同期クライアントを閉じる"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            keys = [k for k in self._clients if isinstance(k, tuple) and k[1] is loop]
+            clients = [(k[0], self._clients.pop(k)) for k in keys]
+        for name, client in clients:
+            close = getattr(client, "aclose", None) or getattr(client, "close", None)
+            if close is None:
+                continue
+            try:
+                result = close()
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                print(f"クライアントの終了に失敗しました: {name} {e}")
+
+    def close_all(self):
+        """作成済みのクライアントを全て閉じる"""
+        with self._lock:
+            # 非同期クライアントはaclose_loop()で閉じる
+            clients = {k: v for k, v in self._clients.items() if isinstance(k, str)}
+            self._clients = {}
+        for name, client in clients.items():
+            close = getattr(client, "close", None)
+            if close is None:
+                continue
+            try:
+                close()
+            except Exception as e:
+                print(f"クライアントの終了に失敗しました: {name} {e}")
+
+
+registry = ClientRegistry()
+registry.register(
+    "genai_aio",
+    lambda: genai.Client(api_key=os.getenv("GEMINI_API_KEY")).aio,
+    per_loop=True,
+)
+registry.register(
+    "openai_async",
+    lambda: AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), timeout=60),
+    per_loop=True,
+)
+registry.register(
+    "translate",
+    lambda: boto3.client(
+        service_name="translate",
+        region_name=os.getenv("AWS_REGION"),
+        aws_access_key_id=os.getenv("AWS_ACCESS_KEY"),
+        aws_secret_access_key=os.getenv("AWS_SECRET"),
+        use_ssl=True,
+    ),
+)
+atexit.register(registry.close_all)
+
+
+def genai_aio_client():
+    """genaiの非同期クライアント (client.aio)。イベントループ内で呼ぶ"""
+    return registry.get("genai_aio")
+
+
+def openai_async_client() -> AsyncOpenAI:
+    """イベントループ内で呼ぶ"""
+    return registry.get("openai_async")
+
+
+def translate_client():
+    return registry.get("translate")
+
+
+def run_sync(coro):
+    """
+    コルーチンを新しいイベントループで実行する (同期版の関数用)
+
+    そのイベントループで作成した非同期クライアントは終了時に閉じる。
+    """
+
+    async def run():
+        try:
+            return await coro
+        finally:
+            await registry.aclose_loop()
+
+    return asyncio.run(run())
@@ -0,0 +1,175 @@
+import bisect
+import re
+import threading
+import time
+from typing import Awaitable, Callable
+
+# コマンド名 (先頭の/と英字)。"/talkこんにちは" のように引数が続けて書かれても切り出せる
+COMMAND_PATTERN = re.compile(r"/[A-Za-z_]+")
+# 処理時間ヒストグラムの区切り(秒)。最後の区間はそれ以上全て
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+Handler = Callable[..., Awaitable[None]]
+
+
+class LatencyHistogram:
+    """
+    処理時間のヒストグラム
+
+    全ての値を保持せず区間ごとの件数だけ数えるので、
+    長時間動かしてもメモリを使わない。パーセンタイルは区間の上限で近似する。
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q: float) -> float:
+        count = sum(self.counts)
+        if count == 0:
+            return 0.0
+        rank = q * count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n > 0:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+
+class Command:
+    """
+    コマンドの定義
+
+    exact=Trueのコマンドは引数を取らず、名前と完全に一致した場合だけ実行する。
+    match=Falseのコマンドはメッセージからは選ばれず、invoke()で呼び出す (メンションなど)。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        handler: Handler,
+        description: str,
+        usage: str = "",
+        exact: bool = False,
+        match: bool = True,
+    ):
+        self.name = name
+        self.handler = handler
+        self.description = description
+        self.usage = usage
+        self.exact = exact
+        self.match = match
+        self.count = 0
+        self.errors = 0
+        self.latency = LatencyHistogram()
+
+    def help_line(self) -> str:
+        usage = f"{self.name} {self.usage}" if self.usage else self.name
+        return f"`{usage}`: {self.description}"
+
+    def stats(self) -> dict:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "p50": self.latency.percentile(0.5),
+            "p95": self.latency.percentile(0.95),
+            "max": self.latency.max,
+            "histogram": dict(
+                zip([*map(str, self.latency.buckets), "inf"], self.latency.counts)
+            ),
+        }
+
+
+class CommandRouter:
+    """
+    コマンド名からハンドラを引く
+
+    コマンドは@router.command(...)で登録する。他のモジュールからも同じrouterに登録できる。
+    実行ごとに件数・エラー数・処理時間を記録する。
+    """
+
+    def __init__(self):
+        self.commands: dict[str, Command] = {}
+        self._lock = threading.Lock()
+
+    def register(self, command: Command):
+        if command.name in self.commands:
+            raise ValueError(f"コマンドが重複しています: {command.name}")
+        self.commands[command.name] = command
+
+    def command(
+        self,
+        name: str,
+        description: str,
+        usage: str = "",
+        exact: bool = False,
+        match: bool = True,
+    ) -> Callable[[Handler], Handler]:
+        """ハンドラをコマンドとして登録するデコレータ"""
+
+        def decorator(handler: Handler) -> Handler:
+            self.register(Command(name, handler, description, usage, exact, match))
+            return handler
+
+        return decorator
+
+    def find(self, content: str) -> Command | None:
+        found = COMMAND_PATTERN.match(content)
+        if found is None:
+            return None
+        command = self.commands.get(found.group())
+        if command is None or not command.match:
+            return None
+        if command.exact and content.strip() != command.name:
+            return None
+        return command
+
+    async def dispatch(self, message) -> bool:
+        """メッセージに対応するコマンドを実行する。該当するコマンドがなければFalse"""
+        command = self.find(message.content)
+        if command is None:
+            return False
+        await self._run(command, message)
+        return True
+
+    async def invoke(self, name: str, message):
+        """名前を指定してコマンドを実行する"""
+        await self._run(self.commands[name], message)
+
+    async def _run(self, command: Command, message):
+        start = time.perf_counter()
+        try:
+            await command.handler(message)
+        except Exception:
+            with self._lock:
+                command.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                command.count += 1
+                command.latency.record(elapsed)
+
+    def help_text(self) -> str:
+        lines = [command.help_line() for command in self.commands.values()]
+        return "**コマンド一覧:**\n\n" + "\n".join(lines)
+
+    def stats(self) -> dict[str, dict]:
+        """実行されたコマンドごとの件数・エラー数・処理時間 (監視用)"""
+        with self._lock:
+            return {
+                name: command.stats()
+                for name, command in self.commands.items()
+                if command.count > 0
+            }
+
+
+router = CommandRouter()
@@ -2,23 +2,44 @@ import asyncio
 import base64
 import os
 import re
+from collections import deque
+from functools import partial
 
 import discord
 from discord import VoiceClient, Message
 from dotenv import load_dotenv
-from google import genai
 from icecream import ic
-from tenacity import retry, stop_after_attempt, wait_fixed
 
+from audio_scheduler import get_scheduler
+import clients
+from clients import genai_aio_client
+from command_router import router
+from book_audio import PARAGRAPH_PAUSE_MS, BookStream, PacketLoader
+import book_manifest
+import book_search
+from image_upload import upload_image_path
+from message_sender import BookSender, OutgoingParagraph
+from pcm_audio import pcm_source
+from rate_limit import estimate_tokens, limit, limiter_status
+from resilience import breaker_status, with_retry
 import generate_book as book
 from generate_image import (
-    generate_image_from_text_google,
-    generate_image_from_text_openai,
+    generate_image_from_text_google_async,
+    generate_image_from_text_openai_async,
 )
-from generate_voice import synthesize_voice_with_timestamp
+import generate_voice as gv
 import utils
 
 SEP = "-" * 100
+# /talkで再生より先に合成しておく音声の数
+SPEECH_LOOKAHEAD = 2
+# /loadの再生単位 (paragraph: 段落ごと, book: ブック全体を1本で)
+LOAD_PLAYBACK = os.getenv("LOAD_PLAYBACK", "paragraph")
+# /listの1ページの件数と/searchの最大件数
+LIST_PAGE_SIZE = 20
+SEARCH_LIMIT = 10
+# /talkの音声をwavディレクトリにも保存するか (通常はメモリ上で再生するだけ)
+TALK_SAVE_WAV = os.getenv("TALK_SAVE_WAV", "0") == "1"
 
 # --- 会話履歴管理用グローバル変数 ---
 # チャンネルIDごとに直近3ターン分の履歴を保持
@@ -31,7 +52,18 @@ intents.message_content = True
 
 TOKEN = os.getenv("DISCORD_CHATBOT_TOKEN")
 
-client = discord.Client(intents=intents)
+
+class BotClient(discord.Client):
+    async def close(self):
+        """Discordから切断し、非同期クライアントとVOICEVOXのセッションも閉じる"""
+        try:
+            await super().close()
+        finally:
+            await clients.registry.aclose_loop()
+            await gv.close_async_session()
+
+
+client = BotClient(intents=intents)
 
 
 def get_prompt(message_content, command):
@@ -43,11 +75,12 @@ async def on_ready():
     print("ログインしました")
 
 
+@router.command("/neko", "猫の鳴き声を送信します。", exact=True)
 async def handle_neko(message):
     await message.channel.send("ポンにゃ")
 
 
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(1))
+@with_retry("discord_voice", max_attempts=3)
 async def get_voice_client(message: Message) -> VoiceClient:
     """
     ボイスクライアント取得
@@ -69,6 +102,7 @@ async def get_voice_client(message: Message) -> VoiceClient:
     return voice_client
 
 
+@router.command("/talk", "指定されたテキストを音声で再生します。", "[テキスト]")
 async def handle_speech(message: Message):
     text = get_prompt(message.content, "/talk")
 
@@ -84,35 +118,41 @@ async def handle_speech(message: Message):
         await message.channel.send("ボイスチャンネルに参加してからコマンドを使ってにゃ")
         return
 
-    # 各テキスト断片ごとに音声合成と再生を実行
-    for i, t in enumerate(texts):
-        await message.channel.send(f"[音声を生成中にゃ][{i+1}/{len(texts)}]")
-
-        # 1. 音声合成
-        filepath = await asyncio.to_thread(synthesize_voice_with_timestamp, t)
-        if filepath is None:
-            await message.channel.send(
-                f"テキスト「{t[:20]}...」の音声合成に失敗したにゃ"
+    # 合成した音声はギルドの再生キューに積み、次の断片の合成をすぐに始める
+    # 再生待ちがSPEECH_LOOKAHEAD件を超えないよう、古いものの再生終了を待つ
+    # /clearされるとsessionごとキャンセルされ、残りの断片は合成しない
+    scheduler = get_scheduler(message.guild.id)
+    pending: deque[asyncio.Future] = deque()
+
+    async with scheduler.session():
+        for i, t in enumerate(texts):
+            while len(pending) >= SPEECH_LOOKAHEAD:
+                await pending.popleft()
+
+            await message.channel.send(f"[音声を生成中にゃ][{i+1}/{len(texts)}]")
+
+            pcm = await gv.synthesize_pcm(t, persist=TALK_SAVE_WAV)
+            if pcm is None:
+                await message.channel.send(
+                    f"テキスト「{t[:20]}...」の音声合成に失敗したにゃ"
+                )
+                continue  # 次のテキストへ
+
+            await message.channel.send("[再生するにゃ]")
+            pending.append(
+                scheduler.enqueue(
+                    f"/talk {t[:20]}",
+                    partial(pcm_source, pcm),
+                    partial(get_voice_client, message),
+                )
             )
-            continue  # 次のテキストへ
 
-        # 2. ボイスチャンネル取得
-        voice_client = await get_voice_client(message)
-
-        # 3. 再生中の場合は待機
-        while voice_client.is_playing():
-            ic("前回音声処理が終わるまで待機")
-            await asyncio.sleep(1)
-
-        # 4. 音声再生
-        source = discord.FFmpegPCMAudio(filepath, executable="ffmpg/ffmpeg.exe")
-        await message.channel.send("[再生するにゃ]")
-        # 音声待機中に切れてしまうケースがあるため、再取得
-        voice_client = await get_voice_client(message)
-
-        voice_client.play(source)
+        await asyncio.gather(*pending)
 
 
+@router.command(
+    "/image", "指定されたプロンプトに基づいて画像を生成します。", "[プロンプト]"
+)
 async def handle_text_to_image(message):
     """
     テキストからの画像生成
@@ -129,9 +169,9 @@ async def handle_text_to_image(message):
     try:
         image_generator = os.getenv("IMAGE_GENERATOR", "google").lower()
         if image_generator == "google":
-            filename = await asyncio.to_thread(generate_image_from_text_google, prompt)
+            filename = await generate_image_from_text_google_async(prompt)
         elif image_generator == "openai":
-            filename = await asyncio.to_thread(generate_image_from_text_openai, prompt)
+            filename = await generate_image_from_text_openai_async(prompt)
         else:
             await message.channel.send(
                 f"無効な画像ジェネレーター: {image_generator}。'google' または 'openai' を指定してにゃ。"
@@ -139,39 +179,138 @@ async def handle_text_to_image(message):
             return
 
         if filename:
-            await message.channel.send(file=discord.File(filename))
+            # 送信用に圧縮した画像を送る
+            upload_path = await asyncio.to_thread(upload_image_path, filename)
+            await message.channel.send(file=discord.File(upload_path))
     except Exception as e:
         await message.channel.send(f"画像生成中にエラーが発生したにゃ: {str(e)}")
 
 
+async def extract_text_from_attachment(message):
+    """
+    添付ファイルあり
+    message.txtという名前の添付ファイルがある場合、
+    その内容を読み取り、/saveコマンドの引数として設定します。
+
+    添付がない場合は通常message応答
+    """
+    # 通常テキスト 添付なし
+    if len(message.attachments) == 0:
+        return message
+
+    # 添付ファイルパターン
+    attachment = message.attachments[0]
+    if attachment.filename == "message.txt":
+        data = await attachment.read()
+        text = data.decode("utf-8")
+        message.content = f"/save {text}"
+
+        return message
+
+
+@router.command(
+    "/save",
+    "テキストをブックとして保存します。"
+    "message.txtという名前の添付ファイルがある場合、その内容を保存します。",
+    "[テキスト]",
+)
 async def handle_save(message: Message):
-    await book.save(message.content, message)
+    message = await extract_text_from_attachment(message)
+    if message:
+        await book.save(message.content, message)
 
 
+@router.command("/list", "保存されているブックの一覧を表示します。", "[ページ]")
 async def handle_list(message: Message):
     """
-    /bookフォルダ内のフォルダ一覧を取得し、Base64デコードしてマークダウンリストとして出力する
+    カタログ(book/catalog.json)からブック一覧を取得し、マークダウンリストとして出力する
+    `/list 2` のようにページを指定できる
     """
-    book_dir = "./book"
-    if not os.path.isdir(book_dir):
-        await message.channel.send("`/book` ディレクトリが見つかりません。")
-        return
+    page_text = get_prompt(message.content, "/list")
+    page = int(page_text) if page_text.isdigit() else 1
 
-    entries = os.listdir(book_dir)
-    folders = sorted(
-        [entry for entry in entries if os.path.isdir(os.path.join(book_dir, entry))]
-    )
+    catalog = await asyncio.to_thread(book_manifest.load_catalog)
 
-    if not folders:
-        await message.channel.send("`/book` ディレクトリにフォルダがありません。")
+    if not catalog.books:
+        await message.channel.send("保存されているブックがありません。")
         return
 
-    folder_list = [f"- {folder_name}" for folder_name in folders]
+    entries = sorted(catalog.books.values(), key=lambda e: e.title)
+    page_count = (len(entries) + LIST_PAGE_SIZE - 1) // LIST_PAGE_SIZE
+    page = min(max(page, 1), page_count)
+    start = (page - 1) * LIST_PAGE_SIZE
+
+    book_list = [
+        f"- {entry.title} ({entry.paragraphs}段落, {entry.duration / 60:.1f}分)"
+        for entry in entries[start : start + LIST_PAGE_SIZE]
+    ]
 
-    response = "## ブック一覧\n" + "\n".join(folder_list)
+    response = f"## ブック一覧 ({page}/{page_count}ページ, 全{len(entries)}冊)\n"
+    response += "\n".join(book_list)
+    if page < page_count:
+        response += f"\n次のページ: `/list {page + 1}`"
     await message.channel.send(response)
 
 
+@router.command("/search", "本文にキーワードを含むブックを検索します。", "[キーワード]")
+async def handle_search(message: Message):
+    """
+    本文にキーワードを含むブックを検索する
+    """
+    query = get_prompt(message.content, "/search")
+    if not query:
+        await message.channel.send(
+            "検索するキーワードを指定してくださいにゃ。例: `/search 魔法`"
+        )
+        return
+
+    hits = await asyncio.to_thread(book_search.search_books, query, SEARCH_LIMIT)
+    if not hits:
+        await message.channel.send(f"「{query}」を含むブックは見つからなかったにゃ。")
+        return
+
+    lines = [
+        f"- {hit.title} (段落 {', '.join(str(i) for i in hit.paragraphs[:5])}"
+        f"{' ...' if len(hit.paragraphs) > 5 else ''}) {hit.snippet}"
+        for hit in hits
+    ]
+    response = f"## 「{query}」の検索結果\n" + "\n".join(lines)
+    # Discordの1メッセージの上限に収める
+    await message.channel.send(response[:2000])
+
+
+def read_outgoing_paragraphs(
+    dir_path: str, paragraphs: list[book_manifest.ParagraphEntry]
+) -> list[OutgoingParagraph]:
+    """
+    ブックの段落ごとに、送信するテキストと画像を読み込む
+    """
+    outgoing = []
+    for paragraph in paragraphs:
+        text = None
+        if paragraph.text:
+            with open(
+                os.path.join(dir_path, paragraph.text), "r", encoding="utf-8"
+            ) as f:
+                text = f.read()
+        images = []
+        image_sha256 = {}
+        if paragraph.image:
+            image_path = os.path.join(dir_path, paragraph.image)
+            images.append(image_path)
+            if paragraph.image_sha256:
+                image_sha256[image_path] = paragraph.image_sha256
+        outgoing.append(
+            OutgoingParagraph(text=text, images=images, image_sha256=image_sha256)
+        )
+    return outgoing
+
+
+@router.command(
+    "/load",
+    "指定されたタイトルのブックを読み込み、テキスト、画像、音声を送信します。",
+    "[タイトル]",
+)
 async def handle_load(message: Message):
     """
     /load コマンドを処理し、指定されたタイトルのブックを読み込み、
@@ -189,63 +328,131 @@ async def handle_load(message: Message):
         await message.channel.send("ボイスチャンネルに参加してからコマンドを使ってにゃ")
         return
 
-    dir_path = os.path.join("book", title)
-
-    if not os.path.exists(dir_path):
+    manifest = await asyncio.to_thread(book_manifest.load_manifest, title)
+    if manifest is None:
         await message.channel.send(f"ブック '{title}' は見つかりませんでしたにゃ。")
         return
 
-    # 対象フォルダ内の子フォルダ一覧を取得し、数値としてソート後、文字列に戻す
-    subdirectories = [
-        str(d)
-        for d in sorted(
-            [
-                int(d)
-                for d in os.listdir(dir_path)
-                if os.path.isdir(os.path.join(dir_path, d)) and d.isdigit()
-            ]
+    dir_path = book_manifest.book_path(title)
+    paragraphs = manifest.paragraphs
+    scheduler = get_scheduler(message.guild.id)
+    connect = partial(get_voice_client, message)
+    outgoing = await asyncio.to_thread(read_outgoing_paragraphs, dir_path, paragraphs)
+
+    # 他のコマンドの音声が段落の間に入らないよう、ブック全体を1つのsessionで流す
+    # /clearされるとsessionごとキャンセルされ、残りの段落は再生も送信もしない
+    async with scheduler.session():
+        loader = PacketLoader(
+            [[os.path.join(dir_path, a.path) for a in p.audio] for p in paragraphs],
+            PARAGRAPH_PAUSE_MS,
         )
-    ]
-    for subdir_name in subdirectories:
-        subdir_path = os.path.join(dir_path, subdir_name)
-
-        # テキスト処理
-        text_file_path = os.path.join(subdir_path, "target.txt")
-        if os.path.exists(text_file_path):
-            with open(text_file_path, "r", encoding="utf-8") as f:
-                content = f.read()
-                await message.channel.send(content)
-
-        # 画像処理
-        image_file_path = os.path.join(subdir_path, "target.png")
-        if os.path.exists(image_file_path):
-            await message.channel.send(file=discord.File(image_file_path))
-
-        # 音声処理
-        wav_files = [
-            os.path.join(subdir_path, f)
-            for f in os.listdir(subdir_path)
-            if f.endswith(".wav") and os.path.isfile(os.path.join(subdir_path, f))
-        ]
+        # テキストと画像は再生より少し先に、まとめて送る
+        sender = BookSender(message.channel, outgoing)
+        sender.start()
+
+        try:
+            if LOAD_PLAYBACK == "book":
+                # ブック全体を1本の音声として流し、段落の再生開始を送信側に伝える
+                loop = asyncio.get_running_loop()
+
+                def on_start(index: int):
+                    loop.call_soon_threadsafe(sender.advance, index)
+
+                await scheduler.enqueue(
+                    f"/load {title}",
+                    partial(BookStream, loader, list(range(len(loader))), on_start),
+                    connect,
+                )
+            else:
+                # 段落ごとに1本の音声として流す (次の段落は再生中に先読みされる)
+                for i, paragraph in enumerate(paragraphs):
+                    sender.advance(i)
+                    await scheduler.enqueue(
+                        f"/load {title} {paragraph.index}",
+                        partial(BookStream, loader, [i]),
+                        connect,
+                    )
+        except asyncio.CancelledError:
+            sender.cancel()
+            raise
+        finally:
+            loader.close()
+        await sender.finish()
 
-        voice_client = await get_voice_client(message)
-        for filepath in wav_files:
-            while voice_client.is_playing():
-                ic("前回音声処理が終わるまで待機")
-                await asyncio.sleep(1)
+    await message.channel.send("おしまいにゃ。")
 
-            source = discord.FFmpegPCMAudio(filepath, executable="ffmpg/ffmpeg.exe")
-            voice_client = await get_voice_client(message)
 
-            voice_client.play(source)
+@router.command("/skip", "再生中の音声を止めて次へ進みます。", exact=True)
+async def handle_skip(message: Message):
+    """再生中の音声を止めて次へ進む"""
+    if get_scheduler(message.guild.id).skip():
+        await message.channel.send("スキップしたにゃ")
+    else:
+        await message.channel.send("再生中の音声は無いにゃ")
 
-        while voice_client.is_playing():
-            ic("段落の音声処理が終わるまで待機")
-            await asyncio.sleep(1)
 
-    await message.channel.send("おしまいにゃ。")
+@router.command("/clear", "再生待ちの音声を全て取り消します。", exact=True)
+async def handle_clear(message: Message):
+    """再生待ちの音声を全て取り消す"""
+    count = get_scheduler(message.guild.id).clear()
+    await message.channel.send(f"再生待ちの音声を{count}件取り消したにゃ")
+
+
+@router.command("/queue", "再生キューの状態を表示します。", exact=True)
+async def handle_queue(message: Message):
+    """再生キューの状態を表示する"""
+    status = get_scheduler(message.guild.id).status()
+    lines = [f"再生中: {status['playing'] or 'なし'}"]
+    lines += [f"{i+1}. {label}" for i, label in enumerate(status["queued"])]
+    await message.channel.send("## 再生キュー\n" + "\n".join(lines))
+
+
+@router.command("/status", "外部サービスの状態を表示します。", exact=True)
+async def handle_status(message: Message):
+    """外部サービスの状態(サーキットブレーカーと呼び出し制限の待ち件数)を表示する"""
+    states = breaker_status()
+    limits = limiter_status()
+    if not states and not limits:
+        await message.channel.send("まだ外部サービスを呼び出していないにゃ")
+        return
+
+    lines = [
+        f"- {name}: {state['state']} (連続失敗 {state['consecutive_failures']}, "
+        f"失敗 {state['total_failures']}, 中止 {state['total_rejected']})"
+        for name, state in sorted(states.items())
+    ]
+    if limits:
+        lines.append("### 呼び出し制限")
+        lines += [
+            f"- {name}: 待ち {state['waiting']}, 実行中 {state['in_flight']}, "
+            f"累計 {state['total_requests']}"
+            for name, state in sorted(limits.items())
+        ]
+    await message.channel.send("## 外部サービスの状態\n" + "\n".join(lines))
 
 
+@with_retry("gemini")
+async def request_chat(prompt: str) -> str:
+    """
+    Gemini APIを使って、ずんだもんの返答を作る
+    """
+    client = genai_aio_client()
+    model = "gemini-2.5-flash-preview-04-17"
+
+    async with limit("gemini", model, estimate_tokens(prompt)):
+        response = await client.models.generate_content(
+            model=model,
+            contents=prompt,
+        )
+    return response.text
+
+
+@router.command(
+    "@ずんだもん",
+    "ずんだもんにメンションすると、会話できます。",
+    "[メッセージ]",
+    match=False,
+)
 async def handle_mention(message):
     global channel_histories
 
@@ -288,16 +495,7 @@ async def handle_mention(message):
     print(f"[会話プロンプト]\n{prompt}")
     print(SEP)
 
-    client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
-
-    # Gemini API呼び出し
-    response = await asyncio.to_thread(
-        client.models.generate_content,
-        model="gemini-2.5-flash-preview-04-17",
-        contents=prompt,
-    )
-
-    bot_reply = response.text
+    bot_reply = await request_chat(prompt)
     ic(bot_reply)
 
     # 履歴に今回のやりとりを追加
@@ -312,86 +510,40 @@ async def handle_mention(message):
     await handle_speech(message)
 
 
+@router.command("/stats", "コマンドごとの実行回数と処理時間を表示します。", exact=True)
+async def handle_stats(message: Message):
+    """コマンドごとの実行回数・エラー数・処理時間(p50, p95, 最大)を表示する"""
+    stats = router.stats()
+    if not stats:
+        await message.channel.send("まだコマンドが実行されていないにゃ")
+        return
+
+    lines = [
+        f"- {name}: {s['count']}回 (エラー {s['errors']}) "
+        f"p50 {s['p50']:.2f}秒, p95 {s['p95']:.2f}秒, 最大 {s['max']:.2f}秒"
+        for name, s in sorted(stats.items())
+    ]
+    await message.channel.send("## コマンドの実行状況\n" + "\n".join(lines))
+
+
+@router.command("/help", "コマンド一覧を表示します。", exact=True)
 async def handle_help(message):
-    help_message = """
-    **コマンド一覧:**
-
-    `/neko`: 猫の鳴き声を送信します。
-    `/image [プロンプト]`: 指定されたプロンプトに基づいて画像を生成します。
-    `/talk [テキスト]`: 指定されたテキストを音声で再生します。
-    `/save [テキスト]`: テキストをブックとして保存します。message.txtという名前の添付ファイルがある場合、その内容を保存します。
-    `/list`: 保存されているブックの一覧を表示します。
-    `/load [タイトル]`: 指定されたタイトルのブックを読み込み、テキスト、画像、音声を送信します。
-    `@ずんだもん`: ずんだもんにメンションすると、会話できます。
-    `/help`: コマンド一覧を表示します。
-    """
-    await message.channel.send(help_message)
+    await message.channel.send(router.help_text())
 
 
 # メッセージ受信時に動作する処理
 @client.event
 async def on_message(message):
-    async def extract_text_from_attachment(message):
-        """
-        添付ファイルあり
-        message.txtという名前の添付ファイルがある場合、
-        その内容を読み取り、/saveコマンドの引数として設定します。
-
-        添付がない場合は通常message応答
-        """
-        # 通常テキスト 添付なし
-        if len(message.attachments) == 0:
-            return message
-
-        # 添付ファイルパターン
-        attachment = message.attachments[0]
-        if attachment.filename == "message.txt":
-            data = await attachment.read()
-            text = data.decode("utf-8")
-            message.content = f"/save {text}"
-
-            return message
-
     if message.author.bot:
         return
 
-    if message.content == "/help":
-        await handle_help(message)
-        return
-
-    if message.content == "/neko":
-        await handle_neko(message)
-        return
-
-    if message.content.startswith("/image"):
-        await handle_text_to_image(message)
-        return
-
-    if message.content.startswith("/talk"):
-        await handle_speech(message)
-        return
-
-    # book一覧表示
-    if message.content.startswith("/list"):
-        await handle_list(message)
-        return
-
-    # book保存処理
-    if message.content.startswith("/save"):
-        message = await extract_text_from_attachment(message)
-        if message:
-            await handle_save(message)
-
-        return
-
-    # bookロード処理
-    if message.content.startswith("/load"):
-        await handle_load(message)
+    if await router.dispatch(message):
         return
 
     if client.user in message.mentions:
-        await handle_mention(message)
+        await router.invoke("@ずんだもん", message)
         return
 
 
-client.run(TOKEN)
+if __name__ == "__main__":
+    client.run(TOKEN)
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+def hash_key(*parts) -> str:
+    """
+    キャッシュキーを作成する
+    partsをJSON化してsha256を取るので、順序と型も含めて一致した場合のみ同じキーになる
+    """
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class DiskCache:
+    """
+    サイズ上限付きのファイルキャッシュ
+
+    キーごとに1ファイルで保存し、最終利用時刻(mtime)が古いものから削除するLRU方式。
+    ヒット時にmtimeを更新するので、よく使われるファイルほど残る。
+    """
+
+    def __init__(self, dir_path: str, max_bytes: int, suffix: str = ""):
+        self.dir_path = dir_path
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self._lock = threading.Lock()
+        self._total_bytes: int | None = None
+
+    def path_for(self, key: str) -> str:
+        # 1ディレクトリにファイルが集中しないよう先頭2文字で振り分ける
+        return os.path.join(self.dir_path, key[:2], key + self.suffix)
+
+    def get(self, key: str) -> str | None:
+        """
+        キャッシュ済みファイルのパスを返す。無ければNone
+        """
+        path = self.path_for(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def read(self, key: str) -> bytes | None:
+        path = self.get(key)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, data: bytes) -> str:
+        """
+        データを保存し、保存先のパスを返す
+        上限を超えた場合は古いものから削除する
+        """
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # 書き込み途中のファイルを読まれないよう、一時ファイルから置き換える
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+
+        with self._lock:
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+            total = self._get_total_bytes() - old_size + len(data)
+            self._total_bytes = total
+            if total > self.max_bytes:
+                self._evict(keep=path)
+
+        return path
+
+    def total_bytes(self) -> int:
+        with self._lock:
+            return self._get_total_bytes()
+
+    def _entries(self) -> list[tuple[float, int, str]]:
+        entries = []
+        if not os.path.isdir(self.dir_path):
+            return entries
+        for root, _, files in os.walk(self.dir_path):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _get_total_bytes(self) -> int:
+        if self._total_bytes is None:
+            self._total_bytes = sum(size for _, size, _ in self._entries())
+        return self._total_bytes
+
+    def _evict(self, keep: str):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._total_bytes = total
+
+    def clear_older_than(self, max_age_seconds: float):
+        """
+        最終利用からmax_age_seconds以上経過したファイルを削除する
+        """
+        threshold = time.time() - max_age_seconds
+        with self._lock:
+            for mtime, size, path in self._entries():
+                if mtime < threshold:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+            self._total_bytes = None
@@ -1,27 +1,66 @@
+import asyncio
 import base64
 import os
 import shutil
 import time
-from typing import Optional, List
+from typing import Awaitable, Callable, Optional, List
 
 import bs4
 from dotenv import load_dotenv
-from google import genai
 import argparse
 from icecream import ic
 import markdown
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 from discord import Message
-from tenacity import retry, stop_after_attempt, wait_fixed
 
+import book_manifest
+import book_search
+import clients
+from clients import genai_aio_client
+from disk_cache import DiskCache, hash_key
+from rate_limit import estimate_tokens, limit
+from resilience import with_retry
+import tracing
+from tracing import span
 import generate_image as gi
 import generate_voice as gv
 import utils as utils
 
-
 load_dotenv()
 SEP = "-" * 100
 
+# 段落パイプラインの各ステージの同時実行数
+SCENE_CONCURRENCY = int(os.getenv("BOOK_SCENE_CONCURRENCY", "3"))
+IMAGE_CONCURRENCY = int(os.getenv("BOOK_IMAGE_CONCURRENCY", "2"))
+VOICE_CONCURRENCY = int(os.getenv("BOOK_VOICE_CONCURRENCY", "2"))
+# 進捗通知の最短間隔(秒)
+PROGRESS_INTERVAL = 2
+
+SCENE_MODEL = "gemini-2.5-flash"
+# SceneAnalysisResultやプロンプトを変更したら上げる (古いメモを使わないように)
+SCENE_SCHEMA_VERSION = 1
+# シーン抽出結果のメモ use: 使う / refresh: 取り直して上書き / off: 使わない
+SCENE_CACHE_MODES = ("use", "refresh", "off")
+SCENE_CACHE_MODE = os.getenv("BOOK_SCENE_CACHE", "use")
+SCENE_CACHE_DIR = os.getenv("SCENE_CACHE_DIR", os.path.join("cache", "scene"))
+SCENE_CACHE_MAX_MB = int(os.getenv("SCENE_CACHE_MAX_MB", "100"))
+# シーン抽出の方式 batch: 原稿全体を一括 / paragraph: 段落ごと
+SCENE_MODES = ("batch", "paragraph")
+SCENE_MODE = os.getenv("BOOK_SCENE_MODE", "batch")
+# 一括抽出で1リクエストに含める本文の最大文字数 (超える場合は分割する)
+SCENE_BATCH_MAX_CHARS = int(os.getenv("BOOK_SCENE_BATCH_MAX_CHARS", "30000"))
+# シーン抽出で渡す文脈(前ページ)の作り方
+# full: 前の全段落 / window: 直前N段落 / summary: 直前N段落 + それより前のあらすじ
+CONTEXT_STRATEGIES = ("full", "window", "summary")
+CONTEXT_STRATEGY = os.getenv("BOOK_CONTEXT", "summary")
+CONTEXT_WINDOW = int(os.getenv("BOOK_CONTEXT_WINDOW", "3"))
+# あらすじの目安文字数
+SUMMARY_MAX_CHARS = 600
+# 登場人物・場所の一覧(book/<title>/registry.json)を作り、シーン抽出では参照させる
+REGISTRY_ENABLED = os.getenv("BOOK_REGISTRY", "1") != "0"
+# 音声はOgg/Opusで保存する。1にするとwavも残す
+KEEP_WAV = os.getenv("BOOK_KEEP_WAV", "0") == "1"
+
 
 class MarkdownData(BaseModel):
     title: str
@@ -121,22 +160,112 @@ class SceneAnalysisResult(BaseModel):
     )
 
 
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(1))
-def get_scene(input_text: str, prev_text: str) -> str:
-    """
-    Gemini APIを使って日本語からシーンを抽出する
-    """
+class IndexedScene(SceneAnalysisResult):
+    """段落番号付きのシーン"""
 
-    client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
-    prompt = f"""
-あなたは優秀な文芸編集者であり、イラストレーターのためのアシスタントです。
-以下の小説本文を注意深く読み、このシーンを挿絵として描くために必要となる具体的な情景描写の要素を抽出・整理してください。
-抽出対象で分からない情報は前ページを参考にして、不足情報を補ってください。
+    index: int = Field(..., description="対象段落の番号（入力の[段落N]のN）")
+
+
+class SceneBatchResult(BaseModel):
+    """一括抽出の結果"""
+
+    scenes: List[IndexedScene] = Field(
+        ..., description="段落ごとのシーン。入力の全段落について1件ずつ格納する。"
+    )
+
+
+class RegisteredCharacter(CharacterInfo):
+    """ブック全体で共通のキャラクター設定"""
+
+    id: str = Field(..., description="キャラクターID（例: c1, c2）")
+
+
+class RegisteredLocation(LocationInfo):
+    """ブック全体で共通の場所設定"""
+
+    id: str = Field(..., description="場所ID（例: l1, l2）")
+
+
+class BookRegistry(BaseModel):
+    """ブックの登場人物・場所の一覧"""
+
+    characters: List[RegisteredCharacter] = Field(
+        ..., description="登場キャラクターの一覧。同じキャラクターは1件にまとめる。"
+    )
+    locations: List[RegisteredLocation] = Field(
+        ..., description="登場する場所の一覧。同じ場所は1件にまとめる。"
+    )
+
+
+class RegistryFile(BaseModel):
+    """registry.jsonの内容 (どの原稿から作った一覧かを記録する)"""
+
+    source_hash: str
+    registry: BookRegistry
+
+
+class CharacterRef(BaseModel):
+    """一覧のキャラクターへの参照と、この段落での差分"""
+
+    id: Optional[str] = Field(
+        None, description="登場人物一覧のキャラクターID。一覧に無い場合はnull"
+    )
+    appearance_delta: Optional[str] = Field(
+        None,
+        description="一覧の外見から変化した点のみ（着替え、怪我など）。変化が無ければnull",
+    )
+    state_action: Optional[str] = Field(
+        None,
+        description="この段落でのキャラクターの状態や行動（表情、ポーズ、動作など）",
+    )
+    info: Optional[CharacterInfo] = Field(
+        None, description="一覧に無いキャラクターの場合のみ、キャラクターの情報"
+    )
 
-# 抽出対象の小説本文
-{input_text}
 
-*   上記の本文から、以下の要素に関する視覚的な情報を抽出してください。
+class SceneRefResult(BaseModel):
+    """登場人物・場所を一覧のIDで参照するシーン"""
+
+    characters: List[CharacterRef] = Field(
+        ..., description="シーンに登場するキャラクターの参照のリスト"
+    )
+    location_id: Optional[str] = Field(
+        None, description="登場人物一覧の場所ID。一覧に無い場合はnull"
+    )
+    location_delta: Optional[str] = Field(
+        None, description="一覧の場所設定から変化した点のみ。変化が無ければnull"
+    )
+    location: Optional[LocationInfo] = Field(
+        None, description="一覧に無い場所の場合のみ、場所の情報"
+    )
+    time_weather: TimeWeatherInfo = Field(..., description="時間・天候に関する情報")
+    action_situation: ActionSituationInfo = Field(
+        ..., description="行動・状況に関する情報"
+    )
+    emotion_atmosphere: EmotionAtmosphereInfo = Field(
+        ..., description="感情・雰囲気に関する情報"
+    )
+    important_objects: Optional[List[str]] = Field(
+        None,
+        description="物語やシーンの鍵となる物、特徴的な小物、特に描写されているアイテムのリスト",
+    )
+
+
+class IndexedSceneRef(SceneRefResult):
+    """段落番号付きの参照形式のシーン"""
+
+    index: int = Field(..., description="対象段落の番号（入力の[段落N]のN）")
+
+
+class SceneRefBatchResult(BaseModel):
+    """参照形式での一括抽出の結果"""
+
+    scenes: List[IndexedSceneRef] = Field(
+        ..., description="段落ごとのシーン。入力の全段落について1件ずつ格納する。"
+    )
+
+
+SCENE_EXTRACTION_RULES = """*   上記の本文から、以下の要素に関する視覚的な情報を抽出してください。
     *   **登場キャラクター (characters)**: シーンに登場する各キャラクター（人間、動物、植物、擬人化された物など）について、以下の情報を**リスト形式**で抽出してください。リストの各要素は一体のキャラクターに対応します。
         *   **種類 (type)**: キャラクターの種類（例: 人間, 犬, 猫, 木, ロボット, 喋るティーポット）
         *   名前 (name): 名前や呼称（もしあれば）
@@ -150,7 +279,106 @@ def get_scene(input_text: str, prev_text: str) -> str:
     *   重要なオブジェクト (important_objects): キャラクターとして扱わない、シーンの鍵となる物や小物のリスト
 *   抽出した結果を、**提供されたJSONスキーマに従ってJSON形式で厳密に出力してください。**
 *   本文中に明示的に書かれていない要素については、JSONの値として `null` を使用するか、スキーマ定義に従って省略してください。
-*   挿絵として描くことを意識し、視覚的な情報を優先して抽出してください。
+*   挿絵として描くことを意識し、視覚的な情報を優先して抽出してください。"""
+
+REGISTRY_REFERENCE_RULES = """*   登場キャラクターと場所は「登場人物・場所一覧」のIDで参照してください。
+    *   一覧にあるキャラクターは id を設定し、外見は一覧から変化した点だけを appearance_delta に書いてください。一覧と同じ外見を繰り返し書かないでください。
+    *   一覧に無いキャラクターだけ id を null にして info に情報を書いてください。
+    *   場所も同様に location_id を設定し、変化した点だけを location_delta に書いてください。一覧に無い場合のみ location に書いてください。"""
+
+
+def scene_schema(registry: Optional[BookRegistry]) -> type[BaseModel]:
+    """一覧の有無に応じたシーンのスキーマ"""
+    return SceneRefResult if registry else SceneAnalysisResult
+
+
+def scene_rules(registry: Optional[BookRegistry]) -> str:
+    """一覧の有無に応じた抽出指示"""
+    if not registry:
+        return SCENE_EXTRACTION_RULES
+    return f"""{SCENE_EXTRACTION_RULES}
+{REGISTRY_REFERENCE_RULES}
+
+# 登場人物・場所一覧
+{registry.model_dump_json(exclude_none=True)}"""
+
+
+scene_cache = DiskCache(
+    SCENE_CACHE_DIR, max_bytes=SCENE_CACHE_MAX_MB * 1024 * 1024, suffix=".json"
+)
+
+
+def scene_cache_key(*parts, registry: Optional[BookRegistry] = None) -> str:
+    """
+    シーン抽出メモのキー
+    一覧を使う場合は、一覧の内容が変われば別の結果として扱う
+    """
+    parts = (*parts, SCENE_MODEL, SCENE_SCHEMA_VERSION)
+    if registry:
+        parts = (*parts, registry.model_dump_json())
+    return hash_key(*parts)
+
+
+def get_scene(
+    input_text: str,
+    prev_text: str,
+    cache_mode: str = SCENE_CACHE_MODE,
+    registry: Optional[BookRegistry] = None,
+) -> Optional[dict]:
+    """get_scene_async()の同期版 (CLI用)"""
+    return clients.run_sync(
+        get_scene_async(input_text, prev_text, cache_mode, registry)
+    )
+
+
+async def get_scene_async(
+    input_text: str,
+    prev_text: str,
+    cache_mode: str = SCENE_CACHE_MODE,
+    registry: Optional[BookRegistry] = None,
+) -> Optional[dict]:
+    """
+    シーンを抽出する
+    同じ本文・前ページ・モデル・スキーマでの抽出結果はメモを再利用する
+    registryを指定した場合は、一覧を参照する形式(SceneRefResult)で返す
+    """
+    schema = scene_schema(registry)
+    key = scene_cache_key(input_text, prev_text, registry=registry)
+
+    if cache_mode == "use":
+        cached = scene_cache.read(key)
+        if cached is not None:
+            print("キャッシュ済みのシーンを使います")
+            return schema.model_validate_json(cached).model_dump()
+
+    result = await request_scene(input_text, prev_text, registry)
+
+    # 抽出に失敗した結果は保存しない
+    if result is not None and cache_mode != "off":
+        scene_cache.put(key, schema(**result).model_dump_json().encode("utf-8"))
+
+    return result
+
+
+@with_retry("gemini")
+async def request_scene(
+    input_text: str, prev_text: str, registry: Optional[BookRegistry] = None
+) -> Optional[dict]:
+    """
+    Gemini APIを使って日本語からシーンを抽出する
+    """
+    schema = scene_schema(registry)
+
+    client = genai_aio_client()
+    prompt = f"""
+あなたは優秀な文芸編集者であり、イラストレーターのためのアシスタントです。
+以下の小説本文を注意深く読み、このシーンを挿絵として描くために必要となる具体的な情景描写の要素を抽出・整理してください。
+抽出対象で分からない情報は前ページを参考にして、不足情報を補ってください。
+
+# 抽出対象の小説本文
+{input_text}
+
+{scene_rules(registry)}
 
 # 重要な注意点
 殺人、暴力、性的な内容、その他の不適切な内容は含まれないようにしてください。
@@ -161,17 +389,19 @@ def get_scene(input_text: str, prev_text: str) -> str:
 
     print(SEP)
     # print(prompt)
-    response = client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=prompt,
-        config={
-            "response_mime_type": "application/json",
-            "response_schema": SceneAnalysisResult,
-        },
-    )
+    print(f"シーン抽出プロンプト: {len(prompt)}文字 (前ページ {len(prev_text)}文字)")
+    async with limit("gemini", SCENE_MODEL, estimate_tokens(prompt)):
+        response = await client.models.generate_content(
+            model=SCENE_MODEL,
+            contents=prompt,
+            config={
+                "response_mime_type": "application/json",
+                "response_schema": schema,
+            },
+        )
 
     try:
-        result = SceneAnalysisResult.model_validate_json(response.text)
+        result = schema.model_validate_json(response.text)
         result = result.model_dump()
     except Exception as e:
         ic(e)
@@ -181,7 +411,387 @@ def get_scene(input_text: str, prev_text: str) -> str:
     return result
 
 
-def generate_image(data: MarkdownData, target_index: int) -> str:
+def split_scene_batches(
+    paragraphs: List[str], max_chars: int = SCENE_BATCH_MAX_CHARS
+) -> List[tuple[int, int]]:
+    """
+    一括抽出のリクエスト単位に段落を分ける
+    各要素は(開始index, 終了index)。1段落でmax_charsを超える場合はその段落だけで1単位
+    """
+    batches = []
+    start = 0
+    size = 0
+    for i, paragraph in enumerate(paragraphs):
+        if i > start and size + len(paragraph) > max_chars:
+            batches.append((start, i))
+            start = i
+            size = 0
+        size += len(paragraph)
+    if start < len(paragraphs):
+        batches.append((start, len(paragraphs)))
+    return batches
+
+
+async def get_scene_batch(
+    paragraphs: List[str],
+    start: int,
+    end: int,
+    cache_mode: str = SCENE_CACHE_MODE,
+    prev_text: Optional[str] = None,
+    registry: Optional[BookRegistry] = None,
+) -> List[Optional[dict]]:
+    """
+    paragraphs[start:end]のシーンを1リクエストで抽出する
+    prev_text未指定の場合は、前ページとして直前のバッチの本文を渡す。
+    結果は段落順に並べ、抽出できなかった段落はNone
+    """
+    targets = paragraphs[start:end]
+    if prev_text is None:
+        prev_start = split_scene_batches(paragraphs[:start])[-1][0] if start else 0
+        prev_text = "".join(paragraphs[prev_start:start])
+
+    schema = scene_schema(registry)
+    batch_schema = SceneRefBatchResult if registry else SceneBatchResult
+    key = scene_cache_key("batch", start, targets, prev_text, registry=registry)
+
+    result = None
+    if cache_mode == "use":
+        cached = scene_cache.read(key)
+        if cached is not None:
+            print("キャッシュ済みのシーンを使います")
+            result = batch_schema.model_validate_json(cached)
+
+    if result is None:
+        result = await request_scene_batch(targets, start, prev_text, registry)
+        if result is not None and cache_mode != "off":
+            scene_cache.put(key, result.model_dump_json().encode("utf-8"))
+
+    scenes: List[Optional[dict]] = [None] * len(targets)
+    if result is None:
+        return scenes
+
+    for scene in result.scenes:
+        if start <= scene.index < end:
+            scenes[scene.index - start] = schema(
+                **scene.model_dump(exclude={"index"})
+            ).model_dump()
+    return scenes
+
+
+@with_retry("gemini")
+async def request_scene_batch(
+    targets: List[str],
+    start: int,
+    prev_text: str,
+    registry: Optional[BookRegistry] = None,
+) -> Optional[SceneBatchResult | SceneRefBatchResult]:
+    """
+    Gemini APIを使って複数段落のシーンを一括で抽出する
+    """
+    batch_schema = SceneRefBatchResult if registry else SceneBatchResult
+
+    client = genai_aio_client()
+    numbered_text = "\n\n".join(
+        f"[段落{start + i}]\n{paragraph}" for i, paragraph in enumerate(targets)
+    )
+    prompt = f"""
+あなたは優秀な文芸編集者であり、イラストレーターのためのアシスタントです。
+以下の小説本文は[段落N]で区切られています。段落ごとに、そのシーンを挿絵として描くために必要となる具体的な情景描写の要素を抽出・整理してください。
+ある段落で分からない情報は、それより前の段落や前ページを参考にして、不足情報を補ってください。
+
+# 抽出対象の小説本文
+{numbered_text}
+
+{scene_rules(registry)}
+*   **各段落の結果には、index として[段落N]のNを設定し、全ての段落について1件ずつ出力してください。**
+
+# 重要な注意点
+殺人、暴力、性的な内容、その他の不適切な内容は含まれないようにしてください。
+
+# 前ページ
+{prev_text}
+"""
+
+    print(SEP)
+    print(f"シーンを一括抽出中... 段落{start}〜{start + len(targets) - 1}")
+    print(f"シーン抽出プロンプト: {len(prompt)}文字 (前ページ {len(prev_text)}文字)")
+    async with limit("gemini", SCENE_MODEL, estimate_tokens(prompt)):
+        response = await client.models.generate_content(
+            model=SCENE_MODEL,
+            contents=prompt,
+            config={
+                "response_mime_type": "application/json",
+                "response_schema": batch_schema,
+            },
+        )
+
+    try:
+        result = batch_schema.model_validate_json(response.text)
+    except Exception as e:
+        ic(e)
+        result = None
+
+    return result
+
+
+@with_retry("gemini")
+async def request_registry(text: str, registry: BookRegistry) -> BookRegistry:
+    """
+    Gemini APIを使って本文から登場人物・場所の一覧を作る
+    既存の一覧がある場合は、それに追記・統合した一覧を返す
+    """
+
+    client = genai_aio_client()
+    prompt = f"""
+あなたは優秀な文芸編集者であり、イラストレーターのためのアシスタントです。
+以下の小説本文を読み、挿絵を描くときに全ページで共通して使う「登場人物・場所一覧」を作成してください。
+
+*   同じキャラクター・場所は1件にまとめ、c1, c2... / l1, l2... のようなIDを付けてください。
+*   既存の一覧がある場合は、そのIDと内容を維持したまま、新しく登場したものを追加してください。
+*   外見 (appearance) は、物語を通して基本となる姿を、挿絵で描けるよう具体的に書いてください。
+*   state_action は一覧では使わないので null にしてください。
+*   本文中に明示的に書かれていない要素については null にしてください。
+
+# 重要な注意点
+殺人、暴力、性的な内容、その他の不適切な内容は含まれないようにしてください。
+
+# 既存の一覧
+{registry.model_dump_json(exclude_none=True)}
+
+# 小説本文
+{text}
+"""
+
+    print(SEP)
+    print(f"登場人物・場所一覧を作成中... プロンプト: {len(prompt)}文字")
+    async with limit("gemini", SCENE_MODEL, estimate_tokens(prompt)):
+        response = await client.models.generate_content(
+            model=SCENE_MODEL,
+            contents=prompt,
+            config={
+                "response_mime_type": "application/json",
+                "response_schema": BookRegistry,
+            },
+        )
+    return BookRegistry.model_validate_json(response.text)
+
+
+async def load_or_build_registry(
+    data: MarkdownData, dir_path: str, cache_mode: str = SCENE_CACHE_MODE
+) -> BookRegistry:
+    """
+    book/<title>/registry.json を読み込む
+    無い場合、原稿が変わっていた場合(またはrefresh指定時)は原稿全体から作成して保存する
+    """
+    registry_path = os.path.join(dir_path, "registry.json")
+    source_hash = hash_key(*data.paragraph, SCENE_MODEL, SCENE_SCHEMA_VERSION)
+    if cache_mode == "use":
+        try:
+            with open(registry_path, "r", encoding="utf-8") as f:
+                saved = RegistryFile.model_validate_json(f.read())
+            if saved.source_hash == source_hash:
+                return saved.registry
+            print("原稿が変わったため、登場人物・場所一覧を作り直します")
+        except (FileNotFoundError, ValidationError):
+            pass
+
+    # 長い原稿はシーン抽出と同じ単位で分け、一覧を引き継ぎながら作る
+    registry = BookRegistry(characters=[], locations=[])
+    for start, end in split_scene_batches(data.paragraph):
+        text = "".join(data.paragraph[start:end])
+        registry = await request_registry(text, registry)
+
+    with open(registry_path, "w", encoding="utf-8") as f:
+        saved = RegistryFile(source_hash=source_hash, registry=registry)
+        f.write(saved.model_dump_json(indent=2))
+    ic(registry)
+    return registry
+
+
+def expand_scene(
+    scene: Optional[dict], registry: Optional[BookRegistry]
+) -> Optional[dict]:
+    """
+    一覧を参照する形式のシーンを、一覧の内容で展開して
+    SceneAnalysisResultと同じ形式にする
+    """
+    if not scene or not registry or "location_id" not in scene:
+        return scene
+
+    characters = {c.id: c for c in registry.characters}
+    locations = {location.id: location for location in registry.locations}
+
+    expanded_characters = []
+    for ref in scene["characters"]:
+        if ref.get("id") in characters:
+            character = characters[ref["id"]].model_dump(exclude={"id"})
+            if ref.get("appearance_delta"):
+                character["appearance"] = (
+                    f"{character['appearance'] or ''} ({ref['appearance_delta']})"
+                )
+        else:
+            character = ref.get("info") or {}
+        character["state_action"] = ref.get("state_action")
+        expanded_characters.append(CharacterInfo(**character).model_dump())
+
+    if scene.get("location_id") in locations:
+        location = locations[scene["location_id"]].model_dump(exclude={"id"})
+        if scene.get("location_delta"):
+            location["atmosphere_features"] = (
+                f"{location['atmosphere_features'] or ''} ({scene['location_delta']})"
+            )
+    else:
+        location = scene.get("location") or {}
+
+    return SceneAnalysisResult(
+        characters=expanded_characters,
+        location=LocationInfo(**location),
+        time_weather=scene["time_weather"],
+        action_situation=scene["action_situation"],
+        emotion_atmosphere=scene["emotion_atmosphere"],
+        important_objects=scene.get("important_objects"),
+    ).model_dump()
+
+
+@with_retry("gemini")
+async def request_summary(summary: str, new_text: str) -> str:
+    """
+    Gemini APIを使って、これまでのあらすじに新しい本文を反映する
+    """
+
+    client = genai_aio_client()
+    prompt = f"""
+あなたは優秀な文芸編集者です。
+「これまでのあらすじ」に「続きの本文」の内容を反映し、更新したあらすじだけを出力してください。
+
+*   挿絵を描くときの参考にするため、登場人物の名前・外見・服装、場所、時代、時間帯、天候など視覚的な情報を優先して残してください。
+*   {SUMMARY_MAX_CHARS}文字以内にまとめてください。
+
+# これまでのあらすじ
+{summary}
+
+# 続きの本文
+{new_text}
+"""
+
+    print(SEP)
+    print(f"あらすじを更新中... プロンプト: {len(prompt)}文字")
+    async with limit("gemini", SCENE_MODEL, estimate_tokens(prompt)):
+        response = await client.models.generate_content(
+            model=SCENE_MODEL, contents=prompt
+        )
+    return response.text.strip()
+
+
+async def update_summary(
+    summary: str, new_text: str, cache_mode: str = SCENE_CACHE_MODE
+) -> str:
+    """
+    あらすじを更新する
+    同じあらすじと本文からの更新結果はメモを再利用する
+    """
+    key = hash_key("summary", summary, new_text, SCENE_MODEL, SCENE_SCHEMA_VERSION)
+
+    if cache_mode == "use":
+        cached = scene_cache.read(key)
+        if cached is not None:
+            return cached.decode("utf-8")
+
+    result = await request_summary(summary, new_text)
+    if cache_mode != "off":
+        scene_cache.put(key, result.encode("utf-8"))
+    return result
+
+
+class ContextBuilder:
+    """
+    シーン抽出に渡す文脈(前ページ)の組み立て
+
+    full: 前の全段落をそのまま渡す (段落が進むほど長くなる)
+    window: 直前window段落だけ渡す
+    summary: 直前window段落に加え、それより前の段落をあらすじとして渡す
+
+    あらすじは「段落kまでのあらすじ」を記録しておき、次に必要になったときは
+    記録済みの中で一番進んだものに、まだ含めていない段落だけを反映して更新する。
+    段落の処理順が前後しても、対象段落より後ろの内容は含まれない。
+    """
+
+    def __init__(
+        self,
+        paragraphs: List[str],
+        strategy: str = CONTEXT_STRATEGY,
+        window: int = CONTEXT_WINDOW,
+        cache_mode: str = SCENE_CACHE_MODE,
+    ):
+        self.paragraphs = paragraphs
+        self.strategy = strategy
+        self.window = window
+        self.cache_mode = cache_mode
+        # 段落k未満を反映したあらすじ
+        self._summaries: dict[int, str] = {0: ""}
+        self._lock = asyncio.Lock()
+
+    async def get(self, index: int) -> str:
+        """
+        段落indexの文脈を取得する
+        """
+        if self.strategy == "full":
+            context = "".join(self.paragraphs[:index])
+        else:
+            window_start = max(0, index - self.window)
+            window_text = "".join(self.paragraphs[window_start:index])
+            if self.strategy == "window" or window_start == 0:
+                context = window_text
+            else:
+                summary = await self._get_summary(window_start)
+                context = (
+                    f"## これまでのあらすじ\n{summary}\n\n## 直前の本文\n{window_text}"
+                )
+
+        print(f"[段落{index}] 文脈({self.strategy}): {len(context)}文字")
+        return context
+
+    async def _get_summary(self, until: int) -> str:
+        async with self._lock:
+            if until in self._summaries:
+                return self._summaries[until]
+
+            base = max(k for k in self._summaries if k < until)
+            new_text = "".join(self.paragraphs[base:until])
+            summary = await update_summary(
+                self._summaries[base], new_text, self.cache_mode
+            )
+            self._summaries[until] = summary
+            return summary
+
+
+def generate_image(
+    data: MarkdownData,
+    target_index: int,
+    scene: Optional[dict] = None,
+    registry: Optional[BookRegistry] = None,
+    context_builder: Optional[ContextBuilder] = None,
+) -> str:
+    """generate_image_async()の同期版 (CLI用)"""
+    return clients.run_sync(
+        generate_image_async(data, target_index, scene, registry, context_builder)
+    )
+
+
+async def generate_image_async(
+    data: MarkdownData,
+    target_index: int,
+    scene: Optional[dict] = None,
+    registry: Optional[BookRegistry] = None,
+    context_builder: Optional[ContextBuilder] = None,
+) -> str:
+    """
+    段落の挿絵を生成する
+    sceneが未指定の場合はget_sceneで抽出してから生成する
+    その際の前ページはcontext_builder (未指定なら既定の設定) で組み立てる
+    registryを指定した場合は、一覧を参照する形式のシーンを展開してからプロンプトにする
+    """
+
     def get_photo_prompt(story, scene) -> str:
         style_keywords = [
             "best quality",
@@ -446,15 +1056,20 @@ def generate_image(data: MarkdownData, target_index: int) -> str:
         return prompt.strip()
 
     content = data.paragraph[target_index]
-    # indexが進むにつれて、全文を増やす
-    prev_text = "".join(data.paragraph[:target_index])
-    # ic(content, prev_text)
-    scene = get_scene(content, prev_text)
+    if scene is None:
+        if context_builder is None:
+            context_builder = ContextBuilder(data.paragraph)
+        prev_text = await context_builder.get(target_index)
+        # ic(content, prev_text)
+        scene = await get_scene_async(
+            content, prev_text, context_builder.cache_mode, registry
+        )
+    scene = expand_scene(scene, registry)
 
     prompt = get_photo_prompt(content, scene)
     # ic(prompt)
     try:
-        image_path = gi.generate_image_from_text_openai(prompt)
+        image_path = await gi.generate_image_from_text_openai_async(prompt)
         return image_path
     except Exception as e:
         ic(f"画像生成エラー: {e}")
@@ -462,6 +1077,11 @@ def generate_image(data: MarkdownData, target_index: int) -> str:
 
 
 def markdown_to_data(markdown_text: str) -> MarkdownData:
+    with span("markdown_to_data", bytes=len(markdown_text.encode("utf-8"))):
+        return parse_markdown(markdown_text)
+
+
+def parse_markdown(markdown_text: str) -> MarkdownData:
     # MDに/bookが含まれている場合は除去
     for word in ["/book", "/save"]:
         markdown_text = markdown_text.replace(word, "").strip()
@@ -491,60 +1111,290 @@ def make_root_dir(data: MarkdownData) -> str:
     """
     対象MDのフォルダ作成、本文保存
     """
-    dir_path = os.path.join("book", data.title)
+    dir_path = book_manifest.book_path(data.title)
 
     os.makedirs(dir_path, exist_ok=True)
 
     markdown_file_path = os.path.join(dir_path, "target.md")
-    with open(markdown_file_path, "w", encoding="utf-8") as f:
-        f.write(data.all_text)
+    with span("write_markdown", bytes=len(data.all_text.encode("utf-8"))):
+        with open(markdown_file_path, "w", encoding="utf-8") as f:
+            f.write(data.all_text)
 
     return dir_path
 
 
-async def save(input_text: str, message: Message):
+class StageLimits(BaseModel):
+    """段落パイプラインの各ステージの同時実行数"""
 
-    start_time = time.time()
+    scene: int = SCENE_CONCURRENCY
+    image: int = IMAGE_CONCURRENCY
+    voice: int = VOICE_CONCURRENCY
 
-    data = markdown_to_data(input_text)
-    # ic(data)
-    dir_path = make_root_dir(data)
-    paragraph_count = len(data.paragraph)
 
-    for i in range(paragraph_count):
-        ic(i, paragraph_count, SEP)
-        await message.channel.send(f"book生成中にゃ {i+1}/{paragraph_count}")
+class BookOptions(BaseModel):
+    """ブック生成の設定"""
+
+    limits: StageLimits = Field(default_factory=StageLimits)
+    scene_cache: str = SCENE_CACHE_MODE
+    scene_mode: str = SCENE_MODE
+    context: str = CONTEXT_STRATEGY
+    context_window: int = CONTEXT_WINDOW
+    registry: bool = REGISTRY_ENABLED
+    keep_wav: bool = KEEP_WAV
+
+
+class BookProgress:
+    """
+    ステージごとの進捗集計
+
+    各ステージの完了はdone()で記録し、通知はreport_loop()が
+    PROGRESS_INTERVAL秒以上の間隔でまとめて行う。
+    通知が遅くても各ステージの処理は止まらない。
+    """
 
-        paragraph_path = os.path.join(dir_path, str(i))
-        os.makedirs(paragraph_path, exist_ok=True)
+    LABELS = {"scene": "シーン", "image": "画像", "voice": "音声"}
+
+    def __init__(
+        self,
+        totals: dict[str, int],
+        on_progress: Callable[[str], Awaitable[None]],
+    ):
+        self.totals = totals
+        self.counts = {stage: 0 for stage in totals}
+        self.on_progress = on_progress
+        self._changed = asyncio.Event()
+
+    def done(self, stage: str):
+        self.counts[stage] += 1
+        self._changed.set()
+
+    def summary(self) -> str:
+        return " | ".join(
+            f"{self.LABELS[stage]} {self.counts[stage]}/{self.totals[stage]}"
+            for stage in self.totals
+        )
+
+    async def report_loop(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            await self.on_progress(self.summary())
+            await asyncio.sleep(PROGRESS_INTERVAL)
+
+
+def write_paragraph_text(data: MarkdownData, dir_path: str, index: int) -> str:
+    """
+    段落フォルダを作成し、本文をtarget.txtに保存する
+    """
+    paragraph_path = os.path.join(dir_path, str(index))
+    os.makedirs(paragraph_path, exist_ok=True)
 
-        # 初回のみタイトル設定
-        target_text = ""
-        if i == 0:
-            target_text = f"## {data.title}\n\n"
+    # 初回のみタイトル設定
+    target_text = ""
+    if index == 0:
+        target_text = f"## {data.title}\n\n"
 
-        target_text += data.paragraph[i]
+    target_text += data.paragraph[index]
 
-        target_file_path = os.path.join(paragraph_path, "target.txt")
+    target_file_path = os.path.join(paragraph_path, "target.txt")
+    with span("write_text", paragraph=index, bytes=len(target_text.encode("utf-8"))):
         with open(target_file_path, "w", encoding="utf-8") as f:
             f.write(target_text)
 
-        # 画像処理
-        image_path = os.path.join(paragraph_path, "target.png")
+    return paragraph_path
+
+
+async def run_pipeline(
+    data: MarkdownData,
+    dir_path: str,
+    on_progress: Callable[[str], Awaitable[None]],
+    options: BookOptions | None = None,
+):
+    """
+    全段落のシーン抽出・画像生成・音声合成を並行して実行する
+
+    段落ごとに「シーン抽出→画像生成」と「音声合成」を別々に進め、
+    ステージごとにセマフォで同時実行数を制限する。
+    出力先は従来通り book/<title>/<i>/ 。既に存在するファイルは作り直さない。
+    """
+    options = options or BookOptions()
+    limits = options.limits
+    scene_semaphore = asyncio.Semaphore(limits.scene)
+    image_semaphore = asyncio.Semaphore(limits.image)
+    voice_semaphore = asyncio.Semaphore(limits.voice)
 
-        if not os.path.exists(image_path):
-            result_path = generate_image(data, i)
-            if result_path:
+    paragraph_count = len(data.paragraph)
+    paragraph_paths = [
+        write_paragraph_text(data, dir_path, i) for i in range(paragraph_count)
+    ]
+    voice_texts = [utils.split_text(p) for p in data.paragraph]
+
+    progress = BookProgress(
+        {
+            "scene": paragraph_count,
+            "image": paragraph_count,
+            "voice": sum(len(texts) for texts in voice_texts),
+        },
+        on_progress,
+    )
+
+    image_paths = [os.path.join(path, "target.png") for path in paragraph_paths]
+    missing_images = [not os.path.exists(path) for path in image_paths]
+
+    # 一括抽出: バッチ単位でリクエストし、各段落は所属するバッチの完了を待つ
+    # 段落index -> (バッチの開始index, バッチのタスク)
+    paragraph_batches: dict[int, tuple[int, asyncio.Task]] = {}
+
+    # 登場人物・場所一覧 (画像生成が必要な場合のみ作成する)
+    registry_task: Optional[asyncio.Task] = None
+
+    async def build_registry() -> Optional[BookRegistry]:
+        try:
+            with span("registry"):
+                return await load_or_build_registry(data, dir_path, options.scene_cache)
+        except Exception as e:
+            # 一覧が無くてもシーンは抽出できるので、ブック全体の生成は止めない
+            print(f"登場人物・場所一覧を作れませんでした。一覧を使わずに続けます: {e}")
+            return None
+
+    async def get_registry() -> Optional[BookRegistry]:
+        if registry_task is None:
+            return None
+        return await registry_task
+
+    context_builder = ContextBuilder(
+        data.paragraph,
+        strategy=options.context,
+        window=options.context_window,
+        cache_mode=options.scene_cache,
+    )
+
+    async def scene_batch(start: int, end: int) -> List[Optional[dict]]:
+        prev_text = await context_builder.get(start)
+        registry = await get_registry()
+        async with scene_semaphore:
+            with span("get_scene_batch", paragraph=start, paragraph_end=end):
+                scenes = await get_scene_batch(
+                    data.paragraph,
+                    start,
+                    end,
+                    options.scene_cache,
+                    prev_text,
+                    registry,
+                )
+        for _ in range(start, end):
+            progress.done("scene")
+        return scenes
+
+    async def get_paragraph_scene(i: int) -> Optional[dict]:
+        if options.scene_mode == "batch":
+            start, batch_task = paragraph_batches[i]
+            scene = (await batch_task)[i - start]
+            if scene is not None:
+                return scene
+
+        prev_text = await context_builder.get(i)
+        registry = await get_registry()
+        async with scene_semaphore:
+            with span("get_scene", paragraph=i):
+                scene = await get_scene_async(
+                    data.paragraph[i], prev_text, options.scene_cache, registry
+                )
+        if options.scene_mode != "batch":
+            progress.done("scene")
+        return scene
+
+    async def image_branch(i: int):
+        image_path = image_paths[i]
+        if not missing_images[i]:
+            if options.scene_mode != "batch":
+                progress.done("scene")
+            progress.done("image")
+            return
+
+        scene = await get_paragraph_scene(i)
+        registry = await get_registry()
+
+        async with image_semaphore:
+            with span("generate_image", paragraph=i):
+                result_path = await generate_image_async(
+                    data, i, scene, registry, context_builder
+                )
+        if result_path:
+            with span("move_image", paragraph=i, bytes=os.path.getsize(result_path)):
                 shutil.move(result_path, image_path)
+        progress.done("image")
+
+    async def voice_branch(i: int):
+        for j, t in enumerate(voice_texts[i]):
+            opus_path = os.path.join(paragraph_paths[i], f"{j}.opus")
+            wav_path = os.path.join(paragraph_paths[i], f"{j}.wav")
+
+            if not os.path.exists(opus_path):
+                async with voice_semaphore:
+                    with span("synthesize_chunk", paragraph=i, chunk=j) as s:
+                        result_path = await gv.synthesize_to_opus(
+                            t,
+                            opus_path,
+                            wav_path=wav_path if options.keep_wav else None,
+                        )
+                        if s and result_path:
+                            s.set(bytes=os.path.getsize(result_path))
+                if not result_path:
+                    print(f"音声合成に失敗しました: {i}/{j}")
+                elif result_path == opus_path and not options.keep_wav:
+                    # 以前の形式で保存済みのwavは不要になる
+                    if os.path.exists(wav_path):
+                        os.remove(wav_path)
+            progress.done("voice")
+
+    reporter = asyncio.create_task(progress.report_loop())
+    try:
+        async with asyncio.TaskGroup() as tg:
+            if options.registry and any(missing_images):
+                registry_task = tg.create_task(build_registry())
+            if options.scene_mode == "batch":
+                if any(missing_images):
+                    for start, end in split_scene_batches(data.paragraph):
+                        task = tg.create_task(scene_batch(start, end))
+                        for i in range(start, end):
+                            paragraph_batches[i] = (start, task)
+                else:
+                    for _ in range(paragraph_count):
+                        progress.done("scene")
+            for i in range(paragraph_count):
+                tg.create_task(image_branch(i))
+                tg.create_task(voice_branch(i))
+    finally:
+        reporter.cancel()
+
+    # /list, /loadがフォルダを走査しなくて済むよう内容一覧を保存する
+    with span("save_manifest"):
+        manifest = await asyncio.to_thread(book_manifest.save_manifest, data.title)
+    with span("index_book"):
+        await asyncio.to_thread(book_search.search_index.index_book, manifest)
+    await on_progress(progress.summary())
 
-        # 音声処理
-        texts = utils.split_text(data.paragraph[i])
-        for j, t in enumerate(texts):
-            wav_path = os.path.join(paragraph_path, f"{j}.wav")
 
-            if not os.path.exists(wav_path):
-                result_path = gv.synthesize_voice_with_timestamp(t)
-                shutil.move(result_path, wav_path)
+async def save(input_text: str, message: Message):
+
+    start_time = time.time()
+
+    with tracing.start_trace("book") as root:
+        data = markdown_to_data(input_text)
+        # ic(data)
+        dir_path = make_root_dir(data)
+        if root:
+            root.set(title=data.title, paragraphs=len(data.paragraph))
+
+        status_message = await message.channel.send(
+            f"book生成中にゃ 0/{len(data.paragraph)}"
+        )
+
+        async def on_progress(summary: str):
+            await status_message.edit(content=f"book生成中にゃ {summary}")
+
+        await run_pipeline(data, dir_path, on_progress)
 
     end_time = time.time()
     elapsed_time = end_time - start_time
@@ -559,6 +1409,59 @@ def main():
     parser.add_argument(
         "--input_file", default="work/01.md", help="処理するMarkdownファイルのパス"
     )
+    parser.add_argument(
+        "--scene_concurrency",
+        type=int,
+        default=SCENE_CONCURRENCY,
+        help="シーン抽出の同時実行数",
+    )
+    parser.add_argument(
+        "--image_concurrency",
+        type=int,
+        default=IMAGE_CONCURRENCY,
+        help="画像生成の同時実行数",
+    )
+    parser.add_argument(
+        "--voice_concurrency",
+        type=int,
+        default=VOICE_CONCURRENCY,
+        help="音声合成の同時実行数",
+    )
+    parser.add_argument(
+        "--scene_cache",
+        choices=SCENE_CACHE_MODES,
+        default=SCENE_CACHE_MODE,
+        help="シーン抽出結果のメモ (use: 使う, refresh: 取り直して上書き, off: 使わない)",
+    )
+    parser.add_argument(
+        "--scene_mode",
+        choices=SCENE_MODES,
+        default=SCENE_MODE,
+        help="シーン抽出の方式 (batch: 原稿全体を一括, paragraph: 段落ごと)",
+    )
+    parser.add_argument(
+        "--context",
+        choices=CONTEXT_STRATEGIES,
+        default=CONTEXT_STRATEGY,
+        help="シーン抽出に渡す文脈 (full: 前の全段落, window: 直前N段落, summary: 直前N段落+あらすじ)",
+    )
+    parser.add_argument(
+        "--context_window",
+        type=int,
+        default=CONTEXT_WINDOW,
+        help="window/summaryで本文をそのまま渡す直前の段落数",
+    )
+    parser.add_argument(
+        "--no_registry",
+        action="store_true",
+        help="登場人物・場所一覧を使わず、段落ごとにキャラクターを抽出する",
+    )
+    parser.add_argument(
+        "--keep_wav",
+        action="store_true",
+        default=KEEP_WAV,
+        help="音声をOgg/Opusに加えてwavでも保存する",
+    )
     args = parser.parse_args()
 
     input_file_path = args.input_file
@@ -568,44 +1471,41 @@ def main():
 
     start_time = time.time()
 
-    data = markdown_to_data(input_text)
-    # ic(data)
-    dir_path = make_root_dir(data)
-    paragraph_count = len(data.paragraph)
-
-    for i in range(paragraph_count):
-        ic(i, paragraph_count, SEP)
-        paragraph_path = os.path.join(dir_path, str(i))
-        os.makedirs(paragraph_path, exist_ok=True)
-
-        # 初回のみタイトル設定
-        target_text = ""
-        if i == 0:
-            target_text = f"## {data.title}\n\n"
-
-        target_text += data.paragraph[i]
-
-        target_file_path = os.path.join(paragraph_path, "target.txt")
-        with open(target_file_path, "w", encoding="utf-8") as f:
-            f.write(target_text)
-
-        # 画像処理
-        image_path = os.path.join(paragraph_path, "target.png")
-
-        if not os.path.exists(image_path):
-            result_path = generate_image(data, i)
-            if result_path:
-                shutil.move(result_path, image_path)
-
-        # 音声処理
-        texts = utils.split_text(data.paragraph[i])
-        for j, t in enumerate(texts):
-            wav_path = os.path.join(paragraph_path, f"{j}.wav")
-
-            if not os.path.exists(wav_path):
-                result_path = gv.synthesize_voice_with_timestamp(t)
-                shutil.move(result_path, wav_path)
-
+    with tracing.start_trace("book") as root:
+        data = markdown_to_data(input_text)
+        # ic(data)
+        dir_path = make_root_dir(data)
+        if root:
+            root.set(title=data.title, paragraphs=len(data.paragraph))
+
+        options = BookOptions(
+            limits=StageLimits(
+                scene=args.scene_concurrency,
+                image=args.image_concurrency,
+                voice=args.voice_concurrency,
+            ),
+            scene_cache=args.scene_cache,
+            scene_mode=args.scene_mode,
+            context=args.context,
+            context_window=args.context_window,
+            registry=REGISTRY_ENABLED and not args.no_registry,
+            keep_wav=args.keep_wav,
+        )
+
+        async def on_progress(summary: str):
+            print(f"進捗: {summary}")
+
+        async def run():
+            try:
+                await run_pipeline(data, dir_path, on_progress, options)
+            finally:
+                await gv.close_async_session()
+                await clients.registry.aclose_loop()
+
+        asyncio.run(run())
+
+    if root:
+        print(f"処理時間の記録を '{root.tracer.path}' に保存しました。")
     end_time = time.time()
     elapsed_time = end_time - start_time
     print(f"実行時間: {elapsed_time:.2f}秒")
@@ -1,25 +1,31 @@
+import asyncio
 import os
 from icecream import ic
 from dotenv import load_dotenv
 from pydantic import BaseModel
-from openai import OpenAI
-import time
 from datetime import datetime
-from google import genai
 from google.genai import types
-from PIL import Image
-from io import BytesIO
 import base64
 from translate import translate_text
+from clients import genai_aio_client, openai_async_client, run_sync
+from image_cache import get_cached_image, put_cached_image
+from rate_limit import estimate_tokens, limit
+from resilience import RetryableError, with_retry
 
 SEP = "-" * 100
+# 生成結果のMIMEタイプと保存時の拡張子
+IMAGE_EXTENSIONS = {"image/png": ".png", "image/jpeg": ".jpg", "image/webp": ".webp"}
 
 # .envファイルの内容を読み込む
 load_dotenv()
 
 
 def generate_image_from_text_openai(input_text: str) -> str:
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), timeout=60)
+    """generate_image_from_text_openai_async()の同期版 (CLI用)"""
+    return run_sync(generate_image_from_text_openai_async(input_text))
+
+
+async def generate_image_from_text_openai_async(input_text: str) -> str:
 
     model = "gpt-image-1"
     size = "1024x1024"
@@ -32,13 +38,17 @@ def generate_image_from_text_openai(input_text: str) -> str:
 
     prompt = input_text
 
+    cached_path = get_cached_image("openai", model, size, quality, prompt)
+    if cached_path:
+        return cached_path
+
     print(SEP)
     print("openaiで画像を生成中...")
     print(model, size, quality)
     print(prompt)
 
     # 画像の生成
-    result = client.images.generate(
+    result = await request_openai_image(
         model=model,
         moderation="low",
         prompt=prompt,
@@ -49,6 +59,7 @@ def generate_image_from_text_openai(input_text: str) -> str:
     # 画像をダウンロードして保存
     image_base64 = result.data[0].b64_json
     image_bytes = base64.b64decode(image_base64)
+    put_cached_image("openai", model, size, quality, prompt, image_bytes)
 
     # imgディレクトリがなければ作成
     os.makedirs("img", exist_ok=True)
@@ -60,8 +71,27 @@ def generate_image_from_text_openai(input_text: str) -> str:
     return filepath
 
 
+@with_retry("openai")
+async def request_openai_image(**kwargs):
+    async with limit("openai", kwargs["model"]):
+        return await openai_async_client().images.generate(**kwargs)
+
+
+@with_retry("openai")
+async def request_openai_edit(image_path: str, **kwargs):
+    # 再試行のたびに先頭から読めるよう、呼び出しごとに開く
+    async with limit("openai", kwargs["model"]):
+        with open(image_path, "rb") as image:
+            return await openai_async_client().images.edit(image=[image], **kwargs)
+
+
 def generate_image_from_text_google(input_text: str) -> str:
-    client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+    """generate_image_from_text_google_async()の同期版 (CLI用)"""
+    return run_sync(generate_image_from_text_google_async(input_text))
+
+
+async def generate_image_from_text_google_async(input_text: str) -> str:
+    model = "gemini-2.0-flash-exp-image-generation"
 
     # 日本語を英語に変換
     # english_txt = translate_text(text=input_text)
@@ -69,78 +99,87 @@ def generate_image_from_text_google(input_text: str) -> str:
 
     prompt = input_text
 
+    cached_path = get_cached_image("google", model, None, None, prompt)
+    if cached_path:
+        return cached_path
+
     print(SEP)
     print("Google Geminiで画像を生成中...")
     print(prompt)
-    base_delay = 1  # 初期待機秒数
-    max_delay = 3  # 最大待機秒数
-
-    for attempt in range(10):
-        try:
-            response = client.models.generate_content(
-                model="gemini-2.0-flash-exp-image-generation",
-                contents=prompt,
-                config=types.GenerateContentConfig(
-                    response_modalities=["Text", "Image"]
-                ),
-            )
-            # imgディレクトリがなければ作成
-            os.makedirs("img", exist_ok=True)
-            filename = datetime.now().strftime("%Y%m%d_%H%M%S_gemini.png")
-            filepath = os.path.join("img", filename)
-
-            for part in response.candidates[0].content.parts:
-                if hasattr(part, "text") and part.text is not None:
-                    print(part.text)
-                elif hasattr(part, "inline_data") and part.inline_data is not None:
-                    image = Image.open(BytesIO(part.inline_data.data))
-                    image.save(filepath)
-                    # image.show()
-                    print(f"画像を '{filepath}' に保存しました。")
-                    return filepath
-
-            raise Exception("画像データが見つかりませんでした。")
-        except Exception as e:
-            print(
-                f"[{attempt+1}/10] Google Geminiでの生成中にエラーが発生しました: {e}"
-            )
-            if attempt == 9:
-                print("最大リトライ回数に達しました。")
-                raise Exception("最大リトライ回数に達しました。")
-            else:
-                delay = min(base_delay * (2**attempt), max_delay)
-                print(f"{delay}秒待機してリトライします。")
-                time.sleep(delay)
-                continue
+
+    data, mime_type = await request_google_image(model, prompt)
+    put_cached_image("google", model, None, None, prompt, data)
+
+    # 受け取ったデータをデコードせずそのまま保存する
+    extension = IMAGE_EXTENSIONS.get(mime_type, ".png")
+    os.makedirs("img", exist_ok=True)
+    filename = datetime.now().strftime(f"%Y%m%d_%H%M%S_gemini{extension}")
+    filepath = os.path.join("img", filename)
+    with open(filepath, "wb") as f:
+        f.write(data)
+    print(f"画像を '{filepath}' に保存しました。")
+    return filepath
+
+
+@with_retry("gemini")
+async def request_google_image(model: str, prompt: str) -> tuple[bytes, str]:
+    """
+    Geminiで画像を生成し、画像データとMIMEタイプを返す
+    画像が含まれていない場合も再試行する
+    """
+    async with limit("gemini", model, estimate_tokens(prompt)):
+        response = await genai_aio_client().models.generate_content(
+            model=model,
+            contents=prompt,
+            config=types.GenerateContentConfig(response_modalities=["Text", "Image"]),
+        )
+    for part in response.candidates[0].content.parts:
+        if hasattr(part, "text") and part.text is not None:
+            print(part.text)
+        elif hasattr(part, "inline_data") and part.inline_data is not None:
+            return part.inline_data.data, part.inline_data.mime_type
+
+    raise RetryableError("画像データが見つかりませんでした。")
 
 
 def edit_image(input_text: str) -> str:
-    client = OpenAI()
+    """edit_image_async()の同期版 (CLI用)"""
+    return run_sync(edit_image_async(input_text))
 
-    english_keywords = translate_text(text=input_text)
-    prompt = english_keywords
+
+async def edit_image_async(input_text: str) -> str:
     model = "gpt-image-1"
     size = "1024x1024"
     # low 1.58 円, medium 6.03 円, high 23.98 円
     quality = "low"
 
-    result = client.images.edit(
+    # 翻訳前の文章をキーにして、翻訳の呼び出しも省略する
+    cached_path = get_cached_image("openai_edit", model, size, quality, input_text)
+    if cached_path:
+        return cached_path
+
+    # Amazon Translateには非同期のSDKが無いのでスレッドで実行する
+    english_keywords = await asyncio.to_thread(translate_text, text=input_text)
+    prompt = english_keywords
+
+    result = await request_openai_edit(
         model=model,
-        image=[
-            open(os.path.join("edit", "zundamon.png"), "rb"),
-        ],
+        image_path=os.path.join("edit", "zundamon.png"),
         prompt=prompt,
     )
 
     image_base64 = result.data[0].b64_json
     image_bytes = base64.b64decode(image_base64)
+    put_cached_image("openai_edit", model, size, quality, input_text, image_bytes)
 
     # Save the image to a file
+    os.makedirs("img", exist_ok=True)
     filename = datetime.now().strftime("%Y%m%d_%H%M%S_openai_edit.png")
     filepath = os.path.join("img", filename)
 
     with open(filepath, "wb") as f:
         f.write(image_bytes)
+    return filepath
 
 
 if __name__ == "__main__":
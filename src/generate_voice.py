@@ -1,107 +1,562 @@
+import asyncio
+import atexit
 import os
-from retry import retry
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
 import datetime
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
 import subprocess
 from dotenv import load_dotenv
 from icecream import ic
 
+from disk_cache import DiskCache, hash_key
+from pcm_audio import wav_to_pcm
+from resilience import ProviderStatusError, with_retry
+from tracing import span
+
 load_dotenv()
 
 SEP = "-" * 100
 SPEED_SCALE = 1.3
 VOICEVOX_EXE_PATH = os.environ.get("VOICEVOX_EXE_PATH")
+VOICEVOX_URL = os.environ.get("VOICEVOX_URL", "http://127.0.0.1:50021")
+# 最後の利用からエンジンを停止するまでの秒数
+VOICEVOX_IDLE_TIMEOUT = float(os.environ.get("VOICEVOX_IDLE_TIMEOUT", "300"))
+# 起動後、/versionが応答するまで待つ最大秒数
+VOICEVOX_STARTUP_TIMEOUT = float(os.environ.get("VOICEVOX_STARTUP_TIMEOUT", "60"))
+# 接続確立・音声合成それぞれの待ち時間上限(秒)
+VOICEVOX_CONNECT_TIMEOUT = 3
+VOICEVOX_READ_TIMEOUT = 60
+# Voicevoxへ同時に張るkeep-alive接続数
+VOICEVOX_MAX_CONNECTIONS = int(os.environ.get("VOICEVOX_MAX_CONNECTIONS", "4"))
+# 合成済み音声のキャッシュ
+VOICE_CACHE_DIR = os.environ.get("VOICE_CACHE_DIR", os.path.join("cache", "voice"))
+VOICE_CACHE_MAX_MB = int(os.environ.get("VOICE_CACHE_MAX_MB", "500"))
+# 最後に起動したエンジンのバージョン (エンジンを起動せずにキャッシュを引くために使う)
+VOICE_VERSION_PATH = f"{VOICE_CACHE_DIR}_engine_version.txt"
+FFMPEG_PATH = os.environ.get("FFMPEG_PATH", "ffmpg/ffmpeg.exe")
+# ブック保存用Opusのビットレート (音声のみなので低めで十分)
+OPUS_BITRATE = os.environ.get("OPUS_BITRATE", "32k")
 
 
-def start_voicevox_server():
-    """Voicevoxサーバーを起動する"""
-    print(SEP)
-    print("Voicevoxサーバーを起動します...")
-    try:
-        subprocess.Popen([VOICEVOX_EXE_PATH])
-        print("Voicevoxサーバーの起動が完了しました。")
-    except Exception as e:
-        print(f"Voicevoxサーバーの起動に失敗しました: {e}")
-    print(SEP)
+class VoicevoxEngine:
+    """
+    Voicevoxエンジンの常駐管理
 
+    初回利用時に一度だけ起動し、/versionが応答するまで待機する。
+    プロセスが落ちていた場合は再起動し、
+    idle_timeout秒使われなければ停止する。
+    """
 
-def stop_voicevox_server():
-    """Voicevoxサーバーを停止する"""
-    print(SEP)
-    print("Voicevoxサーバーを停止します...")
-    try:
-        subprocess.call(["taskkill", "/F", "/IM", "run.exe"])
-        print("Voicevoxサーバーの停止が完了しました。")
-    except Exception as e:
-        print(f"Voicevoxサーバーの停止に失敗しました: {e}")
-    print(SEP)
+    def __init__(
+        self,
+        exe_path: str | None,
+        base_url: str,
+        idle_timeout: float,
+        startup_timeout: float,
+    ):
+        self.exe_path = exe_path
+        self.base_url = base_url
+        self.idle_timeout = idle_timeout
+        self.startup_timeout = startup_timeout
+        self._process: subprocess.Popen | None = None
+        self._lock = threading.RLock()
+        self._idle_timer: threading.Timer | None = None
+        self._users = 0
+        self._external = False
+        # 自前で起動したエンジンが/versionに応答したか
+        self._ready = False
+        # 起動中エンジンのバージョン (キャッシュキーに使う)
+        self.version: str | None = None
+
+    def is_running(self) -> bool:
+        """自前で起動したプロセスが生きているか"""
+        return self._process is not None and self._process.poll() is None
+
+    def is_ready(self) -> bool:
+        """起動処理なしですぐに利用できるか (起動待ちの間はFalse)"""
+        return self._external or (self._ready and self.is_running())
+
+    def mark_unhealthy(self):
+        """接続に失敗したとき、次回利用時に起動確認をやり直させる"""
+        self._external = False
+        self._ready = False
+
+    def ensure_running(self):
+        """
+        エンジンが応答可能な状態にする
+        既に起動済みなら何もしない
+        """
+        with self._lock:
+            if self.is_ready():
+                return
+
+            if self._process is not None:
+                if self.is_running():
+                    if check_voicevox_server(self.base_url) == 200:
+                        self._ready = True
+                        return
+                    print("Voicevoxサーバーが応答しません。再起動します。")
+                else:
+                    print(
+                        f"Voicevoxサーバーが終了していました (returncode={self._process.returncode})。再起動します。"
+                    )
+                self.stop()
+
+            # 外部で起動済みのサーバー(docker等)があればそれを使う
+            if check_voicevox_server(self.base_url) == 200:
+                self._external = True
+                self.version = get_voicevox_version(self.base_url)
+                return
+
+            if not self.exe_path:
+                raise ConnectionError(
+                    f"Voicevoxサーバーに接続できず、VOICEVOX_EXE_PATHも未設定です ({self.base_url})"
+                )
+
+            self._start()
+
+    def _start(self):
+        print(SEP)
+        print("Voicevoxサーバーを起動します...")
+        self._process = subprocess.Popen([self.exe_path])
+
+        deadline = time.monotonic() + self.startup_timeout
+        while time.monotonic() < deadline:
+            if self._process.poll() is not None:
+                raise Exception(
+                    f"Voicevoxサーバーが起動直後に終了しました (returncode={self._process.returncode})"
+                )
+            if check_voicevox_server(self.base_url) == 200:
+                self.version = get_voicevox_version(self.base_url)
+                self._ready = True
+                print("Voicevoxサーバーの起動が完了しました。")
+                print(SEP)
+                return
+            time.sleep(0.5)
+
+        self.stop()
+        raise TimeoutError(
+            f"Voicevoxサーバーが{self.startup_timeout}秒以内に起動しませんでした"
+        )
+
+    def stop(self):
+        """自前で起動したエンジンを停止する"""
+        with self._lock:
+            process = self._detach()
+        self._terminate(process)
+
+    def _detach(self) -> subprocess.Popen | None:
+        """
+        停止するプロセスを管理対象から外す (ロックを持って呼ぶ)
+        終了待ちはロックの外で行い、その間に他の利用者を待たせない
+        """
+        self._cancel_idle_timer()
+        process, self._process = self._process, None
+        self._ready = False
+        return process
+
+    def _terminate(self, process: subprocess.Popen | None):
+        if process is None:
+            return
+
+        print(SEP)
+        print("Voicevoxサーバーを停止します...")
+        try:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            print("Voicevoxサーバーの停止が完了しました。")
+        except Exception as e:
+            print(f"Voicevoxサーバーの停止に失敗しました: {e}")
+        print(SEP)
+
+    def _acquire(self):
+        with self._lock:
+            self._cancel_idle_timer()
+            self.ensure_running()
+            self._users += 1
+
+    def _release(self):
+        with self._lock:
+            self._users -= 1
+            if self._users == 0:
+                self._schedule_idle_stop()
 
+    @contextmanager
+    def use(self):
+        """
+        エンジン利用区間
+        利用中はアイドル停止せず、最後の利用者が抜けたらタイマーを仕掛ける
+        """
+        self._acquire()
+        try:
+            yield self
+        finally:
+            self._release()
 
-def check_voicevox_server():
+    @asynccontextmanager
+    async def use_async(self):
+        """
+        use()の非同期版
+        起動待ちが必要な場合のみスレッドに逃がし、起動済みならイベントループ上で完結させる
+        """
+        if self.is_ready():
+            self._acquire()
+        else:
+            await asyncio.to_thread(self._acquire)
+        try:
+            yield self
+        finally:
+            self._release()
+
+    def _schedule_idle_stop(self):
+        if self._process is None or self.idle_timeout <= 0:
+            return
+        self._idle_timer = threading.Timer(self.idle_timeout, self._stop_if_idle)
+        self._idle_timer.daemon = True
+        self._idle_timer.start()
+
+    def _stop_if_idle(self):
+        with self._lock:
+            if self._users > 0 or self._process is None:
+                return
+            print(
+                f"Voicevoxサーバーが{self.idle_timeout}秒使われなかったため停止します"
+            )
+            process = self._detach()
+        self._terminate(process)
+
+    def _cancel_idle_timer(self):
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+
+
+def _create_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=VOICEVOX_MAX_CONNECTIONS)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# 起動確認用のkeep-alive接続プール (起動待ちはスレッドで行うので同期で呼ぶ)
+_session = _create_session()
+
+# 非同期処理用のセッション (イベントループごとに作成)
+_async_session: aiohttp.ClientSession | None = None
+# _async_sessionを作成したイベントループ
+_async_session_loop: asyncio.AbstractEventLoop | None = None
+
+
+def _get_async_session() -> aiohttp.ClientSession:
+    """
+    実行中のイベントループに紐づくaiohttpセッションを取得する
+    ループが変わっていたり閉じられていた場合は作り直す
+    """
+    global _async_session, _async_session_loop
+
+    loop = asyncio.get_running_loop()
+    if (
+        _async_session is None
+        or _async_session.closed
+        or _async_session_loop is not loop
+    ):
+        connector = aiohttp.TCPConnector(
+            limit=VOICEVOX_MAX_CONNECTIONS, keepalive_timeout=60
+        )
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=VOICEVOX_CONNECT_TIMEOUT, sock_read=VOICEVOX_READ_TIMEOUT
+        )
+        _async_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        _async_session_loop = loop
+    return _async_session
+
+
+async def close_async_session():
+    """非同期セッションを閉じる (ボット終了時に呼ぶ)"""
+    global _async_session, _async_session_loop
+    if _async_session is not None and not _async_session.closed:
+        await _async_session.close()
+    _async_session = None
+    _async_session_loop = None
+
+
+def check_voicevox_server(base_url: str = VOICEVOX_URL):
     """
     Voicevoxサーバーの起動確認を行い、HTTPステータスコードを返す
     接続できない場合は0を返す
     """
     try:
-        response = requests.get("http://127.0.0.1:50021/version")
+        response = _session.get(f"{base_url}/version", timeout=2)
         return response.status_code
     except requests.exceptions.RequestException:
         return 0
 
 
-@retry(tries=10)
-def synthesize_voice_with_timestamp(text, speaker=1):
+def get_voicevox_version(base_url: str = VOICEVOX_URL) -> str | None:
+    """
+    Voicevoxエンジンのバージョンを取得する
+    """
+    try:
+        response = _session.get(f"{base_url}/version", timeout=2)
+        if response.status_code == 200:
+            return response.text.strip().strip('"')
+    except requests.exceptions.RequestException:
+        pass
+    return None
+
+
+engine = VoicevoxEngine(
+    exe_path=VOICEVOX_EXE_PATH,
+    base_url=VOICEVOX_URL,
+    idle_timeout=VOICEVOX_IDLE_TIMEOUT,
+    startup_timeout=VOICEVOX_STARTUP_TIMEOUT,
+)
+atexit.register(engine.stop)
+
+voice_cache = DiskCache(
+    VOICE_CACHE_DIR, max_bytes=VOICE_CACHE_MAX_MB * 1024 * 1024, suffix=".wav"
+)
+
+
+# VOICE_VERSION_PATHに記録済みのバージョン
+_stored_version: str | None = None
+
+
+def cache_engine_version() -> str | None:
+    """
+    音声キャッシュのキーに使うエンジンのバージョン
+    エンジンが起動していない場合は、前回起動したときに記録したバージョンを使う
+    """
+    global _stored_version
+
+    if engine.version is not None:
+        if engine.version != _stored_version:
+            os.makedirs(os.path.dirname(VOICE_VERSION_PATH) or ".", exist_ok=True)
+            tmp_path = f"{VOICE_VERSION_PATH}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(engine.version)
+            os.replace(tmp_path, VOICE_VERSION_PATH)
+            _stored_version = engine.version
+        return engine.version
+
+    if _stored_version is None:
+        try:
+            with open(VOICE_VERSION_PATH, "r", encoding="utf-8") as f:
+                _stored_version = f.read().strip() or None
+        except FileNotFoundError:
+            pass
+    return _stored_version
+
+
+def voice_cache_key(text, speaker) -> str:
+    """
+    音声キャッシュのキー
+    話者・話速・エンジンのバージョンが変われば別の音声として扱う
+    """
+    return hash_key(text, speaker, SPEED_SCALE, cache_engine_version())
+
+
+def read_voice_cache(text, speaker) -> bytes | None:
+    """
+    キャッシュ済みの音声を取得する
+    一度もエンジンのバージョンを取得していない場合はキーが決まらないのでNone
+    """
+    if cache_engine_version() is None:
+        return None
+    cached = voice_cache.read(voice_cache_key(text, speaker))
+    if cached is not None:
+        print("キャッシュ済みの音声を使います")
+    return cached
+
+
+def save_wav(wav: bytes) -> str:
+    """
+    音声データをwavディレクトリに保存し、ファイルパスを返す
+    """
+    # 現在時刻を取得し、ファイル名を生成
+    # 並行して合成しても衝突しないようマイクロ秒まで含める
+    now = datetime.datetime.now()
+    filename = now.strftime("%Y%m%d_%H%M%S_%f") + ".wav"
+    # wavディレクトリがなければ作成
+    os.makedirs("wav", exist_ok=True)
+    filepath = f"wav/{filename}"
+
+    print("音声ファイルを保存中...")
+    with open(filepath, "wb") as f:
+        f.write(wav)
+    print(f"音声が {filepath} に保存されました。")
+    return filepath
+
+
+def synthesize_voice_with_timestamp(text, speaker=1) -> str | None:
+    """synthesize_voice_with_timestamp_async()の同期版 (CLI用)"""
+
+    async def run():
+        try:
+            return await synthesize_voice_with_timestamp_async(text, speaker)
+        finally:
+            await close_async_session()
+
+    return asyncio.run(run())
+
+
+@with_retry("voicevox")
+async def synthesize(text, speaker=1) -> bytes | None:
+    """
+    非同期で音声合成し、wavのバイト列を返す
+    audio_queryに失敗した場合はNoneを返す
+    """
     print(SEP)
     print(f"音声合成するテキスト: {text}")
 
-    start_voicevox_server()
+    session = _get_async_session()
 
-    try:
-        status_code = check_voicevox_server()
-        if status_code != 200:
-            raise Exception(
-                f"Voicevoxサーバーが起動していません (status_code={status_code})"
-            )
+    # エンジンが停止中でもキャッシュにあれば起動しない
+    cached = read_voice_cache(text, speaker)
+    if cached is not None:
+        return cached
 
-        # 現在時刻を取得し、ファイル名を生成
-        now = datetime.datetime.now()
-        filename = now.strftime("%Y%m%d_%H%M%S") + ".wav"
-        # wavディレクトリがなければ作成
-        os.makedirs("wav", exist_ok=True)
-        filepath = f"wav/{filename}"
+    async with engine.use_async():
+        cached = read_voice_cache(text, speaker)
+        if cached is not None:
+            return cached
+        cache_key = voice_cache_key(text, speaker)
 
         # 1. テキストから音声合成のためのクエリを作成
         print("音声合成クエリを作成中...")
         query_payload = {"text": text, "speaker": speaker}
-        query_response = requests.post(
-            "http://localhost:50021/audio_query", params=query_payload
-        )
-
-        if query_response.status_code != 200:
-            print(f"Error in audio_query: {query_response.text}")
-            return None
+        try:
+            async with session.post(
+                f"{VOICEVOX_URL}/audio_query", params=query_payload
+            ) as query_response:
+                if query_response.status != 200:
+                    print(f"Error in audio_query: {await query_response.text()}")
+                    return None
+                query = await query_response.json(content_type=None)
+        except aiohttp.ClientConnectionError:
+            engine.mark_unhealthy()
+            raise
 
         print("クエリ作成完了")
-        query = query_response.json()
         query["speedScale"] = SPEED_SCALE
 
         # 2. クエリを元に音声データを生成
         print("音声データを生成中...")
         synthesis_payload = {"speaker": speaker}
-        synthesis_response = requests.post(
-            "http://localhost:50021/synthesis", params=synthesis_payload, json=query
-        )
+        async with session.post(
+            f"{VOICEVOX_URL}/synthesis", params=synthesis_payload, json=query
+        ) as synthesis_response:
+            if synthesis_response.status != 200:
+                error_text = await synthesis_response.text()
+                print(f"Error in synthesis: {error_text}")
+                raise ProviderStatusError(
+                    f"Error in synthesis: {error_text}", synthesis_response.status
+                )
+            wav = await synthesis_response.read()
 
-        if synthesis_response.status_code == 200:
-            # 音声ファイルとして保存
-            print("音声ファイルを保存中...")
-            with open(filepath, "wb") as f:
-                f.write(synthesis_response.content)
-            print(f"音声が {filepath} に保存されました。")
-            return filepath
-        else:
-            print(f"Error in synthesis: {synthesis_response.text}")
-            raise Exception(f"Error in synthesis: {synthesis_response.text}")
+        voice_cache.put(cache_key, wav)
+        return wav
+
+
+async def synthesize_voice_with_timestamp_async(text, speaker=1) -> str | None:
+    """
+    synthesize_voice_with_timestamp()の非同期版
+    合成結果をwavディレクトリに保存し、ファイルパスを返す
+    """
+    wav = await synthesize(text, speaker)
+    if wav is None:
+        return None
+    return save_wav(wav)
+
+
+async def synthesize_pcm(text, speaker=1, persist=False) -> bytes | None:
+    """
+    音声合成し、Discordでそのまま再生できるPCMを返す (/talk用)
+    ファイルは書き出さずメモリ上で変換する。persist=Trueの場合のみwavも保存する
+    """
+    wav = await synthesize(text, speaker)
+    if wav is None:
+        return None
+    if persist:
+        save_wav(wav)
+    return await asyncio.to_thread(wav_to_pcm, wav)
+
+
+async def encode_opus(wav: bytes, filepath) -> str | None:
+    """
+    wavをDiscordでそのまま送れるOgg/Opus(48kHzステレオ・20msフレーム)に変換して保存する
+    再生時はFFmpegOpusAudio(codec="copy")で再エンコード無しに送信できる
+    """
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG_PATH,
+        "-y",
+        "-loglevel",
+        "error",
+        "-i",
+        "pipe:0",
+        "-ar",
+        "48000",
+        "-ac",
+        "2",
+        "-c:a",
+        "libopus",
+        "-b:a",
+        OPUS_BITRATE,
+        "-application",
+        "voip",
+        "-frame_duration",
+        "20",
+        "-f",
+        "ogg",
+        filepath,
+        stdin=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    _, stderr = await process.communicate(wav)
+    if process.returncode != 0:
+        print(f"Opusへの変換に失敗しました: {stderr.decode(errors='replace')}")
+        return None
+    return filepath
+
+
+async def synthesize_to_opus(text, filepath, speaker=1, wav_path=None) -> str | None:
+    """
+    音声合成してOgg/Opusで保存する (ブック保存用)
+    wav_pathを指定した場合はwavも保存する
+    Opusへの変換に失敗した場合は再生できるようwavを残し、そのパスを返す
+    """
+    with span("voicevox") as s:
+        wav = await synthesize(text, speaker)
+        if s and wav:
+            s.set(bytes=len(wav))
+    if wav is None:
+        return None
+    if wav_path:
+        with span("write_wav", bytes=len(wav)), open(wav_path, "wb") as f:
+            f.write(wav)
+
+    with span("encode_opus") as s:
+        try:
+            result_path = await encode_opus(wav, filepath)
+        except FileNotFoundError:
+            print(f"ffmpegが見つかりません: {FFMPEG_PATH}")
+            result_path = None
+        if s and result_path:
+            s.set(bytes=os.path.getsize(result_path))
+    if result_path:
+        return result_path
 
-    finally:
-        stop_voicevox_server()
+    fallback_path = wav_path or os.path.splitext(filepath)[0] + ".wav"
+    if not wav_path:
+        with span("write_wav", bytes=len(wav)), open(fallback_path, "wb") as f:
+            f.write(wav)
+    return fallback_path
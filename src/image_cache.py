@@ -0,0 +1,171 @@
+import json
+import os
+import shutil
+import threading
+import time
+from datetime import datetime
+
+from disk_cache import DiskCache, hash_key
+
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", os.path.join("cache", "image"))
+IMAGE_CACHE_MAX_MB = int(os.getenv("IMAGE_CACHE_MAX_MB", "2000"))
+# 最終利用からこの日数を過ぎた画像は削除する
+IMAGE_CACHE_MAX_AGE_DAYS = float(os.getenv("IMAGE_CACHE_MAX_AGE_DAYS", "90"))
+IMAGE_CACHE_ENABLED = os.getenv("IMAGE_CACHE_ENABLED", "1") != "0"
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    キャッシュキー用にプロンプトを正規化する
+    インデントや改行の違いだけのプロンプトは同じものとして扱う
+    """
+    return " ".join(prompt.split())
+
+
+# 先頭のバイト列から画像の形式を判定する (APIによってPNG以外を返すことがある)
+IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"GIF8", ".gif"),
+]
+
+
+def image_extension(data: bytes) -> str:
+    for signature, extension in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return extension
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return ".webp"
+    return ".png"
+
+
+class ImageCache:
+    """
+    プロンプトをキーにした生成画像のキャッシュ
+
+    画像本体はDiskCacheに画像の形式に合った拡張子で保存し、
+    どのプロンプトから生成したかをindex.jsonに記録する。
+    最終利用時刻は画像本体のmtimeで管理するので、ヒット時にindex.jsonは書き換えない。
+    """
+
+    def __init__(self, dir_path: str, max_bytes: int, max_age_days: float):
+        self.dir_path = dir_path
+        self.max_age_seconds = max_age_days * 24 * 60 * 60
+        self.index_path = os.path.join(dir_path, "index.json")
+        # 拡張子は画像ごとに異なるので、キーに含めて保存する
+        self.blobs = DiskCache(os.path.join(dir_path, "blobs"), max_bytes=max_bytes)
+        self._lock = threading.Lock()
+        self._index: dict[str, dict] | None = None
+
+    @staticmethod
+    def make_key(provider, model, size, quality, prompt) -> str:
+        return hash_key(provider, model, size, quality, normalize_prompt(prompt))
+
+    def get(self, provider, model, size, quality, prompt) -> str | None:
+        """
+        キャッシュ済み画像のパスを返す。無ければNone
+        """
+        key = self.make_key(provider, model, size, quality, prompt)
+        with self._lock:
+            index = self._load_index()
+            if key not in index:
+                return None
+
+            # 拡張子を記録する前のキャッシュはPNGで保存されている
+            path = self.blobs.get(self._blob_key(key, index[key]))
+            if path is None:
+                # 容量超過で本体が削除済み
+                del index[key]
+                self._save_index()
+            return path
+
+    def put(self, provider, model, size, quality, prompt, data: bytes) -> str:
+        """
+        生成した画像を保存し、保存先のパスを返す
+        """
+        key = self.make_key(provider, model, size, quality, prompt)
+        entry = {
+            "provider": provider,
+            "model": model,
+            "size": size,
+            "quality": quality,
+            "prompt": normalize_prompt(prompt),
+            "extension": image_extension(data),
+            "bytes": len(data),
+            "created_at": time.time(),
+        }
+        path = self.blobs.put(self._blob_key(key, entry), data)
+        with self._lock:
+            index = self._load_index()
+            index[key] = entry
+            self._prune(index)
+            self._save_index()
+        return path
+
+    def prune(self):
+        """
+        期限切れの画像と、本体が削除済みのインデックスを掃除する
+        """
+        with self._lock:
+            self._prune(self._load_index())
+            self._save_index()
+
+    def _prune(self, index: dict[str, dict]):
+        self.blobs.clear_older_than(self.max_age_seconds)
+        for key, entry in list(index.items()):
+            if not os.path.exists(self.blobs.path_for(self._blob_key(key, entry))):
+                del index[key]
+
+    @staticmethod
+    def _blob_key(key: str, entry: dict) -> str:
+        return key + entry.get("extension", ".png")
+
+    def _load_index(self) -> dict[str, dict]:
+        if self._index is None:
+            try:
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    self._index = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                self._index = {}
+        return self._index
+
+    def _save_index(self):
+        os.makedirs(self.dir_path, exist_ok=True)
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._index, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+
+image_cache = ImageCache(
+    IMAGE_CACHE_DIR,
+    max_bytes=IMAGE_CACHE_MAX_MB * 1024 * 1024,
+    max_age_days=IMAGE_CACHE_MAX_AGE_DAYS,
+)
+
+
+def get_cached_image(provider, model, size, quality, prompt) -> str | None:
+    """
+    キャッシュにあれば、img/ にコピーしてそのパスを返す
+    呼び出し元が生成結果を移動してもキャッシュ本体が残るようにコピーする
+    """
+    if not IMAGE_CACHE_ENABLED:
+        return None
+
+    cached_path = image_cache.get(provider, model, size, quality, prompt)
+    if cached_path is None:
+        return None
+
+    os.makedirs("img", exist_ok=True)
+    extension = os.path.splitext(cached_path)[1]
+    filename = datetime.now().strftime(f"%Y%m%d_%H%M%S_%f_{provider}_cache{extension}")
+    filepath = os.path.join("img", filename)
+    shutil.copyfile(cached_path, filepath)
+    print(f"キャッシュ済みの画像を使います: '{filepath}'")
+    return filepath
+
+
+def put_cached_image(provider, model, size, quality, prompt, data: bytes):
+    if not IMAGE_CACHE_ENABLED:
+        return
+    image_cache.put(provider, model, size, quality, prompt, data)
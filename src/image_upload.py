@@ -0,0 +1,56 @@
+import io
+import os
+
+from PIL import Image
+
+from book_manifest import file_sha256
+from disk_cache import DiskCache, hash_key
+
+# Discordへ送る画像の形式 (webp, jpeg, original: 変換しない)
+UPLOAD_IMAGE_FORMAT = os.getenv("UPLOAD_IMAGE_FORMAT", "webp")
+UPLOAD_IMAGE_QUALITY = int(os.getenv("UPLOAD_IMAGE_QUALITY", "85"))
+UPLOAD_CACHE_DIR = os.getenv("UPLOAD_CACHE_DIR", os.path.join("cache", "upload"))
+UPLOAD_CACHE_MAX_MB = int(os.getenv("UPLOAD_CACHE_MAX_MB", "500"))
+
+UPLOAD_FORMATS = {"webp": ("WEBP", ".webp"), "jpeg": ("JPEG", ".jpg")}
+
+upload_cache = DiskCache(UPLOAD_CACHE_DIR, max_bytes=UPLOAD_CACHE_MAX_MB * 1024 * 1024)
+
+
+def encode_for_upload(data: bytes, image_format: str, quality: int) -> bytes:
+    image = Image.open(io.BytesIO(data))
+    if image_format == "JPEG" and image.mode != "RGB":
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format, quality=quality)
+    return buffer.getvalue()
+
+
+def upload_image_path(path: str, sha256: str | None = None) -> str:
+    """
+    Discordへ送る用に圧縮した画像のパスを返す
+    元の画像はそのまま残し、変換結果は内容のハッシュをキーにキャッシュする
+    変換しても小さくならない場合は元の画像のパスを返す
+    """
+    if UPLOAD_IMAGE_FORMAT not in UPLOAD_FORMATS:
+        return path
+    image_format, suffix = UPLOAD_FORMATS[UPLOAD_IMAGE_FORMAT]
+
+    key = hash_key(sha256 or file_sha256(path), image_format, UPLOAD_IMAGE_QUALITY)
+    cached_path = upload_cache.get(key + suffix)
+    if cached_path is not None:
+        return cached_path
+
+    with open(path, "rb") as f:
+        data = f.read()
+    try:
+        encoded = encode_for_upload(data, image_format, UPLOAD_IMAGE_QUALITY)
+    except OSError as e:
+        print(f"画像の変換に失敗しました: {path} {e}")
+        return path
+
+    if len(encoded) >= len(data):
+        return path
+
+    print(f"送信用に画像を変換しました: {len(data)} -> {len(encoded)} bytes")
+    return upload_cache.put(key + suffix, encoded)
@@ -0,0 +1,181 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import List, Optional
+
+import discord
+from pydantic import BaseModel, Field
+
+from image_upload import upload_image_path
+
+# Discordの1メッセージの上限
+MAX_MESSAGE_CHARS = 2000
+MAX_MESSAGE_FILES = 10
+# 再生中の段落から何段落先までテキストと画像を先に送るか
+LOAD_SEND_AHEAD = int(os.getenv("LOAD_SEND_AHEAD", "3"))
+# チャンネルごとの送信数の上限 (Discordのレート制限より少し控えめにする)
+CHANNEL_RATE_LIMIT = 5
+CHANNEL_RATE_PERIOD = 5.5
+
+
+class OutgoingParagraph(BaseModel):
+    text: Optional[str] = None
+    images: List[str] = Field(default_factory=list)
+    # 画像のパス -> manifestに記録済みのsha256 (送信用の変換でハッシュを取り直さないため)
+    image_sha256: dict[str, str] = Field(default_factory=dict)
+
+
+class OutgoingMessage(BaseModel):
+    content: str = ""
+    images: List[str] = Field(default_factory=list)
+
+
+def pack_messages(
+    paragraphs: List[OutgoingParagraph],
+    max_chars: int = MAX_MESSAGE_CHARS,
+    max_files: int = MAX_MESSAGE_FILES,
+) -> List[OutgoingMessage]:
+    """
+    連続する段落を、文字数と添付数の上限に収まるメッセージにまとめる
+    本文と画像はそれぞれの上限を超えるまで同じメッセージに足していく
+    (画像は本文の後に付くので、1通の中では本文の後に段落順で並ぶ)
+    段落の順番は変えない。上限を超える長さの段落は分割する
+    """
+    messages: List[OutgoingMessage] = []
+    current = OutgoingMessage()
+
+    def flush():
+        nonlocal current
+        if current.content or current.images:
+            messages.append(current)
+        current = OutgoingMessage()
+
+    for paragraph in paragraphs:
+        # 段落の本文と画像はなるべく同じメッセージに入れる
+        if current.images and len(current.images) + len(paragraph.images) > max_files:
+            flush()
+
+        text = paragraph.text or ""
+        pieces = [text[i : i + max_chars] for i in range(0, len(text), max_chars)]
+        for piece in pieces:
+            joined = f"{current.content}\n\n{piece}" if current.content else piece
+            if len(joined) > max_chars:
+                flush()
+                joined = piece
+            current.content = joined
+
+        for image in paragraph.images:
+            if len(current.images) >= max_files:
+                flush()
+            current.images.append(image)
+
+    flush()
+    return messages
+
+
+class ChannelRateLimiter:
+    """
+    period秒あたりlimit回までに送信を抑える
+
+    Discord側でレート制限にかかると、ライブラリが待機する間
+    後続の送信がすべて止まるため、手前で間隔を空ける。
+    """
+
+    def __init__(self, limit: int, period: float):
+        self.limit = limit
+        self.period = period
+        self._sent: deque[float] = deque()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            now = time.monotonic()
+            while self._sent and now - self._sent[0] >= self.period:
+                self._sent.popleft()
+            if len(self._sent) >= self.limit:
+                await asyncio.sleep(self.period - (now - self._sent[0]))
+                self._sent.popleft()
+            self._sent.append(time.monotonic())
+
+
+rate_limiters: dict[int, ChannelRateLimiter] = {}
+
+
+def get_rate_limiter(channel_id: int) -> ChannelRateLimiter:
+    if channel_id not in rate_limiters:
+        rate_limiters[channel_id] = ChannelRateLimiter(
+            CHANNEL_RATE_LIMIT, CHANNEL_RATE_PERIOD
+        )
+    return rate_limiters[channel_id]
+
+
+class BookSender:
+    """
+    /loadの段落のテキストと画像を、音声の再生より先にまとめて送る
+
+    再生中の段落からwindow段落先までを送信対象とし、
+    その範囲の未送信の段落をpack_messages()でまとめて送る。
+    送信は別タスクで行うので、送信待ちで音声の再生が止まることは無い。
+    """
+
+    def __init__(
+        self,
+        channel: discord.abc.Messageable,
+        paragraphs: List[OutgoingParagraph],
+        window: int = LOAD_SEND_AHEAD,
+    ):
+        self.channel = channel
+        self.paragraphs = paragraphs
+        self.window = max(window, 1)
+        self._image_sha256 = {
+            path: sha256 for p in paragraphs for path, sha256 in p.image_sha256.items()
+        }
+        self._limiter = get_rate_limiter(channel.id)
+        self._sent = 0  # 送信済みの段落数
+        self._allowed = self.window  # この段落数まで送ってよい
+        self._changed = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def advance(self, index: int):
+        """段落indexの再生が始まった"""
+        self._allowed = max(self._allowed, index + self.window)
+        self._changed.set()
+
+    async def finish(self):
+        """残りの段落を全て送り終わるまで待つ"""
+        self.advance(len(self.paragraphs))
+        if self._task is not None:
+            await self._task
+
+    def cancel(self):
+        """/clearで取り消された場合、残りの段落は送らない"""
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        while self._sent < len(self.paragraphs):
+            end = min(self._allowed, len(self.paragraphs))
+            if self._sent >= end:
+                self._changed.clear()
+                await self._changed.wait()
+                continue
+
+            messages = pack_messages(self.paragraphs[self._sent : end])
+            self._sent = end
+            for outgoing in messages:
+                # 送信用に圧縮した画像を送る (変換済みならキャッシュを使う)
+                upload_paths = [
+                    await asyncio.to_thread(
+                        upload_image_path, path, self._image_sha256.get(path)
+                    )
+                    for path in outgoing.images
+                ]
+                await self._limiter.acquire()
+                await self.channel.send(
+                    content=outgoing.content or None,
+                    files=[discord.File(path) for path in upload_paths],
+                )
@@ -0,0 +1,85 @@
+import io
+import sys
+import wave
+from array import array
+
+import discord
+
+# Discordの音声はステレオ・16bit・48kHzのPCM
+DISCORD_SAMPLE_RATE = 48000
+DISCORD_CHANNELS = 2
+# 20ms分のバイト数 (discord.PCMAudioはこの単位で読み出す)
+FRAME_SIZE = DISCORD_SAMPLE_RATE // 50 * DISCORD_CHANNELS * 2
+
+
+def _resample(samples: array, rate: int) -> array:
+    """
+    1チャンネル分のサンプルを48kHzに変換する
+    48kHzの約数(Voicevoxの24kHzなど)は線形補間、それ以外は最近傍で変換する
+    """
+    if rate == DISCORD_SAMPLE_RATE or not samples:
+        return samples
+
+    if DISCORD_SAMPLE_RATE % rate == 0:
+        factor = DISCORD_SAMPLE_RATE // rate
+        next_samples = samples[1:] + samples[-1:]
+        out = array("h", bytes(2 * len(samples) * factor))
+        out[0::factor] = samples
+        for j in range(1, factor):
+            out[j::factor] = array(
+                "h",
+                [a + (b - a) * j // factor for a, b in zip(samples, next_samples)],
+            )
+        return out
+
+    n_out = len(samples) * DISCORD_SAMPLE_RATE // rate
+    return array("h", [samples[i * rate // DISCORD_SAMPLE_RATE] for i in range(n_out)])
+
+
+def wav_to_pcm(wav: bytes) -> bytes:
+    """
+    wavのバイト列をDiscordでそのまま再生できるPCMに変換する
+    ffmpegを使わずメモリ上で変換するので、ファイルを書き出す必要が無い
+    """
+    with wave.open(io.BytesIO(wav)) as w:
+        channels = w.getnchannels()
+        sample_width = w.getsampwidth()
+        rate = w.getframerate()
+        frames = w.readframes(w.getnframes())
+
+    if sample_width != 2 or channels not in (1, 2):
+        raise ValueError(
+            f"対応していないwav形式です: {channels}ch, {sample_width * 8}bit"
+        )
+
+    samples = array("h")
+    samples.frombytes(frames)
+    # wavはリトルエンディアン
+    if sys.byteorder == "big":
+        samples.byteswap()
+
+    if channels == 1:
+        left = right = _resample(samples, rate)
+    else:
+        left = _resample(samples[0::2], rate)
+        right = _resample(samples[1::2], rate)
+
+    out = array("h", bytes(4 * len(left)))
+    out[0::2] = left
+    out[1::2] = right
+    if sys.byteorder == "big":
+        out.byteswap()
+
+    pcm = out.tobytes()
+    # 最後の半端なフレームが捨てられないよう無音で埋める
+    remainder = len(pcm) % FRAME_SIZE
+    if remainder:
+        pcm += bytes(FRAME_SIZE - remainder)
+    return pcm
+
+
+def pcm_source(pcm: bytes) -> discord.AudioSource:
+    """
+    wav_to_pcm()で変換したPCMを再生する音声ソースを作成する
+    """
+    return discord.PCMAudio(io.BytesIO(pcm))
@@ -0,0 +1,214 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Callable
+
+from pydantic import BaseModel
+
+
+class LimitConfig(BaseModel):
+    """1分あたりのリクエスト数・トークン数と同時実行数の上限 (0は無制限)"""
+
+    rpm: int = 0
+    tpm: int = 0
+    max_in_flight: int = 0
+
+
+# プロバイダごとの既定値。モデルごとに別々に数える
+DEFAULT_LIMITS = {
+    "gemini": LimitConfig(rpm=60, tpm=1_000_000, max_in_flight=4),
+    "openai": LimitConfig(rpm=5, max_in_flight=2),
+}
+# 例: RATE_LIMITS='{"gemini/gemini-2.5-flash": {"rpm": 10, "tpm": 250000}}'
+RATE_LIMITS = json.loads(os.getenv("RATE_LIMITS", "{}"))
+# 応答として見込むトークン数 (リクエスト時点では分からないため)
+EXPECTED_OUTPUT_TOKENS = 1000
+
+
+def estimate_tokens(prompt: str) -> int:
+    """
+    プロンプトのトークン数の見積もり
+    日本語はおおむね1文字1トークン程度なので文字数を使う
+    """
+    return len(prompt) + EXPECTED_OUTPUT_TOKENS
+
+
+class TokenBucket:
+    """
+    1分あたりper_minuteまで使えるバケット
+
+    使う分を先に差し引き(不足分は借りる)、補充されるまでの待ち時間を返す。
+    先に予約した呼び出しから順に使えるので、待ちが長くなっても順番が入れ替わらない。
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: int) -> float:
+        if self.capacity <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= min(amount, self.capacity)
+        return max(0.0, -self.level / self.rate)
+
+    def refund(self, amount: int):
+        """reserve()で差し引いた分を戻す (使わずに終わった呼び出し用)"""
+        if self.capacity <= 0:
+            return
+        self.level = min(self.capacity, self.level + min(amount, self.capacity))
+
+
+class InFlightGate:
+    """
+    同時実行数の上限
+
+    複数のイベントループから使えるよう、threading.Lockで管理し、
+    空きが出たら待っている呼び出しを1件ずつ起こす。
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._waiters: deque[Callable[[], None]] = deque()
+
+    def _try_enter(self) -> bool:
+        if self.limit <= 0 or self.in_flight < self.limit:
+            self.in_flight += 1
+            return True
+        return False
+
+    async def enter_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            future = loop.create_future()
+
+            def wake():
+                loop.call_soon_threadsafe(
+                    lambda: future.done() or future.set_result(None)
+                )
+
+            with self._lock:
+                if self._try_enter():
+                    return
+                self._waiters.append(wake)
+            try:
+                await future
+            except asyncio.CancelledError:
+                with self._lock:
+                    if wake in self._waiters:
+                        self._waiters.remove(wake)
+                        raise
+                # 起こされた後にキャンセルされた場合は、次の呼び出しに譲る
+                self._wake_next()
+                raise
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._wake_next()
+
+    def _wake_next(self):
+        with self._lock:
+            wake = self._waiters.popleft() if self._waiters else None
+        if wake:
+            wake()
+
+
+class ProviderLimiter:
+    """
+    プロバイダ・モデルごとの呼び出し制限
+
+    リクエスト数とトークン数はTokenBucket、同時実行数はInFlightGateで制限する。
+    """
+
+    def __init__(self, name: str, config: LimitConfig):
+        self.name = name
+        self.config = config
+        self._requests = TokenBucket(config.rpm)
+        self._tokens = TokenBucket(config.tpm)
+        self._gate = InFlightGate(config.max_in_flight)
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.total_requests = 0
+
+    def _reserve(self, tokens: int) -> float:
+        with self._lock:
+            self.waiting += 1
+            return max(self._requests.reserve(1), self._tokens.reserve(tokens))
+
+    def _entered(self):
+        with self._lock:
+            self.waiting -= 1
+            self.total_requests += 1
+
+    def _cancelled(self, tokens: int):
+        # 呼び出さずに終わったので、予約した分を後の呼び出しに戻す
+        with self._lock:
+            self.waiting -= 1
+            self._requests.refund(1)
+            self._tokens.refund(tokens)
+
+    @asynccontextmanager
+    async def acquire(self, tokens: int = 0):
+        delay = self._reserve(tokens)
+        try:
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self._gate.enter_async()
+        except BaseException:
+            self._cancelled(tokens)
+            raise
+        self._entered()
+        try:
+            yield
+        finally:
+            self._gate.leave()
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "waiting": self.waiting,
+                "in_flight": self._gate.in_flight,
+                "total_requests": self.total_requests,
+                **self.config.model_dump(),
+            }
+
+
+limiters: dict[str, ProviderLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(provider: str, model: str) -> ProviderLimiter:
+    name = f"{provider}/{model}"
+    with _limiters_lock:
+        if name not in limiters:
+            config = DEFAULT_LIMITS.get(provider, LimitConfig())
+            if name in RATE_LIMITS:
+                config = config.model_copy(update=RATE_LIMITS[name])
+            limiters[name] = ProviderLimiter(name, config)
+        return limiters[name]
+
+
+def limit(provider: str, model: str, tokens: int = 0):
+    """
+    呼び出し前に枠を確保する
+    async with limit("gemini", model, estimate_tokens(prompt)): ...
+    """
+    return get_limiter(provider, model).acquire(tokens)
+
+
+def limiter_status() -> dict[str, dict]:
+    """全プロバイダ・モデルの待ち件数と実行中の件数 (監視用)"""
+    with _limiters_lock:
+        items = list(limiters.items())
+    return {name: limiter.status() for name, limiter in items}
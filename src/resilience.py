@@ -0,0 +1,332 @@
+import asyncio
+import functools
+import inspect
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable
+
+import aiohttp
+import botocore.exceptions
+import httpx
+import openai
+import requests
+
+from tracing import record_retry
+
+# 再試行の既定値 (全プロバイダ共通)
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "5"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "1"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "20"))
+# 連続でこの回数失敗したら、CIRCUIT_RESET_TIMEOUT秒は呼び出さずに失敗させる
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+
+# 400番台のうち、時間をおけば成功する可能性があるので再試行するHTTPステータス
+# (それ以外の認証エラーや不正なリクエストは再試行しても結果が変わらない)
+RETRYABLE_CLIENT_ERRORS = (408, 429)
+# 通信・タイムアウトの失敗 (各SDKが独自の例外で送出する)
+NETWORK_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    aiohttp.ClientConnectionError,
+    aiohttp.ClientPayloadError,
+    httpx.TransportError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    openai.APIConnectionError,
+    botocore.exceptions.HTTPClientError,
+)
+# AWSは混雑時に400番台とこのエラーコードを返す
+THROTTLING_ERROR_CODES = (
+    "Throttling",
+    "ThrottlingException",
+    "TooManyRequestsException",
+)
+
+
+class RetryableError(Exception):
+    """応答はあったが一時的な失敗と分かるもの (画像が含まれていない等)。再試行する"""
+
+
+class ProviderStatusError(Exception):
+    """HTTPステータス付きの失敗 (ステータスで再試行するかを判定する)"""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class CircuitOpenError(Exception):
+    """プロバイダが停止中と判断され、呼び出しを行わなかった"""
+
+    def __init__(self, provider: str, retry_in: float):
+        super().__init__(
+            f"{provider} は停止中のため呼び出しを中止しました ({retry_in:.0f}秒後に再開)"
+        )
+        self.provider = provider
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    プロバイダごとのサーキットブレーカー
+
+    closed: 通常どおり呼び出す
+    open: 連続失敗がしきい値に達した。reset_timeout秒は呼び出さずに失敗させる
+    half_open: reset_timeoutが経過した。1件だけ試し、成功すればclosedに戻す
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        self._trial_started = 0.0
+        self.total_failures = 0
+        self.total_rejected = 0
+        self.last_error: str | None = None
+
+    def before_call(self):
+        with self._lock:
+            if self._state == "closed":
+                return
+            now = time.monotonic()
+            elapsed = now - self._opened_at
+            if self._state == "open" and elapsed >= self.reset_timeout:
+                self._state = "half_open"
+            # 試しの呼び出しがキャンセル等で結果を残さなかった場合も、時間が経てば再度試す
+            trial_stalled = now - self._trial_started >= self.reset_timeout
+            if self._state == "half_open" and (
+                not self._trial_running or trial_stalled
+            ):
+                self._trial_running = True
+                self._trial_started = now
+                return
+            self.total_rejected += 1
+            raise CircuitOpenError(self.name, max(self.reset_timeout - elapsed, 0))
+
+    def is_open(self) -> bool:
+        with self._lock:
+            return self._state == "open"
+
+    def record_success(self):
+        with self._lock:
+            self._state = "closed"
+            self._failures = 0
+            self._trial_running = False
+
+    def record_ignored(self):
+        """プロバイダの状態が分からない失敗。試しの呼び出しだけを終わらせる"""
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self, error: BaseException):
+        with self._lock:
+            self._failures += 1
+            self.total_failures += 1
+            self.last_error = f"{type(error).__name__}: {error}"[:200]
+            self._trial_running = False
+            if self._state == "half_open" or self._failures >= self.failure_threshold:
+                if self._state != "open":
+                    print(f"{self.name} を停止中と判断しました: {self.last_error}")
+                self._state = "open"
+                self._opened_at = time.monotonic()
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "state": self._state,
+                "consecutive_failures": self._failures,
+                "total_failures": self.total_failures,
+                "total_rejected": self.total_rejected,
+                "last_error": self.last_error,
+            }
+
+
+breakers: dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(provider: str) -> CircuitBreaker:
+    with _breakers_lock:
+        if provider not in breakers:
+            breakers[provider] = CircuitBreaker(
+                provider, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT
+            )
+        return breakers[provider]
+
+
+def breaker_status() -> dict[str, dict]:
+    """全プロバイダのサーキットブレーカーの状態 (監視用)"""
+    with _breakers_lock:
+        items = list(breakers.items())
+    return {name: breaker.status() for name, breaker in items}
+
+
+def status_code(error: BaseException) -> int | None:
+    """各SDKの例外からHTTPステータスを取り出す"""
+    for attr in ("status_code", "status", "code"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(error, "response", None)
+    if isinstance(response, dict):
+        # botocoreのClientError
+        value = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    else:
+        value = getattr(response, "status_code", None) or getattr(
+            response, "status", None
+        )
+    return value if isinstance(value, int) else None
+
+
+def is_throttled(error: BaseException) -> bool:
+    response = getattr(error, "response", None)
+    if not isinstance(response, dict):
+        return False
+    return response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES
+
+
+def retry_after(error: BaseException) -> float | None:
+    """
+    Retry-Afterヘッダで指定された待ち時間(秒)
+    秒数と日時のどちらの形式にも対応する
+    """
+    headers = getattr(error, "headers", None)
+    if headers is None:
+        headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    通信・タイムアウトの失敗、429/408、500番台だけを再試行する
+    プログラムの誤りや応答の形式の誤り(ValidationError等)は再試行しない
+    """
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, (RetryableError, *NETWORK_ERRORS)) or is_throttled(error):
+        return True
+    code = status_code(error)
+    if code is None:
+        return False
+    return code in RETRYABLE_CLIENT_ERRORS or 500 <= code < 600
+
+
+def is_provider_response(error: BaseException) -> bool:
+    """プロバイダが応答したうえでの失敗か (不正なリクエスト等)"""
+    return status_code(error) is not None
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float) -> float:
+    """
+    指数バックオフ (full jitter)
+    複数の呼び出しが同じタイミングで再試行しないよう、0から上限までの乱数にする
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2**attempt))
+
+
+def with_retry(
+    provider: str,
+    max_attempts: int = RETRY_MAX_ATTEMPTS,
+    base_delay: float = RETRY_BASE_DELAY,
+    max_delay: float = RETRY_MAX_DELAY,
+) -> Callable:
+    """
+    プロバイダ呼び出しの再試行デコレータ
+
+    失敗時は指数バックオフ(ジッター付き)で待って再試行する。
+    Retry-Afterが返された場合はその時間だけ待つ。
+    プロバイダが停止中と判断された場合は呼び出さずにCircuitOpenErrorを送出する。
+    async関数はasyncio.sleepで待つのでイベントループを止めない。
+    同期関数(スレッドで実行されるもの)はtime.sleepで待つ。
+    """
+    breaker = get_breaker(provider)
+
+    def delay_for(error: BaseException, attempt: int) -> float | None:
+        if not is_retryable(error) or attempt + 1 >= max_attempts:
+            return None
+        # 停止中と判断した時点で再試行をやめ、元のエラーを返す
+        if breaker.is_open():
+            return None
+        delay = retry_after(error)
+        if delay is None:
+            delay = backoff_delay(attempt, base_delay, max_delay)
+        print(
+            f"[{provider}][{attempt + 1}/{max_attempts}] {error} "
+            f"{delay:.1f}秒後に再試行します"
+        )
+        record_retry()
+        return delay
+
+    def record_error(error: BaseException):
+        if isinstance(error, CircuitOpenError):
+            return
+        if is_retryable(error):
+            breaker.record_failure(error)
+        elif is_provider_response(error):
+            # 不正なリクエストなどはプロバイダが応答しているので停止とは数えない
+            breaker.record_success()
+        else:
+            # プログラムの誤りなどはプロバイダの状態と無関係なので記録しない
+            breaker.record_ignored()
+
+    def decorator(func: Callable) -> Callable:
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs) -> Any:
+                for attempt in range(max_attempts):
+                    breaker.before_call()
+                    try:
+                        result = await func(*args, **kwargs)
+                    except Exception as e:
+                        record_error(e)
+                        delay = delay_for(e, attempt)
+                        if delay is None:
+                            raise
+                        await asyncio.sleep(delay)
+                    else:
+                        breaker.record_success()
+                        return result
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs) -> Any:
+            for attempt in range(max_attempts):
+                breaker.before_call()
+                try:
+                    result = func(*args, **kwargs)
+                except Exception as e:
+                    record_error(e)
+                    delay = delay_for(e, attempt)
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
+                else:
+                    breaker.record_success()
+                    return result
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,303 @@
+import argparse
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterator, Optional
+
+from pydantic import BaseModel
+
+SEP = "-" * 100
+
+# 処理時間の記録 (JSON lines) の保存先。TRACE_ENABLED=1の場合のみ記録する
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "0") == "1"
+TRACE_DIR = os.getenv("TRACE_DIR", "trace")
+
+
+class Span:
+    """
+    1つの処理の記録
+
+    attrsには段落番号(paragraph)、扱ったバイト数(bytes)などを入れる。
+    再試行の回数はresilience.with_retryがrecord_retry()で加算する。
+    """
+
+    def __init__(self, tracer: "Tracer", name: str, parent_id: Optional[str], attrs):
+        self.tracer = tracer
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attrs = attrs
+        self.retries = 0
+        self.error: Optional[str] = None
+        self.start = time.perf_counter()
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_record(self, end: float) -> dict:
+        return {
+            "trace_id": self.tracer.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": round(self.start - self.tracer.start, 6),
+            "duration": round(end - self.start, 6),
+            "retries": self.retries,
+            "error": self.error,
+            **self.attrs,
+        }
+
+
+class Tracer:
+    """
+    spanをJSON linesでファイルへ書き出す
+    spanはイベントループとスレッドの両方から終了するのでロックして書く
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.start = time.perf_counter()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(path, "w", encoding="utf-8")
+
+    def write(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+# 実行中のtracerとspan。asyncioのタスクやto_threadのスレッドにも引き継がれる
+_tracer: contextvars.ContextVar[Optional[Tracer]] = contextvars.ContextVar(
+    "tracer", default=None
+)
+_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar(
+    "span", default=None
+)
+
+
+def trace_path(name: str) -> str:
+    filename = datetime.now().strftime(f"%Y%m%d_%H%M%S_{name}.jsonl")
+    return os.path.join(TRACE_DIR, filename)
+
+
+@contextmanager
+def start_trace(name: str, **attrs) -> Iterator[Optional[Span]]:
+    """
+    記録を開始し、全体を表すspanを返す
+    TRACE_ENABLEDが無効の場合は何も記録しない
+    """
+    if not TRACE_ENABLED:
+        yield None
+        return
+    tracer = Tracer(trace_path(name))
+    token = _tracer.set(tracer)
+    try:
+        with span(name, **attrs) as root:
+            yield root
+    finally:
+        _tracer.reset(token)
+        tracer.close()
+
+
+@contextmanager
+def span(name: str, **attrs) -> Iterator[Optional[Span]]:
+    """
+    処理時間を記録する
+    start_trace()の外で呼ばれた場合は何もしない
+    with span("generate_image", paragraph=i) as s:
+        ...
+        if s: s.set(bytes=size)
+    """
+    tracer = _tracer.get()
+    if tracer is None:
+        yield None
+        return
+    parent = _span.get()
+    current = Span(tracer, name, parent.span_id if parent else None, attrs)
+    token = _span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"[:200]
+        raise
+    finally:
+        _span.reset(token)
+        tracer.write(current.to_record(time.perf_counter()))
+
+
+def record_retry():
+    """実行中のspanの再試行回数を加算する"""
+    current = _span.get()
+    if current is not None:
+        current.retries += 1
+
+
+class SpanRecord(BaseModel):
+    span_id: str
+    parent_id: Optional[str] = None
+    name: str
+    start: float
+    duration: float
+    retries: int = 0
+    error: Optional[str] = None
+    paragraph: Optional[int] = None
+    chunk: Optional[int] = None
+    bytes: Optional[int] = None
+
+    @property
+    def end(self) -> float:
+        return self.start + self.duration
+
+
+class StageSummary(BaseModel):
+    """
+    処理ごとの集計
+    busyは同時に実行された区間の重なりを除いた時間
+    """
+
+    name: str
+    count: int
+    total: float
+    busy: float
+    max: float
+    bytes: int
+    retries: int
+    errors: int
+
+
+def load_trace(path: str) -> list[SpanRecord]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [SpanRecord.model_validate_json(line) for line in f if line.strip()]
+
+
+def busy_time(spans: list[SpanRecord]) -> float:
+    total = 0.0
+    current_start = current_end = None
+    for s in sorted(spans, key=lambda s: s.start):
+        if current_end is None or s.start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = s.start, s.end
+        else:
+            current_end = max(current_end, s.end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+
+def stage_breakdown(spans: list[SpanRecord]) -> list[StageSummary]:
+    stages: dict[str, list[SpanRecord]] = defaultdict(list)
+    for s in spans:
+        stages[s.name].append(s)
+    summaries = [
+        StageSummary(
+            name=name,
+            count=len(items),
+            total=sum(s.duration for s in items),
+            busy=busy_time(items),
+            max=max(s.duration for s in items),
+            bytes=sum(s.bytes or 0 for s in items),
+            retries=sum(s.retries for s in items),
+            errors=sum(1 for s in items if s.error),
+        )
+        for name, items in stages.items()
+    ]
+    return sorted(summaries, key=lambda s: s.busy, reverse=True)
+
+
+def critical_path(spans: list[SpanRecord]) -> list[tuple[int, SpanRecord]]:
+    """
+    全体の完了時刻を決めた処理の連なりを (深さ, span) の一覧で返す
+
+    親spanの終了時刻から遡り、その時点までに最後に終わった子spanを選ぶ。
+    選んだ子の開始時刻より前に終わった子を同様に選び、子の中も同じように辿る。
+    同時に実行された処理の区別がつかない場合は同じ段落の処理を優先する。
+    """
+    children: dict[Optional[str], list[SpanRecord]] = defaultdict(list)
+    for s in spans:
+        children[s.parent_id].append(s)
+    epsilon = 0.01
+
+    def walk(parent: SpanRecord, depth: int) -> list[tuple[int, SpanRecord]]:
+        chosen: list[SpanRecord] = []
+        cursor = parent.end
+        while True:
+            candidates = [
+                s for s in children[parent.span_id] if s.end <= cursor + epsilon
+            ]
+            if chosen:
+                candidates = [s for s in candidates if s.start < chosen[-1].start]
+            if not candidates:
+                break
+            # 直前で終わった処理のうち、同じ段落のものを優先する (段落内の処理は順番に実行される)
+            paragraph = chosen[-1].paragraph if chosen else None
+            adjacent = [
+                s
+                for s in candidates
+                if paragraph is not None
+                and s.paragraph == paragraph
+                and s.end >= cursor - epsilon
+            ]
+            child = max(adjacent or candidates, key=lambda s: s.end)
+            chosen.append(child)
+            cursor = child.start
+        path = [(depth, parent)]
+        for child in reversed(chosen):
+            path.extend(walk(child, depth + 1))
+        return path
+
+    roots = children[None]
+    if not roots:
+        return []
+    return walk(max(roots, key=lambda s: s.duration), 0)
+
+
+def format_summary(spans: list[SpanRecord]) -> str:
+    lines = [SEP, "処理ごとの内訳 (実時間は同時に実行された区間の重なりを除く)"]
+    lines.append(
+        f"{'処理':<24}{'件数':>6}{'実時間':>10}{'合計':>10}{'最大':>9}"
+        f"{'バイト':>12}{'再試行':>6}{'失敗':>5}"
+    )
+    for s in stage_breakdown(spans):
+        lines.append(
+            f"{s.name:<24}{s.count:>6}{s.busy:>10.2f}{s.total:>10.2f}{s.max:>9.2f}"
+            f"{s.bytes:>12}{s.retries:>6}{s.errors:>5}"
+        )
+    lines += [SEP, "クリティカルパス"]
+    for depth, s in critical_path(spans):
+        label = s.name
+        if s.paragraph is not None:
+            label += (
+                f"[{s.paragraph}]" if s.chunk is None else f"[{s.paragraph}/{s.chunk}]"
+            )
+        retries = f" 再試行{s.retries}" if s.retries else ""
+        lines.append(
+            f"{'  ' * depth}{label} {s.start:.2f}s〜{s.end:.2f}s "
+            f"({s.duration:.2f}秒){retries}"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="処理時間の記録を集計し、処理ごとの内訳とクリティカルパスを表示します。"
+    )
+    parser.add_argument("trace_file", help="集計する記録 (trace/*.jsonl) のパス")
+    args = parser.parse_args()
+    print(format_summary(load_trace(args.trace_file)))
+
+
+if __name__ == "__main__":
+    main()
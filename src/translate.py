@@ -1,12 +1,5 @@
-import boto3
-import os
-from dotenv import load_dotenv
-
-load_dotenv()
-
-AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY")
-AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET")
-AWS_REGION_NAME = os.getenv("AWS_REGION")
+from clients import translate_client
+from resilience import with_retry
 
 
 def translate_text(text, source_language_code="ja", target_language_code="en"):
@@ -22,24 +15,26 @@ def translate_text(text, source_language_code="ja", target_language_code="en"):
         str: 翻訳されたテキスト。エラーが発生した場合はNone。
     """
     try:
-        translate = boto3.client(
-            service_name="translate",
-            region_name=AWS_REGION_NAME,
-            aws_access_key_id=AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-            use_ssl=True,
-        )
-        result = translate.translate_text(
-            Text=text,
-            SourceLanguageCode=source_language_code,
-            TargetLanguageCode=target_language_code,
-        )
-        return result.get("TranslatedText")
+        return request_translation(text, source_language_code, target_language_code)
     except Exception as e:
         print(f"Error during translation: {e}")
         return None
 
 
+@with_retry("translate")
+def request_translation(text, source_language_code, target_language_code):
+    """
+    Amazon Translateの呼び出し (スレッドで実行されるので同期で再試行する)
+    """
+    translate = translate_client()
+    result = translate.translate_text(
+        Text=text,
+        SourceLanguageCode=source_language_code,
+        TargetLanguageCode=target_language_code,
+    )
+    return result.get("TranslatedText")
+
+
 if __name__ == "__main__":
     text_to_translate = "こんにちは、世界！"
     translated_text = translate_text(text_to_translate)
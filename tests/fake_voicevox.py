@@ -0,0 +1,53 @@
+"""
+テスト用の偽のVoicevoxエンジン (/version, /audio_query, /synthesisに応答する)
+
+FAKE_VOICEVOX_PORT: 待ち受けるポート
+FAKE_VOICEVOX_DELAY: 応答を始めるまでの秒数 (起動に時間がかかる様子を再現する)
+"""
+
+import os
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+VERSION = b'"0.0.0-fake"'
+AUDIO_QUERY = b'{"speedScale": 1.0}'
+WAV = b"RIFF-fake-wav"
+
+
+class Handler(BaseHTTPRequestHandler):
+    # パスごとの受け付けた件数 (テストで同じプロセスに立てた場合に確認する)
+    requests: dict[str, int] = {}
+
+    def _respond(self, body: bytes, content_type: str):
+        path = self.path.split("?")[0]
+        Handler.requests[path] = Handler.requests.get(path, 0) + 1
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/version":
+            self.send_error(404)
+            return
+        self._respond(VERSION, "application/json")
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = self.path.split("?")[0]
+        if path == "/audio_query":
+            self._respond(AUDIO_QUERY, "application/json")
+        elif path == "/synthesis":
+            self._respond(WAV, "audio/wav")
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    time.sleep(float(os.environ.get("FAKE_VOICEVOX_DELAY", "0")))
+    port = int(os.environ["FAKE_VOICEVOX_PORT"])
+    HTTPServer(("127.0.0.1", port), Handler).serve_forever()
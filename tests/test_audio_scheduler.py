@@ -0,0 +1,114 @@
+import asyncio
+
+from audio_scheduler import GuildAudioScheduler
+
+
+class FakeVoiceClient:
+    """play()で渡された音声を記録し、少し待ってafterを呼ぶ"""
+
+    def __init__(self):
+        self.played = []
+        self._stopped = None
+
+    def play(self, source, after):
+        self.played.append(source)
+        loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+
+        async def finish():
+            try:
+                await asyncio.wait_for(self._stopped.wait(), 0.01)
+            except asyncio.TimeoutError:
+                pass
+            after(None)
+
+        loop.create_task(finish())
+
+    def stop(self):
+        self._stopped.set()
+
+
+def test_play_in_enqueue_order():
+    """積んだ順に再生され、全て再生し終わるとFutureが完了すること"""
+
+    async def run():
+        # Arrange
+        scheduler = GuildAudioScheduler(1)
+        voice_client = FakeVoiceClient()
+
+        async def connect():
+            return voice_client
+
+        # Act
+        futures = [scheduler.enqueue(str(i), lambda i=i: i, connect) for i in range(3)]
+        await asyncio.gather(*futures)
+        return voice_client.played, scheduler.status()
+
+    played, status = asyncio.run(run())
+
+    # Assert
+    assert played == [0, 1, 2]
+    assert status == {"playing": None, "queued": []}
+
+
+def test_clear_finishes_queued_items():
+    """clear()で再生待ちが取り消され、そのFutureも完了すること"""
+
+    async def run():
+        # Arrange
+        scheduler = GuildAudioScheduler(1)
+        voice_client = FakeVoiceClient()
+
+        async def connect():
+            return voice_client
+
+        futures = [scheduler.enqueue(str(i), lambda i=i: i, connect) for i in range(3)]
+        await asyncio.sleep(0)
+
+        # Act
+        count = scheduler.clear()
+        await asyncio.wait_for(asyncio.gather(*futures), 1)
+        return count, voice_client.played
+
+    count, played = asyncio.run(run())
+
+    # Assert
+    assert count == 2
+    assert played == [0]
+
+
+def test_clear_cancels_session():
+    """
+    clear()で音声を積んでいる途中のsessionと、順番待ちのsessionがキャンセルされること
+    clear()の後に始めたsessionは最後まで再生されること
+    """
+
+    async def run():
+        # Arrange
+        scheduler = GuildAudioScheduler(1)
+        voice_client = FakeVoiceClient()
+
+        async def connect():
+            return voice_client
+
+        async def produce(name):
+            async with scheduler.session():
+                for i in range(3):
+                    await scheduler.enqueue(name, lambda i=i: (name, i), connect)
+
+        first = asyncio.create_task(produce("a"))
+        second = asyncio.create_task(produce("b"))
+        await asyncio.sleep(0.005)
+
+        # Act
+        scheduler.clear()
+        await asyncio.gather(first, second, return_exceptions=True)
+        await asyncio.wait_for(produce("c"), 1)
+        return first.cancelled(), second.cancelled(), voice_client.played
+
+    first_cancelled, second_cancelled, played = asyncio.run(run())
+
+    # Assert
+    assert first_cancelled
+    assert second_cancelled
+    assert played == [("a", 0), ("c", 0), ("c", 1), ("c", 2)]
@@ -0,0 +1,48 @@
+import os
+
+import book_audio
+from book_audio import BookStream, PacketLoader, book_audio_files
+
+
+def test_book_audio_files_order(tmp_path):
+    """番号順に並び、同じ番号ならOpusが優先されること"""
+    # Arrange
+    for name in ["10.opus", "2.opus", "1.wav", "2.wav", "target.txt", "0.opus"]:
+        (tmp_path / name).write_bytes(b"")
+
+    # Act
+    files = book_audio_files(str(tmp_path))
+
+    # Assert
+    assert [os.path.basename(f) for f in files] == [
+        "0.opus",
+        "1.wav",
+        "2.opus",
+        "10.opus",
+    ]
+
+
+def test_book_stream_reads_paragraphs_in_order(monkeypatch):
+    """段落の順にパケットを返し、段落の開始を通知して次の段落を先読みすること"""
+    # Arrange
+    loaded = []
+
+    def fake_load(filepaths, pause_ms):
+        loaded.append(filepaths)
+        return [f.encode() for f in filepaths] + [b"-"] * (pause_ms // 20)
+
+    monkeypatch.setattr(book_audio, "load_paragraph_packets", fake_load)
+    loader = PacketLoader([["a", "b"], [], ["c"]], pause_ms=20)
+    started = []
+    stream = BookStream(loader, [0, 1, 2], started.append)
+
+    # Act
+    packets = []
+    while packet := stream.read():
+        packets.append(packet)
+    loader.close()
+
+    # Assert
+    assert packets == [b"a", b"b", b"-", b"-", b"c", b"-"]
+    assert started == [0, 1, 2]
+    assert loaded == [["a", "b"], [], ["c"]]
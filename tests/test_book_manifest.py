@@ -0,0 +1,99 @@
+import wave
+
+import pytest
+
+import book_manifest
+
+
+def write_wav(path, seconds: float, rate=24000):
+    with wave.open(str(path), "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(bytes(int(rate * seconds) * 2))
+
+
+def make_book(root, title: str, paragraphs: int):
+    for i in range(paragraphs):
+        path = root / "book" / title / str(i)
+        path.mkdir(parents=True)
+        (path / "target.txt").write_text(f"段落{i}", encoding="utf-8")
+        write_wav(path / "0.wav", 1.0)
+        write_wav(path / "1.wav", 0.5)
+
+
+def test_save_manifest_and_catalog(tmp_path, monkeypatch):
+    """manifestに段落・音声の長さが記録され、カタログにも反映されること"""
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    make_book(tmp_path, "本A", 2)
+
+    # Act
+    manifest = book_manifest.save_manifest("本A")
+    catalog = book_manifest.load_catalog()
+
+    # Assert
+    assert [p.index for p in manifest.paragraphs] == [0, 1]
+    assert [a.path.replace("\\", "/") for a in manifest.paragraphs[0].audio] == [
+        "0/0.wav",
+        "0/1.wav",
+    ]
+    assert manifest.duration == 3.0
+    assert (tmp_path / "book" / "本A" / "manifest.json").exists()
+    assert catalog.books["本A"].paragraphs == 2
+
+
+def test_load_catalog_migrates_old_books(tmp_path, monkeypatch):
+    """カタログもmanifestも無いブックは、初回に走査して作成されること"""
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    make_book(tmp_path, "本A", 1)
+    make_book(tmp_path, "本B", 3)
+
+    # Act
+    catalog = book_manifest.load_catalog()
+
+    # Assert
+    assert sorted(catalog.books) == ["本A", "本B"]
+    assert catalog.books["本B"].paragraphs == 3
+    assert (tmp_path / "book" / "本B" / "manifest.json").exists()
+    assert book_manifest.load_manifest("無い本") is None
+
+
+def test_save_manifest_migrates_catalog(tmp_path, monkeypatch):
+    """カタログが無い状態でブックを保存すると、既存のブックもカタログに載ること"""
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    make_book(tmp_path, "old", 1)
+    make_book(tmp_path, "new", 2)
+
+    # Act
+    book_manifest.save_manifest("new")
+    catalog = book_manifest.load_catalog()
+
+    # Assert
+    assert sorted(catalog.books) == ["new", "old"]
+    assert catalog.books["old"].paragraphs == 1
+    assert (tmp_path / "book" / "old" / "manifest.json").exists()
+
+
+def test_invalid_title(tmp_path, monkeypatch):
+    """bookフォルダの外を指すタイトルは読み込まず、manifestもカタログも作らないこと"""
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    make_book(tmp_path, "本A", 1)
+
+    # Act
+    results = [
+        book_manifest.load_manifest(title)
+        for title in ["..", ".", "", "本A/0", "../book/本A", "本A\\0"]
+    ]
+    catalog = book_manifest.load_catalog()
+
+    # Assert
+    assert results == [None] * 6
+    assert not (tmp_path / "manifest.json").exists()
+    assert not (tmp_path / "book" / "manifest.json").exists()
+    assert list(catalog.books) == ["本A"]
+    with pytest.raises(ValueError):
+        book_manifest.book_path("..")
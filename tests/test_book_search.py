@@ -0,0 +1,120 @@
+import book_manifest
+import book_search
+from book_search import SearchIndex, bigrams, normalize_text
+
+
+def make_book(root, title: str, texts: list[str]):
+    for i, text in enumerate(texts):
+        path = root / "book" / title / str(i)
+        path.mkdir(parents=True, exist_ok=True)
+        (path / "target.txt").write_text(text, encoding="utf-8")
+    return book_manifest.save_manifest(title)
+
+
+def test_bigrams():
+    """空白や全角・半角の違いを無くしてバイグラムにすること"""
+    # Arrange & Act
+    grams = bigrams(normalize_text("ＡＢ c"))
+
+    # Assert
+    assert grams == {"ab", "bc"}
+
+
+def test_search_by_bigrams(tmp_path, monkeypatch):
+    """全てのバイグラムを含む段落だけが見つかること"""
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    index = SearchIndex(str(tmp_path / "index.json"))
+    index.index_book(make_book(tmp_path, "本A", ["魔法使いの森", "静かな湖"]))
+    index.index_book(make_book(tmp_path, "本B", ["森の魔法"]))
+
+    # Act & Assert
+    assert index.search("魔法") == {"本A": [0], "本B": [0]}
+    assert index.search("魔法使い") == {"本A": [0]}
+    assert index.search("湖") == {"本A": [1]}
+    assert index.search("火山") == {}
+
+
+def test_reindex_replaces_book(tmp_path, monkeypatch):
+    """本文が変わったブックは古い内容で見つからなくなり、ファイルから読み直せること"""
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / "index.json")
+    index = SearchIndex(path)
+    index.index_book(make_book(tmp_path, "本A", ["魔法使いの森"]))
+
+    # Act
+    index.index_book(make_book(tmp_path, "本A", ["静かな湖"]))
+
+    # Assert
+    reloaded = SearchIndex(path)
+    assert reloaded.search("魔法") == {}
+    assert reloaded.search("静か") == {"本A": [0]}
+
+
+def test_search_books_verifies_text(tmp_path, monkeypatch):
+    """バイグラムが揃っていても、本文に続けて含まれない段落は除かれること"""
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(
+        book_search, "search_index", SearchIndex(str(tmp_path / "index.json"))
+    )
+    make_book(tmp_path, "本A", ["あいう", "あい・いう"])
+
+    # Act
+    hits = book_search.search_books("あいう")
+
+    # Assert
+    assert [(hit.title, hit.paragraphs) for hit in hits] == [("本A", [0])]
+    assert "あいう" in hits[0].snippet
+
+
+def test_search_books_ranks_before_limit(tmp_path, monkeypatch):
+    """本文で確認した一致段落の数で順位を付けてから、件数を絞ること"""
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(
+        book_search, "search_index", SearchIndex(str(tmp_path / "index.json"))
+    )
+    # 本Aは候補の段落が多いが、続けて含むのは1段落だけ
+    make_book(tmp_path, "本A", ["あいう", "あい・いう", "いう・あい"])
+    make_book(tmp_path, "本B", ["あいう", "あいうえ"])
+
+    # Act
+    hits = book_search.search_books("あいう", limit=1)
+
+    # Assert
+    assert [(hit.title, hit.paragraphs) for hit in hits] == [("本B", [0, 1])]
+
+
+def test_make_snippet_uses_normalized_query():
+    """空白などを除いたクエリの長さで、一致箇所の前後を切り出すこと"""
+    # Arrange
+    text = "あ" * 30 + "魔法使い" + "い" * 30
+
+    # Act
+    snippet = book_search.make_snippet(text, "魔 法 使 い")
+
+    # Assert
+    assert snippet == "…" + "あ" * 20 + "魔法使い" + "い" * 20 + "…"
+
+
+def test_corrupt_index_is_rebuilt(tmp_path, monkeypatch):
+    """インデックスが壊れている場合は、カタログの全ブックから作り直すこと"""
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    path = tmp_path / "index.json"
+    make_book(tmp_path, "本A", ["魔法使いの森"])
+    make_book(tmp_path, "本B", ["森の魔法"])
+    path.write_text("{", encoding="utf-8")
+    index = SearchIndex(str(path))
+
+    # Act
+    index.index_book(make_book(tmp_path, "本C", ["魔法の湖"]))
+
+    # Assert
+    assert SearchIndex(str(path)).search("魔法") == {
+        "本A": [0],
+        "本B": [0],
+        "本C": [0],
+    }
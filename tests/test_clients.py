@@ -0,0 +1,76 @@
+import threading
+
+import clients
+from clients import ClientRegistry
+
+
+class FakeClient:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_client_is_created_once():
+    """複数スレッドから呼んでもクライアントは1回だけ作成されること"""
+    # Arrange
+    registry = ClientRegistry()
+    created = []
+
+    def factory():
+        created.append(FakeClient())
+        return created[-1]
+
+    registry.register("fake", factory)
+    results = []
+
+    # Act
+    threads = [
+        threading.Thread(target=lambda: results.append(registry.get("fake")))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Assert
+    assert len(created) == 1
+    assert all(client is created[0] for client in results)
+
+
+def test_override_and_close_all():
+    """差し替えたクライアントが返り、close_all()で閉じられること"""
+    # Arrange
+    registry = ClientRegistry()
+    registry.register("fake", FakeClient)
+    fake = FakeClient()
+
+    # Act
+    registry.override("fake", fake)
+    client = registry.get("fake")
+    registry.close_all()
+
+    # Assert
+    assert client is fake
+    assert fake.closed
+    assert registry.get("fake") is not fake
+
+
+def test_run_sync_closes_loop_clients(monkeypatch):
+    """run_sync()で作成した非同期クライアントが終了時に閉じられること"""
+    # Arrange
+    registry = ClientRegistry()
+    registry.register("fake", FakeClient, per_loop=True)
+    monkeypatch.setattr(clients, "registry", registry)
+
+    async def work():
+        return registry.get("fake")
+
+    # Act
+    client = clients.run_sync(work())
+
+    # Assert
+    assert client.closed
+    assert registry._clients == {}
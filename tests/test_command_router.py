@@ -0,0 +1,141 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from command_router import CommandRouter, LatencyHistogram
+
+
+def make_router():
+    router = CommandRouter()
+    calls = []
+
+    @router.command("/talk", "音声で再生します。", "[テキスト]")
+    async def talk(message):
+        calls.append(("talk", message.content))
+
+    @router.command("/skip", "次へ進みます。", exact=True)
+    async def skip(message):
+        calls.append(("skip", message.content))
+
+    @router.command("/fail", "失敗します。")
+    async def fail(message):
+        raise RuntimeError("fail")
+
+    @router.command("@bot", "会話します。", match=False)
+    async def mention(message):
+        calls.append(("mention", message.content))
+
+    return router, calls
+
+
+def dispatch(router, content):
+    return asyncio.run(router.dispatch(SimpleNamespace(content=content)))
+
+
+def test_dispatch_by_command_name():
+    """コマンド名でハンドラを選び、引数が続けて書かれていても実行すること"""
+    # Arrange
+    router, calls = make_router()
+
+    # Act
+    results = [
+        dispatch(router, "/talk こんにちは"),
+        dispatch(router, "/talkこんにちは"),
+        dispatch(router, "/skip"),
+    ]
+
+    # Assert
+    assert results == [True, True, True]
+    assert calls == [
+        ("talk", "/talk こんにちは"),
+        ("talk", "/talkこんにちは"),
+        ("skip", "/skip"),
+    ]
+
+
+def test_dispatch_not_matched():
+    """登録されていないコマンド、引数付きのexactコマンド、match=Falseのコマンドは実行しないこと"""
+    # Arrange
+    router, calls = make_router()
+
+    # Act
+    results = [
+        dispatch(router, "/unknown"),
+        dispatch(router, "/skip 2"),
+        dispatch(router, "/talking"),
+        dispatch(router, "@bot"),
+        dispatch(router, "こんにちは"),
+    ]
+
+    # Assert
+    assert results == [False] * 5
+    assert calls == []
+
+
+def test_stats():
+    """コマンドごとに実行回数・エラー数・処理時間を記録すること"""
+    # Arrange
+    router, _ = make_router()
+
+    # Act
+    dispatch(router, "/talk a")
+    dispatch(router, "/talk b")
+    with pytest.raises(RuntimeError):
+        dispatch(router, "/fail")
+    asyncio.run(router.invoke("@bot", SimpleNamespace(content="hi")))
+    stats = router.stats()
+
+    # Assert
+    assert set(stats) == {"/talk", "/fail", "@bot"}
+    assert stats["/talk"]["count"] == 2
+    assert stats["/talk"]["errors"] == 0
+    assert stats["/fail"]["count"] == 1
+    assert stats["/fail"]["errors"] == 1
+    assert sum(stats["/talk"]["histogram"].values()) == 2
+
+
+def test_help_text():
+    """登録順にコマンド一覧を作ること"""
+    # Arrange
+    router, _ = make_router()
+
+    # Act
+    text = router.help_text()
+
+    # Assert
+    assert text.splitlines()[2:] == [
+        "`/talk [テキスト]`: 音声で再生します。",
+        "`/skip`: 次へ進みます。",
+        "`/fail`: 失敗します。",
+        "`@bot`: 会話します。",
+    ]
+
+
+def test_duplicate_command():
+    """同じ名前のコマンドは登録できないこと"""
+    # Arrange
+    router, _ = make_router()
+
+    # Act / Assert
+    with pytest.raises(ValueError):
+
+        @router.command("/talk", "重複")
+        async def talk(message):
+            pass
+
+
+def test_latency_percentile():
+    """パーセンタイルを区間の上限で返すこと"""
+    # Arrange
+    histogram = LatencyHistogram(buckets=(0.1, 1, 10))
+
+    # Act
+    for seconds in [0.05] * 90 + [0.5] * 5 + [20] * 5:
+        histogram.record(seconds)
+
+    # Assert
+    assert histogram.percentile(0.5) == 0.1
+    assert histogram.percentile(0.95) == 1
+    assert histogram.percentile(0.99) == 20
+    assert histogram.max == 20
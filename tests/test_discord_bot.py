@@ -0,0 +1,133 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import discord_bot
+from audio_scheduler import get_scheduler
+from book_manifest import BookManifest, ParagraphEntry
+from message_sender import OutgoingParagraph
+
+
+class FakeVoiceClient:
+    """play()で渡された音声を記録し、少し待ってafterを呼ぶ"""
+
+    def __init__(self):
+        self.played = []
+        self._stopped = None
+
+    def play(self, source, after):
+        self.played.append(source)
+        loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+
+        async def finish():
+            try:
+                await asyncio.wait_for(self._stopped.wait(), 0.05)
+            except asyncio.TimeoutError:
+                pass
+            after(None)
+
+        loop.create_task(finish())
+
+    def stop(self):
+        self._stopped.set()
+
+
+class FakeChannel:
+    def __init__(self):
+        self.id = 1
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append(content)
+
+
+class FakeLoader:
+    def __init__(self, paragraph_files, pause_ms):
+        self.paragraph_files = paragraph_files
+
+    def __len__(self):
+        return len(self.paragraph_files)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def voice_client(monkeypatch):
+    voice_client = FakeVoiceClient()
+    manifest = BookManifest(
+        title="テスト",
+        updated_at=0,
+        duration=0,
+        paragraphs=[ParagraphEntry(index=i, text=f"{i}.txt") for i in range(3)],
+    )
+
+    async def get_voice_client(message):
+        return voice_client
+
+    monkeypatch.setattr(discord_bot.book_manifest, "load_manifest", lambda t: manifest)
+    monkeypatch.setattr(
+        discord_bot,
+        "read_outgoing_paragraphs",
+        lambda d, ps: [OutgoingParagraph(text=f"段落{p.index}") for p in ps],
+    )
+    monkeypatch.setattr(discord_bot, "PacketLoader", FakeLoader)
+    monkeypatch.setattr(discord_bot, "BookStream", lambda loader, indices: indices)
+    monkeypatch.setattr(discord_bot, "get_voice_client", get_voice_client)
+    monkeypatch.setattr(discord_bot, "LOAD_PLAYBACK", "paragraph")
+    return voice_client
+
+
+def test_clear_stops_load(voice_client):
+    """/loadの再生中に/clearすると、残りの段落は再生も送信もされないこと"""
+
+    async def run():
+        # Arrange
+        channel = FakeChannel()
+        guild = SimpleNamespace(id=1001)
+        author = SimpleNamespace(voice=SimpleNamespace(channel=object()))
+        load = SimpleNamespace(
+            content="/load テスト", channel=channel, author=author, guild=guild
+        )
+        clear = SimpleNamespace(content="/clear", channel=channel, guild=guild)
+        task = asyncio.create_task(discord_bot.handle_load(load))
+        while not voice_client.played:
+            await asyncio.sleep(0.001)
+
+        # Act
+        await discord_bot.handle_clear(clear)
+        await asyncio.gather(task, return_exceptions=True)
+        await asyncio.sleep(0.1)
+        return task.cancelled(), channel.sent, get_scheduler(guild.id).status()
+
+    cancelled, sent, status = asyncio.run(run())
+
+    # Assert
+    assert cancelled
+    assert voice_client.played == [[0]]
+    assert "おしまいにゃ。" not in sent
+    assert status == {"playing": None, "queued": []}
+
+
+def test_close_releases_clients(monkeypatch):
+    """ボットの終了時に非同期クライアントとVOICEVOXのセッションを閉じること"""
+    # Arrange
+    closed = []
+
+    async def aclose_loop():
+        closed.append("clients")
+
+    async def close_async_session():
+        closed.append("voicevox")
+
+    monkeypatch.setattr(discord_bot.clients.registry, "aclose_loop", aclose_loop)
+    monkeypatch.setattr(discord_bot.gv, "close_async_session", close_async_session)
+    client = discord_bot.BotClient(intents=discord_bot.intents)
+
+    # Act
+    asyncio.run(client.close())
+
+    # Assert
+    assert closed == ["clients", "voicevox"]
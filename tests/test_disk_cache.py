@@ -0,0 +1,52 @@
+import os
+
+from disk_cache import DiskCache, hash_key
+
+
+def test_hash_key_is_stable():
+    """同じ引数なら同じキー、どれか一つでも違えば別のキーになること"""
+    # Arrange & Act
+    key1 = hash_key("こんにちは", 1, 1.3, "0.14.0")
+    key2 = hash_key("こんにちは", 1, 1.3, "0.14.0")
+    key3 = hash_key("こんにちは", 2, 1.3, "0.14.0")
+
+    # Assert
+    assert key1 == key2
+    assert key1 != key3
+
+
+def test_put_and_read(tmp_path):
+    """保存したデータが読み出せること"""
+    # Arrange
+    cache = DiskCache(str(tmp_path), max_bytes=1024, suffix=".wav")
+    key = hash_key("a")
+
+    # Act
+    path = cache.put(key, b"data")
+
+    # Assert
+    assert path.endswith(".wav")
+    assert cache.read(key) == b"data"
+    assert cache.read(hash_key("b")) is None
+
+
+def test_evict_least_recently_used(tmp_path):
+    """上限を超えたら最後に使われたのが古いものから削除されること"""
+    # Arrange
+    cache = DiskCache(str(tmp_path), max_bytes=10)
+    keys = [hash_key(i) for i in range(3)]
+    for i, key in enumerate(keys[:2]):
+        path = cache.put(key, b"x" * 4)
+        os.utime(path, (i, i))
+
+    # keys[0]を使うと、keys[1]の方が古くなる
+    cache.get(keys[0])
+
+    # Act
+    cache.put(keys[2], b"x" * 4)
+
+    # Assert
+    assert cache.read(keys[0]) is not None
+    assert cache.read(keys[1]) is None
+    assert cache.read(keys[2]) is not None
+    assert cache.total_bytes() <= 10
@@ -0,0 +1,399 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import generate_book as book
+
+
+def test_split_scene_batches_within_limit():
+    """上限以内なら1リクエストにまとまること"""
+    # Arrange
+    paragraphs = ["あ" * 100] * 5
+
+    # Act
+    result = book.split_scene_batches(paragraphs, max_chars=1000)
+
+    # Assert
+    assert result == [(0, 5)]
+
+
+def test_split_scene_batches_over_limit():
+    """上限を超える場合は段落の境界で分割されること"""
+    # Arrange
+    paragraphs = ["あ" * 400] * 5
+
+    # Act
+    result = book.split_scene_batches(paragraphs, max_chars=1000)
+
+    # Assert
+    assert result == [(0, 2), (2, 4), (4, 5)]
+
+
+def test_split_scene_batches_long_paragraph():
+    """1段落で上限を超える場合はその段落だけで1リクエストになること"""
+    # Arrange
+    paragraphs = ["あ" * 100, "い" * 2000, "う" * 100]
+
+    # Act
+    result = book.split_scene_batches(paragraphs, max_chars=1000)
+
+    # Assert
+    assert result == [(0, 1), (1, 2), (2, 3)]
+
+
+def test_split_scene_batches_empty():
+    """段落が無い場合は空になること"""
+    # Act & Assert
+    assert book.split_scene_batches([], max_chars=1000) == []
+
+
+def test_context_builder_full():
+    """fullでは前の全段落が文脈になること"""
+    # Arrange
+    builder = book.ContextBuilder(["あ", "い", "う", "え"], strategy="full")
+
+    # Act
+    result = asyncio.run(builder.get(3))
+
+    # Assert
+    assert result == "あいう"
+
+
+def test_context_builder_window():
+    """windowでは直前N段落だけが文脈になること"""
+    # Arrange
+    builder = book.ContextBuilder(["あ", "い", "う", "え"], strategy="window", window=2)
+
+    # Act
+    result = asyncio.run(builder.get(3))
+
+    # Assert
+    assert result == "いう"
+
+
+def test_context_builder_summary(monkeypatch):
+    """summaryでは窓より前の段落があらすじとして渡され、後ろの段落は含まれないこと"""
+    # Arrange
+    requests = []
+
+    async def fake_update_summary(summary, new_text, cache_mode):
+        requests.append((summary, new_text))
+        return summary + new_text.upper()
+
+    monkeypatch.setattr(book, "update_summary", fake_update_summary)
+    builder = book.ContextBuilder(
+        ["a", "b", "c", "d", "e"], strategy="summary", window=1
+    )
+
+    # Act
+    async def run():
+        # 処理順が前後しても正しいあらすじになること
+        return await builder.get(4), await builder.get(2)
+
+    result4, result2 = asyncio.run(run())
+
+    # Assert
+    assert "ABC" in result4 and result4.endswith("d")
+    assert "A" in result2 and "B" not in result2 and result2.endswith("b")
+    assert requests == [("", "abc"), ("", "a")]
+
+
+def test_expand_scene_with_registry():
+    """一覧のIDで参照したキャラクター・場所が、一覧の内容と差分で展開されること"""
+    # Arrange
+    registry = book.BookRegistry(
+        characters=[
+            book.RegisteredCharacter(
+                id="c1", type="人間", name="ごんべえ", appearance="藁の帽子"
+            )
+        ],
+        locations=[book.RegisteredLocation(id="l1", specific_place="池")],
+    )
+    scene = book.SceneRefResult(
+        characters=[
+            book.CharacterRef(
+                id="c1", appearance_delta="ずぶ濡れ", state_action="驚く"
+            ),
+            book.CharacterRef(info=book.CharacterInfo(type="鳥", name="カモ")),
+        ],
+        location_id="l1",
+        time_weather=book.TimeWeatherInfo(time_of_day="朝"),
+        action_situation=book.ActionSituationInfo(),
+        emotion_atmosphere=book.EmotionAtmosphereInfo(),
+    ).model_dump()
+
+    # Act
+    result = book.expand_scene(scene, registry)
+
+    # Assert
+    assert result["characters"][0]["name"] == "ごんべえ"
+    assert result["characters"][0]["appearance"] == "藁の帽子 (ずぶ濡れ)"
+    assert result["characters"][0]["state_action"] == "驚く"
+    assert result["characters"][1]["name"] == "カモ"
+    assert result["location"]["specific_place"] == "池"
+    assert result["time_weather"]["time_of_day"] == "朝"
+    book.SceneAnalysisResult(**result)
+
+
+def test_expand_scene_without_registry():
+    """一覧が無い場合はそのまま返すこと"""
+    # Arrange
+    scene = {"characters": []}
+
+    # Act & Assert
+    assert book.expand_scene(scene, None) is scene
+
+
+def test_generate_image_uses_context_builder(monkeypatch):
+    """シーンが無い場合は、渡した文脈の組み立て方で前ページを作って抽出すること"""
+    # Arrange
+    requests = []
+
+    async def fake_get_scene_async(input_text, prev_text, cache_mode, registry):
+        requests.append((input_text, prev_text, cache_mode))
+        return {"characters": []}
+
+    async def fake_generate_image(prompt):
+        return "image.png"
+
+    monkeypatch.setattr(book, "get_scene_async", fake_get_scene_async)
+    monkeypatch.setattr(
+        book.gi, "generate_image_from_text_openai_async", fake_generate_image
+    )
+    data = book.MarkdownData(
+        title="本", paragraph=["あ", "い", "う", "え"], all_text="あいうえ"
+    )
+    builder = book.ContextBuilder(
+        data.paragraph, strategy="window", window=1, cache_mode="off"
+    )
+
+    # Act
+    result = asyncio.run(book.generate_image_async(data, 3, None, None, builder))
+
+    # Assert
+    assert result == "image.png"
+    assert requests == [("え", "う", "off")]
+
+
+def test_registry_rebuilt_when_manuscript_changes(tmp_path, monkeypatch):
+    """原稿が同じなら保存済みの一覧を使い、変わった場合は作り直すこと"""
+    # Arrange
+    requests = []
+
+    async def fake_request_registry(text, registry):
+        requests.append(text)
+        return book.BookRegistry(characters=[], locations=[])
+
+    monkeypatch.setattr(book, "request_registry", fake_request_registry)
+    data = book.MarkdownData(title="本", paragraph=["あ", "い"], all_text="あい")
+    changed = book.MarkdownData(title="本", paragraph=["あ", "う"], all_text="あう")
+
+    # Act
+    asyncio.run(book.load_or_build_registry(data, str(tmp_path), "use"))
+    asyncio.run(book.load_or_build_registry(data, str(tmp_path), "use"))
+    asyncio.run(book.load_or_build_registry(changed, str(tmp_path), "use"))
+
+    # Assert
+    assert requests == ["あい", "あう"]
+
+
+class FakeSceneClient:
+    """genai_aio_client()の偽物。シーン抽出の呼び出し回数を数える"""
+
+    def __init__(self):
+        self.calls = 0
+        self.models = SimpleNamespace(generate_content=self.generate_content)
+
+    async def generate_content(self, model, contents, config):
+        self.calls += 1
+        scene = book.SceneAnalysisResult(
+            characters=[],
+            location=book.LocationInfo(specific_place="森"),
+            time_weather=book.TimeWeatherInfo(),
+            action_situation=book.ActionSituationInfo(),
+            emotion_atmosphere=book.EmotionAtmosphereInfo(),
+        )
+        return SimpleNamespace(text=scene.model_dump_json())
+
+
+@pytest.mark.parametrize(
+    "cache_mode, expected_calls, expected_files",
+    [("use", 1, 1), ("refresh", 2, 1), ("off", 2, 0)],
+)
+def test_scene_cache_mode(
+    tmp_path, monkeypatch, cache_mode, expected_calls, expected_files
+):
+    """useでは保存済みのシーンを使い、refreshでは抽出し直し、offではメモを残さないこと"""
+    # Arrange
+    client = FakeSceneClient()
+    cache_dir = tmp_path / "scene"
+    monkeypatch.setattr(book, "genai_aio_client", lambda: client)
+    monkeypatch.setattr(
+        book, "scene_cache", book.DiskCache(str(cache_dir), 1024 * 1024, ".json")
+    )
+
+    # Act
+    results = [
+        asyncio.run(book.get_scene_async("本文", "前ページ", cache_mode))
+        for _ in range(2)
+    ]
+
+    # Assert
+    assert client.calls == expected_calls
+    assert results[0] == results[1]
+    assert results[0]["location"]["specific_place"] == "森"
+    assert len(list(cache_dir.rglob("*.json"))) == expected_files
+
+
+class FakeBookServices:
+    """run_pipelineが呼ぶシーン抽出・画像生成・音声合成の偽物 (同時実行数を記録する)"""
+
+    def __init__(self, tmp_path):
+        self.tmp_path = tmp_path
+        self.scene_batches = []
+        self.images = []
+        self.voices = []
+        self.registries = []
+        self.saved_titles = []
+        self.active = {"image": 0, "voice": 0}
+        self.max_active = {"image": 0, "voice": 0}
+        # 画像生成と音声合成が同時に実行されたか
+        self.overlapped = False
+
+    async def _run(self, stage: str, seconds: float):
+        self.active[stage] += 1
+        self.max_active[stage] = max(self.max_active[stage], self.active[stage])
+        if self.active["image"] and self.active["voice"]:
+            self.overlapped = True
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self.active[stage] -= 1
+
+    async def get_scene_batch(
+        self, paragraphs, start, end, cache_mode, prev_text, registry
+    ):
+        self.scene_batches.append((start, end))
+        self.registries.append(registry)
+        await asyncio.sleep(0.01)
+        return [{"paragraph": i} for i in range(start, end)]
+
+    async def generate_image_async(self, data, i, scene, registry, context_builder):
+        self.images.append((i, scene["paragraph"]))
+        await self._run("image", 0.05)
+        path = self.tmp_path / f"image_{i}.png"
+        path.write_bytes(b"png")
+        return str(path)
+
+    async def synthesize_to_opus(self, text, opus_path, wav_path=None):
+        self.voices.append(text)
+        await self._run("voice", 0.05)
+        with open(opus_path, "wb") as f:
+            f.write(b"opus")
+        return opus_path
+
+
+@pytest.fixture
+def services(tmp_path, monkeypatch):
+    """run_pipelineの外部呼び出しを偽物に置き換える"""
+    services = FakeBookServices(tmp_path)
+    monkeypatch.setattr(book, "get_scene_batch", services.get_scene_batch)
+    monkeypatch.setattr(book, "generate_image_async", services.generate_image_async)
+    monkeypatch.setattr(book.gv, "synthesize_to_opus", services.synthesize_to_opus)
+    monkeypatch.setattr(
+        book.book_manifest, "save_manifest", services.saved_titles.append
+    )
+    monkeypatch.setattr(
+        book.book_search, "search_index", SimpleNamespace(index_book=lambda m: None)
+    )
+    split_scene_batches = book.split_scene_batches
+    monkeypatch.setattr(
+        book, "split_scene_batches", lambda ps: split_scene_batches(ps, max_chars=2)
+    )
+    return services
+
+
+def make_book_data(tmp_path):
+    data = book.MarkdownData(
+        title="本", paragraph=["あ", "い", "う", "え", "お"], all_text="あいうえお"
+    )
+    dir_path = tmp_path / "本"
+    dir_path.mkdir()
+    return data, dir_path
+
+
+def test_run_pipeline(tmp_path, services):
+    """
+    段落ごとにシーン抽出→画像生成と音声合成を並行して進め、
+    ステージごとの同時実行数を守ること。作成済みのファイルは作り直さないこと
+    """
+    # Arrange
+    data, dir_path = make_book_data(tmp_path)
+    options = book.BookOptions(
+        limits=book.StageLimits(scene=1, image=2, voice=2),
+        scene_cache="off",
+        scene_mode="batch",
+        context="window",
+        registry=False,
+    )
+    progress = []
+
+    async def on_progress(summary):
+        progress.append(summary)
+
+    def run():
+        asyncio.run(book.run_pipeline(data, str(dir_path), on_progress, options))
+
+    # Act
+    run()
+    first = (services.scene_batches, list(services.images), list(services.voices))
+    os.remove(dir_path / "2" / "target.png")
+    os.remove(dir_path / "4" / "0.opus")
+    services.scene_batches = []
+    services.images.clear()
+    services.voices.clear()
+    run()
+
+    # Assert
+    scene_batches, images, voices = first
+    # 各段落の画像は、その段落のシーンから生成される
+    assert sorted(images) == [(i, i) for i in range(5)]
+    assert sorted(voices) == data.paragraph
+    assert sorted(scene_batches) == [(0, 2), (2, 4), (4, 5)]
+    assert services.max_active == {"image": 2, "voice": 2}
+    assert services.overlapped
+    for i in range(5):
+        assert (dir_path / str(i) / "target.png").read_bytes() == b"png"
+        assert (dir_path / str(i) / "0.opus").read_bytes() == b"opus"
+    # 2回目は削除したファイルだけを作り直す
+    assert services.images == [(2, 2)]
+    assert services.voices == ["お"]
+    assert progress
+
+
+def test_run_pipeline_without_registry(tmp_path, services, monkeypatch):
+    """登場人物・場所一覧を作れなくても、一覧を使わずにブックを作り終えること"""
+
+    # Arrange
+    async def broken_registry(data, dir_path, cache_mode):
+        raise ValueError("invalid json")
+
+    monkeypatch.setattr(book, "load_or_build_registry", broken_registry)
+    data, dir_path = make_book_data(tmp_path)
+    options = book.BookOptions(
+        scene_cache="off", scene_mode="batch", context="window", registry=True
+    )
+
+    async def on_progress(summary):
+        pass
+
+    # Act
+    asyncio.run(book.run_pipeline(data, str(dir_path), on_progress, options))
+
+    # Assert
+    assert services.registries == [None] * 3
+    assert sorted(services.voices) == data.paragraph
+    assert len(services.images) == 5
+    assert services.saved_titles == ["本"]
@@ -0,0 +1,95 @@
+import os
+
+from image_cache import ImageCache, normalize_prompt
+
+
+def test_normalize_prompt():
+    """インデントや改行の違いが無視されること"""
+    # Arrange
+    prompt1 = """
+        # 指示
+        猫と戯れている。
+    """
+    prompt2 = "# 指示 猫と戯れている。"
+
+    # Act & Assert
+    assert normalize_prompt(prompt1) == normalize_prompt(prompt2)
+
+
+def test_put_and_get(tmp_path):
+    """同じ条件で保存した画像が取得でき、条件が違えば取得できないこと"""
+    # Arrange
+    cache = ImageCache(str(tmp_path), max_bytes=1024, max_age_days=1)
+
+    # Act
+    cache.put("openai", "gpt-image-1", "1024x1024", "low", "猫", b"png")
+
+    # Assert
+    path = cache.get("openai", "gpt-image-1", "1024x1024", "low", " 猫\n")
+    assert path is not None
+    with open(path, "rb") as f:
+        assert f.read() == b"png"
+    assert cache.get("openai", "gpt-image-1", "1024x1024", "high", "猫") is None
+    assert cache.get("google", "gpt-image-1", "1024x1024", "low", "猫") is None
+
+
+def test_index_is_persisted(tmp_path):
+    """インデックスにプロンプトが記録され、別インスタンスからも参照できること"""
+    # Arrange
+    cache = ImageCache(str(tmp_path), max_bytes=1024, max_age_days=1)
+    cache.put("google", "gemini", None, None, "犬", b"png")
+
+    # Act
+    reopened = ImageCache(str(tmp_path), max_bytes=1024, max_age_days=1)
+
+    # Assert
+    assert os.path.exists(reopened.index_path)
+    assert reopened.get("google", "gemini", None, None, "犬") is not None
+
+
+def test_prune_expired(tmp_path):
+    """最終利用から期限を過ぎた画像が削除されること"""
+    # Arrange
+    cache = ImageCache(str(tmp_path), max_bytes=1024, max_age_days=1)
+    cache.put("google", "gemini", None, None, "犬", b"png")
+    key = cache.make_key("google", "gemini", None, None, "犬")
+    os.utime(cache.blobs.path_for(key + ".png"), (0, 0))
+
+    # Act
+    cache.prune()
+
+    # Assert
+    assert cache.get("google", "gemini", None, None, "犬") is None
+
+
+def test_extension_from_image_data(tmp_path):
+    """画像の形式に合った拡張子で保存されること"""
+    # Arrange
+    cache = ImageCache(str(tmp_path), max_bytes=1024, max_age_days=1)
+
+    # Act
+    cache.put("google", "gemini", None, None, "犬", b"\xff\xd8\xff\xe0jpeg")
+    cache.put("google", "gemini", None, None, "猫", b"\x89PNG\r\n\x1a\npng")
+
+    # Assert
+    assert cache.get("google", "gemini", None, None, "犬").endswith(".jpg")
+    assert cache.get("google", "gemini", None, None, "猫").endswith(".png")
+
+
+def test_get_does_not_rewrite_index(tmp_path, monkeypatch):
+    """ヒットしてもindex.jsonを書き換えず、画像本体の最終利用時刻を更新すること"""
+    # Arrange
+    cache = ImageCache(str(tmp_path), max_bytes=1024, max_age_days=1)
+    cache.put("google", "gemini", None, None, "犬", b"png")
+    path = cache.get("google", "gemini", None, None, "犬")
+    os.utime(path, (0, 0))
+    saved = []
+    monkeypatch.setattr(cache, "_save_index", lambda: saved.append(1))
+
+    # Act
+    for _ in range(3):
+        cache.get("google", "gemini", None, None, "犬")
+
+    # Assert
+    assert saved == []
+    assert os.path.getmtime(path) > 0
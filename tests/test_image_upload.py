@@ -0,0 +1,52 @@
+import io
+from random import Random
+
+from PIL import Image
+
+import image_upload
+from disk_cache import DiskCache
+
+
+def write_png(path):
+    # 生成画像に近い、PNGでは圧縮しにくい画像にする
+    random = Random(0)
+    image = Image.new("RGB", (256, 256))
+    image.putdata(
+        [(x, y, random.randrange(64)) for y in range(256) for x in range(256)]
+    )
+    image.save(path, format="PNG")
+
+
+def test_upload_image_is_converted_and_cached(tmp_path, monkeypatch):
+    """WebPに変換され、2回目はキャッシュ済みのファイルが返ること"""
+    # Arrange
+    monkeypatch.setattr(
+        image_upload, "upload_cache", DiskCache(str(tmp_path / "cache"), 10**7)
+    )
+    monkeypatch.setattr(image_upload, "UPLOAD_IMAGE_FORMAT", "webp")
+    path = str(tmp_path / "target.png")
+    write_png(path)
+
+    # Act
+    first = image_upload.upload_image_path(path)
+    second = image_upload.upload_image_path(path)
+
+    # Assert
+    assert first.endswith(".webp")
+    assert first == second
+    with open(first, "rb") as f:
+        assert Image.open(io.BytesIO(f.read())).format == "WEBP"
+
+
+def test_original_format_is_not_converted(tmp_path, monkeypatch):
+    """originalの場合は元の画像のパスがそのまま返ること"""
+    # Arrange
+    monkeypatch.setattr(image_upload, "UPLOAD_IMAGE_FORMAT", "original")
+    path = str(tmp_path / "target.png")
+    write_png(path)
+
+    # Act
+    result = image_upload.upload_image_path(path)
+
+    # Assert
+    assert result == path
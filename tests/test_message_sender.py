@@ -0,0 +1,110 @@
+import asyncio
+
+import message_sender
+from message_sender import BookSender, OutgoingParagraph, pack_messages
+
+
+def test_pack_messages_by_limits():
+    """文字数と添付数の上限でメッセージが分かれ、順番が保たれること"""
+    # Arrange
+    paragraphs = [
+        OutgoingParagraph(text="a" * 6),
+        OutgoingParagraph(text="b" * 6),
+        OutgoingParagraph(text="c" * 3, images=["1.png", "2.png", "3.png"]),
+        OutgoingParagraph(text="d" * 25),
+    ]
+
+    # Act
+    messages = pack_messages(paragraphs, max_chars=20, max_files=2)
+
+    # Assert
+    assert [(m.content, m.images) for m in messages] == [
+        ("a" * 6 + "\n\n" + "b" * 6 + "\n\n" + "c" * 3, ["1.png", "2.png"]),
+        ("d" * 20, ["3.png"]),
+        ("d" * 5, []),
+    ]
+
+
+def test_pack_messages_with_images():
+    """全ての段落に画像があっても、上限まで1通にまとめること"""
+    # Arrange
+    paragraphs = [OutgoingParagraph(text=str(i), images=[f"{i}.png"]) for i in range(5)]
+
+    # Act
+    messages = pack_messages(paragraphs, max_chars=20, max_files=3)
+
+    # Assert
+    assert [(m.content, m.images) for m in messages] == [
+        ("0\n\n1\n\n2", ["0.png", "1.png", "2.png"]),
+        ("3\n\n4", ["3.png", "4.png"]),
+    ]
+
+
+class FakeChannel:
+    id = 1
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, content=None, files=None):
+        self.sent.append(content)
+
+
+def test_book_sender_sends_ahead_within_window(monkeypatch):
+    """再生中の段落からwindow段落先までをまとめて送ること"""
+    # Arrange
+    monkeypatch.setattr(message_sender, "rate_limiters", {})
+
+    async def run():
+        channel = FakeChannel()
+        sender = BookSender(
+            channel, [OutgoingParagraph(text=str(i)) for i in range(5)], window=2
+        )
+        sender.start()
+        await asyncio.sleep(0.01)
+        first = list(channel.sent)
+
+        # Act
+        sender.advance(1)
+        await asyncio.sleep(0.01)
+        second = list(channel.sent)
+        await sender.finish()
+        return first, second, channel.sent
+
+    first, second, sent = asyncio.run(run())
+
+    # Assert
+    assert first == ["0\n\n1"]
+    assert second == ["0\n\n1", "2"]
+    assert sent == ["0\n\n1", "2", "3\n\n4"]
+
+
+def test_book_sender_uses_recorded_sha256(tmp_path, monkeypatch):
+    """manifestに記録済みの画像のハッシュを、送信用の変換に渡すこと"""
+    # Arrange
+    monkeypatch.setattr(message_sender, "rate_limiters", {})
+    image = tmp_path / "0.png"
+    image.write_bytes(b"png")
+    uploads = []
+
+    def fake_upload_image_path(path, sha256=None):
+        uploads.append((path, sha256))
+        return path
+
+    monkeypatch.setattr(message_sender, "upload_image_path", fake_upload_image_path)
+    paragraphs = [
+        OutgoingParagraph(
+            text="0", images=[str(image)], image_sha256={str(image): "abc"}
+        )
+    ]
+
+    async def run():
+        sender = BookSender(FakeChannel(), paragraphs)
+        sender.start()
+        await sender.finish()
+
+    # Act
+    asyncio.run(run())
+
+    # Assert
+    assert uploads == [(str(image), "abc")]
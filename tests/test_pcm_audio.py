@@ -0,0 +1,44 @@
+import io
+import wave
+from array import array
+
+from pcm_audio import FRAME_SIZE, wav_to_pcm
+
+
+def make_wav(samples, rate=24000, channels=1) -> bytes:
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(channels)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(array("h", samples).tobytes())
+    return buf.getvalue()
+
+
+def test_mono_24k_to_stereo_48k():
+    """24kHzモノラルが補間されて48kHzステレオになること"""
+    # Arrange
+    wav = make_wav([0, 100, 200])
+
+    # Act
+    pcm = array("h")
+    pcm.frombytes(wav_to_pcm(wav))
+
+    # Assert
+    left = list(pcm[0::2][:6])
+    right = list(pcm[1::2][:6])
+    assert left == [0, 50, 100, 150, 200, 200]
+    assert left == right
+
+
+def test_pad_to_frame_size():
+    """20ms単位で読み出せるよう無音で埋められること"""
+    # Arrange
+    wav = make_wav([1] * 1000)
+
+    # Act
+    pcm = wav_to_pcm(wav)
+
+    # Assert
+    assert len(pcm) % FRAME_SIZE == 0
+    assert len(pcm) >= 1000 * 2 * 2 * 2
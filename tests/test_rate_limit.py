@@ -0,0 +1,139 @@
+import asyncio
+
+import pytest
+
+import rate_limit
+from rate_limit import LimitConfig, ProviderLimiter, TokenBucket
+
+
+@pytest.fixture(autouse=True)
+def reset_limiters(monkeypatch):
+    monkeypatch.setattr(rate_limit, "limiters", {})
+    monkeypatch.setattr(rate_limit, "RATE_LIMITS", {})
+
+
+def test_token_bucket_waits_when_empty():
+    """上限まではすぐ使え、使い切った後は補充されるまでの待ち時間を返すこと"""
+    # Arrange
+    bucket = TokenBucket(per_minute=60)
+
+    # Act
+    delays = [bucket.reserve(1) for _ in range(62)]
+
+    # Assert
+    assert all(delay == 0 for delay in delays[:60])
+    # 1秒に1回補充されるので、61回目は約1秒、62回目は約2秒待つ
+    assert delays[60] == pytest.approx(1, abs=0.1)
+    assert delays[61] == pytest.approx(2, abs=0.1)
+
+
+def test_token_bucket_unlimited():
+    """上限0は無制限として扱うこと"""
+    # Arrange
+    bucket = TokenBucket(per_minute=0)
+
+    # Act
+    delay = bucket.reserve(10_000_000)
+
+    # Assert
+    assert delay == 0
+
+
+def test_max_in_flight():
+    """同時実行数の上限を超えた呼び出しは、空きが出るまで待つこと"""
+    # Arrange
+    limiter = ProviderLimiter("test/model", LimitConfig(max_in_flight=2))
+    running = 0
+    peak = 0
+    observed_waiting = []
+
+    async def call():
+        nonlocal running, peak
+        async with limiter.acquire():
+            running += 1
+            peak = max(peak, running)
+            observed_waiting.append(limiter.status()["waiting"])
+            await asyncio.sleep(0.01)
+            running -= 1
+
+    async def main():
+        await asyncio.gather(*(call() for _ in range(5)))
+
+    # Act
+    asyncio.run(main())
+
+    # Assert
+    assert peak == 2
+    status = limiter.status()
+    assert status["total_requests"] == 5
+    assert status["in_flight"] == 0
+    assert status["waiting"] == 0
+    # 最初の呼び出しの時点では残りの呼び出しが待っている
+    assert max(observed_waiting) > 0
+
+
+def test_cancelled_waiter_refunds_reservation():
+    """同時実行数の空きを待つ間にキャンセルされた呼び出しは、予約した枠を戻すこと"""
+    # Arrange
+    limiter = ProviderLimiter("test/model", LimitConfig(rpm=2, max_in_flight=1))
+
+    async def main():
+        async with limiter.acquire():
+            task = asyncio.create_task(limiter.acquire().__aenter__())
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        # 戻した枠を使えるので、補充を待たずに入れる
+        await asyncio.wait_for(limiter.acquire().__aenter__(), timeout=1)
+
+    # Act
+    asyncio.run(main())
+
+    # Assert
+    assert limiter.status()["total_requests"] == 2
+
+
+def test_cancelled_waiter_is_removed():
+    """待機中にキャンセルされた呼び出しは待ち件数から外れること"""
+    # Arrange
+    limiter = ProviderLimiter("test/model", LimitConfig(max_in_flight=1))
+
+    async def main():
+        async with limiter.acquire():
+            task = asyncio.create_task(limiter.acquire().__aenter__())
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        # 空きが出た後も次の呼び出しがすぐに入れる
+        async with limiter.acquire():
+            pass
+
+    # Act
+    asyncio.run(main())
+
+    # Assert
+    status = limiter.status()
+    assert status["waiting"] == 0
+    assert status["in_flight"] == 0
+    assert status["total_requests"] == 2
+
+
+def test_get_limiter_config():
+    """プロバイダの既定値に、プロバイダ/モデルごとの設定を上書きすること"""
+    # Arrange
+    rate_limit.RATE_LIMITS["gemini/fast"] = {"rpm": 10}
+
+    # Act
+    fast = rate_limit.get_limiter("gemini", "fast")
+    other = rate_limit.get_limiter("gemini", "other")
+
+    # Assert
+    assert fast.config.rpm == 10
+    assert (
+        fast.config.max_in_flight == rate_limit.DEFAULT_LIMITS["gemini"].max_in_flight
+    )
+    assert other.config.rpm == rate_limit.DEFAULT_LIMITS["gemini"].rpm
+    assert rate_limit.get_limiter("gemini", "fast") is fast
+    assert set(rate_limit.limiter_status()) == {"gemini/fast", "gemini/other"}
@@ -0,0 +1,143 @@
+import asyncio
+
+import pytest
+from botocore.exceptions import ClientError
+from pydantic import BaseModel, ValidationError
+
+import resilience
+from resilience import CircuitOpenError, retry_after, with_retry
+
+
+class StatusError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class Registry(BaseModel):
+    characters: list[str]
+
+
+@pytest.fixture(autouse=True)
+def reset_breakers(monkeypatch):
+    monkeypatch.setattr(resilience, "breakers", {})
+    monkeypatch.setattr(resilience, "backoff_delay", lambda *args: 0)
+
+
+def test_retry_until_success():
+    """失敗しても上限回数までは再試行し、成功すれば結果を返すこと"""
+    # Arrange
+    calls = []
+
+    @with_retry("test", max_attempts=3)
+    async def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise StatusError(503)
+        return "ok"
+
+    # Act
+    result = asyncio.run(flaky())
+
+    # Assert
+    assert result == "ok"
+    assert len(calls) == 3
+    assert resilience.breaker_status()["test"]["state"] == "closed"
+
+
+def test_client_error_is_not_retried():
+    """400番台(429等を除く)は再試行しないこと"""
+    # Arrange
+    calls = []
+
+    @with_retry("test", max_attempts=3)
+    def bad_request():
+        calls.append(1)
+        raise StatusError(400)
+
+    # Act & Assert
+    with pytest.raises(StatusError):
+        bad_request()
+    assert len(calls) == 1
+
+
+def test_circuit_opens_and_fails_fast(monkeypatch):
+    """連続失敗がしきい値に達すると、呼び出さずにCircuitOpenErrorになること"""
+    # Arrange
+    monkeypatch.setattr(resilience, "CIRCUIT_FAILURE_THRESHOLD", 2)
+    calls = []
+
+    @with_retry("down", max_attempts=5)
+    def down():
+        calls.append(1)
+        raise ConnectionError("down")
+
+    # Act & Assert
+    with pytest.raises(ConnectionError):
+        down()
+    with pytest.raises(CircuitOpenError):
+        down()
+    assert len(calls) == 2
+    status = resilience.breaker_status()["down"]
+    assert status["state"] == "open"
+    assert status["total_rejected"] == 1
+
+
+def test_retry_after_header():
+    """Retry-Afterの秒数を読み取れること"""
+    # Arrange & Act & Assert
+    assert retry_after(StatusError(429, {"retry-after": "7"})) == 7.0
+    assert retry_after(StatusError(429)) is None
+
+
+def test_programming_error_is_not_retried():
+    """応答の形式の誤りなどは再試行せず、ブレーカーの失敗にも数えないこと"""
+    # Arrange
+    calls = []
+
+    @with_retry("test", max_attempts=3)
+    async def bad_json():
+        calls.append(1)
+        return Registry.model_validate_json("{}")
+
+    # Act
+    for _ in range(resilience.CIRCUIT_FAILURE_THRESHOLD + 1):
+        with pytest.raises(ValidationError):
+            asyncio.run(bad_json())
+
+    # Assert
+    assert len(calls) == resilience.CIRCUIT_FAILURE_THRESHOLD + 1
+    status = resilience.breaker_status()["test"]
+    assert status["state"] == "closed"
+    assert status["total_failures"] == 0
+
+
+def test_is_retryable():
+    """通信・タイムアウトの失敗、429/408、500番台、AWSの混雑だけを再試行すること"""
+    # Arrange
+    throttled = ClientError(
+        {
+            "Error": {"Code": "ThrottlingException"},
+            "ResponseMetadata": {"HTTPStatusCode": 400},
+        },
+        "TranslateText",
+    )
+    invalid = ClientError(
+        {
+            "Error": {"Code": "ValidationException"},
+            "ResponseMetadata": {"HTTPStatusCode": 400},
+        },
+        "TranslateText",
+    )
+
+    # Act & Assert
+    assert resilience.is_retryable(ConnectionResetError())
+    assert resilience.is_retryable(asyncio.TimeoutError())
+    assert resilience.is_retryable(StatusError(429))
+    assert resilience.is_retryable(StatusError(408))
+    assert resilience.is_retryable(StatusError(503))
+    assert resilience.is_retryable(throttled)
+    assert not resilience.is_retryable(invalid)
+    assert not resilience.is_retryable(StatusError(409))
+    assert not resilience.is_retryable(KeyError("text"))
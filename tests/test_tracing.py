@@ -0,0 +1,147 @@
+import asyncio
+import json
+
+import pytest
+
+import resilience
+import tracing
+from resilience import with_retry
+from tracing import SpanRecord, critical_path, span, stage_breakdown, start_trace
+
+
+@pytest.fixture(autouse=True)
+def trace_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(tracing, "TRACE_DIR", str(tmp_path))
+    monkeypatch.setattr(tracing, "TRACE_ENABLED", True)
+    monkeypatch.setattr(resilience, "breakers", {})
+    monkeypatch.setattr(resilience, "backoff_delay", lambda *args: 0)
+    return tmp_path
+
+
+def read_records(trace_dir):
+    (path,) = trace_dir.glob("*.jsonl")
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_span_nesting(trace_dir):
+    """spanの親子関係と属性をJSON linesで書き出すこと (タスクとスレッドにも引き継ぐ)"""
+
+    # Arrange
+    def write():
+        with span("write_text", paragraph=1, bytes=10):
+            pass
+
+    async def run():
+        with span("pipeline"):
+            await asyncio.gather(
+                asyncio.to_thread(write),
+                asyncio.create_task(asyncio.sleep(0)),
+            )
+
+    # Act
+    with start_trace("book") as root:
+        root.set(title="テスト")
+        asyncio.run(run())
+
+    # Assert
+    records = {r["name"]: r for r in read_records(trace_dir)}
+    assert set(records) == {"book", "pipeline", "write_text"}
+    assert records["book"]["parent_id"] is None
+    assert records["book"]["title"] == "テスト"
+    assert records["pipeline"]["parent_id"] == records["book"]["span_id"]
+    assert records["write_text"]["parent_id"] == records["pipeline"]["span_id"]
+    assert records["write_text"]["paragraph"] == 1
+    assert records["write_text"]["bytes"] == 10
+
+
+def test_span_records_retries_and_error(trace_dir):
+    """再試行の回数と、失敗した場合のエラーを記録すること"""
+    # Arrange
+    calls = []
+
+    @with_retry("test", max_attempts=3)
+    async def flaky():
+        calls.append(1)
+        raise ConnectionError("boom")
+
+    # Act
+    with start_trace("book"):
+        with pytest.raises(ConnectionError):
+            with span("get_scene", paragraph=0):
+                asyncio.run(flaky())
+
+    # Assert
+    records = {r["name"]: r for r in read_records(trace_dir)}
+    assert records["get_scene"]["retries"] == 2
+    assert records["get_scene"]["error"] == "ConnectionError: boom"
+
+
+def test_span_without_trace(trace_dir):
+    """start_trace()の外では何も記録しないこと"""
+    # Act
+    with span("generate_image") as s:
+        pass
+
+    # Assert
+    assert s is None
+    assert list(trace_dir.glob("*.jsonl")) == []
+
+
+def make_span(span_id, name, start, duration, parent_id="root", **attrs):
+    return SpanRecord(
+        span_id=span_id,
+        parent_id=parent_id,
+        name=name,
+        start=start,
+        duration=duration,
+        **attrs,
+    )
+
+
+def test_stage_breakdown():
+    """処理ごとに件数・合計・重なりを除いた時間・バイト数を集計すること"""
+    # Arrange
+    spans = [
+        make_span("a", "synthesize_chunk", 0, 2, bytes=100),
+        make_span("b", "synthesize_chunk", 1, 2, bytes=200, retries=1),
+        make_span("c", "synthesize_chunk", 5, 1, error="RuntimeError"),
+    ]
+
+    # Act
+    (summary,) = stage_breakdown(spans)
+
+    # Assert
+    assert summary.count == 3
+    assert summary.total == pytest.approx(5)
+    # 0〜3秒と5〜6秒
+    assert summary.busy == pytest.approx(4)
+    assert summary.bytes == 300
+    assert summary.retries == 1
+    assert summary.errors == 1
+
+
+def test_critical_path():
+    """全体の完了時刻を決めた処理の連なりを返すこと"""
+    # Arrange
+    spans = [
+        make_span("root", "book", 0, 10, parent_id=None),
+        make_span("md", "markdown_to_data", 0, 1),
+        make_span("s0", "get_scene", 1, 2, paragraph=0),
+        make_span("i0", "generate_image", 3, 6, paragraph=0),
+        make_span("v0", "synthesize_chunk", 1, 3, paragraph=0, chunk=0),
+        make_span("m0", "move_image", 9, 1, paragraph=0),
+        make_span("e0", "encode_opus", 3, 1, parent_id="v0"),
+    ]
+
+    # Act
+    path = critical_path(spans)
+
+    # Assert
+    assert [(depth, s.span_id) for depth, s in path] == [
+        (0, "root"),
+        (1, "md"),
+        (1, "s0"),
+        (1, "i0"),
+        (1, "m0"),
+    ]
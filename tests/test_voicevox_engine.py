@@ -0,0 +1,230 @@
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from http.server import HTTPServer
+
+import pytest
+
+import fake_voicevox
+import generate_voice as gv
+from generate_voice import VoicevoxEngine
+
+FAKE_SERVER = os.path.join(os.path.dirname(__file__), "fake_voicevox.py")
+
+posix_only = pytest.mark.skipif(
+    os.name == "nt", reason="偽のエンジンをシェルスクリプトで起動するため"
+)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def fake_engine(tmp_path, monkeypatch):
+    """偽のVoicevoxエンジンを起動する実行ファイルと、そのURL"""
+    port = free_port()
+    monkeypatch.setenv("FAKE_VOICEVOX_PORT", str(port))
+    monkeypatch.setenv("FAKE_VOICEVOX_DELAY", "0.5")
+    exe_path = tmp_path / "voicevox"
+    exe_path.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_SERVER}"\n')
+    exe_path.chmod(0o755)
+    return str(exe_path), f"http://127.0.0.1:{port}"
+
+
+def make_engine(exe_path, url, idle_timeout=0.0):
+    return VoicevoxEngine(exe_path, url, idle_timeout=idle_timeout, startup_timeout=10)
+
+
+def wait_until(condition, timeout=5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+@posix_only
+def test_start_and_wait_for_version(fake_engine):
+    """起動後、/versionが応答するまで待ってからバージョンを記録すること"""
+    # Arrange
+    engine = make_engine(*fake_engine)
+
+    # Act
+    try:
+        with engine.use():
+            ready = engine.is_ready()
+            status = gv.check_voicevox_server(engine.base_url)
+        process = engine._process
+    finally:
+        engine.stop()
+
+    # Assert
+    assert ready
+    assert status == 200
+    assert engine.version == "0.0.0-fake"
+    assert process.poll() is not None
+    assert engine._process is None
+
+
+@posix_only
+def test_restart_after_unhealthy(fake_engine):
+    """接続に失敗した後は起動確認をやり直し、プロセスが終了していれば再起動すること"""
+    # Arrange
+    engine = make_engine(*fake_engine)
+    try:
+        engine.ensure_running()
+        first = engine._process
+
+        # Act
+        engine.mark_unhealthy()
+        engine.ensure_running()
+        same = engine._process
+        first.kill()
+        first.wait()
+        engine.mark_unhealthy()
+        engine.ensure_running()
+        second = engine._process
+    finally:
+        engine.stop()
+
+    # Assert
+    # 応答するプロセスはそのまま使い、終了したプロセスは起動し直す
+    assert same is first
+    assert second is not first
+    assert second.poll() is not None
+
+
+@posix_only
+def test_idle_stop(fake_engine):
+    """最後の利用からidle_timeout秒使われなければ停止すること"""
+    # Arrange
+    engine = make_engine(*fake_engine, idle_timeout=0.2)
+
+    # Act
+    try:
+        with engine.use():
+            process = engine._process
+        stopped = wait_until(lambda: engine._process is None)
+    finally:
+        engine.stop()
+
+    # Assert
+    assert stopped
+    assert process.wait(timeout=5) is not None
+    assert not engine.is_ready()
+
+
+@posix_only
+def test_external_server_is_not_stopped(fake_engine, monkeypatch):
+    """外部で起動済みのサーバーを使う場合は、起動も停止もしないこと"""
+    # Arrange
+    monkeypatch.setenv("FAKE_VOICEVOX_DELAY", "0")
+    exe_path, url = fake_engine
+    server = subprocess.Popen([sys.executable, FAKE_SERVER])
+    try:
+        assert wait_until(lambda: gv.check_voicevox_server(url) == 200)
+        engine = make_engine(None, url, idle_timeout=0.1)
+
+        # Act
+        with engine.use():
+            pass
+        time.sleep(0.3)
+        engine.stop()
+
+        # Assert
+        assert engine.is_ready()
+        assert engine._process is None
+        assert engine._idle_timer is None
+        assert engine.version == "0.0.0-fake"
+        assert server.poll() is None
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def test_voice_cache_hit_without_engine(tmp_path, monkeypatch):
+    """再起動後も、記録したバージョンでキャッシュを引き、エンジンを起動しないこと"""
+    # Arrange
+    monkeypatch.setattr(gv, "voice_cache", gv.DiskCache(str(tmp_path), 1024 * 1024))
+    monkeypatch.setattr(gv, "VOICE_VERSION_PATH", str(tmp_path / "version.txt"))
+    monkeypatch.setattr(gv, "_stored_version", None)
+    monkeypatch.setattr(gv, "engine", make_engine(None, "http://127.0.0.1:1"))
+    gv.engine.version = "1.0.0"
+    gv.voice_cache.put(gv.voice_cache_key("こんにちは", 1), b"wav")
+
+    # 再起動 (エンジンのバージョンも記録済みのバージョンも未取得)
+    monkeypatch.setattr(gv, "_stored_version", None)
+    monkeypatch.setattr(gv, "engine", make_engine(None, "http://127.0.0.1:1"))
+
+    # Act
+    cached = gv.read_voice_cache("こんにちは", 1)
+    missed = gv.read_voice_cache("さようなら", 1)
+
+    # Assert
+    assert cached == b"wav"
+    assert missed is None
+    assert gv.engine._process is None
+
+
+@pytest.fixture
+def voicevox_server(tmp_path, monkeypatch):
+    """同じプロセスで偽のVoicevoxエンジンを立て、音声合成の向き先にする"""
+    server = HTTPServer(("127.0.0.1", 0), fake_voicevox.Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_port}"
+    monkeypatch.setattr(fake_voicevox.Handler, "requests", {})
+    monkeypatch.setattr(gv, "VOICEVOX_URL", url)
+    monkeypatch.setattr(gv, "engine", make_engine(None, url))
+    monkeypatch.setattr(gv, "voice_cache", gv.DiskCache(str(tmp_path), 1024 * 1024))
+    monkeypatch.setattr(gv, "VOICE_VERSION_PATH", str(tmp_path / "version.txt"))
+    monkeypatch.setattr(gv, "_stored_version", None)
+    monkeypatch.setattr(gv, "_async_session", None)
+    monkeypatch.setattr(gv, "_async_session_loop", None)
+    yield fake_voicevox.Handler
+    server.shutdown()
+    server.server_close()
+
+
+def test_async_session_per_loop(voicevox_server):
+    """同じイベントループでは同じセッションを使い回し、別のループでは作り直すこと"""
+    # Arrange
+    first_loop = asyncio.new_event_loop()
+    second_loop = asyncio.new_event_loop()
+
+    async def synthesize_twice():
+        first = await gv.synthesize("こんにちは")
+        session = gv._async_session
+        second = await gv.synthesize("さようなら")
+        assert gv._async_session is session
+        return [first, second], session
+
+    async def synthesize_once():
+        wav = await gv.synthesize("またね")
+        session = gv._async_session
+        await gv.close_async_session()
+        return wav, session
+
+    # Act
+    try:
+        wavs, first_session = first_loop.run_until_complete(synthesize_twice())
+        wav, second_session = second_loop.run_until_complete(synthesize_once())
+        first_loop.run_until_complete(first_session.close())
+    finally:
+        first_loop.close()
+        second_loop.close()
+
+    # Assert
+    assert wavs == [fake_voicevox.WAV, fake_voicevox.WAV]
+    assert wav == fake_voicevox.WAV
+    assert second_session is not first_session
+    assert voicevox_server.requests["/synthesis"] == 3
+    assert gv._async_session is None